@@ -0,0 +1,485 @@
+'''
+Benchmarks for the simulation.
+
+    python benchmark.py suite --out results.json
+    python benchmark.py compare before.json after.json
+    python benchmark.py scaling --agents 250 500 1000 2000 --steps 10
+    python benchmark.py startup --pool 0 2 --restarts 20
+    python benchmark.py clock --delays 0 0.05 0.2 --seconds 5
+
+`suite` runs a set of scenarios (map size, cars and pedestrians) built from
+tiled copies of the city map or generated city-scale maps (see mapgen.py),
+each one in a fresh process, and reports step
+throughput and latency, find_path latency, frame encode time and size for
+every frame format (and for the reflective JSON encoder, to compare, and for
+a viewport in the middle of the map) and the peak memory. `compare` puts two result files side
+by side.
+
+`scaling` runs the model with an increasing number of agents and reports the
+mean step time with the occupancy grid and with the old linear scan over every
+agent.
+
+`startup` launches the server (main.py) and reports how long it takes to
+accept connections, to answer the first start command and to answer the
+next ones, once per size of its pool of models set up in the background.
+
+`clock` runs a simulation on its own clock with clients that take different
+times to handle every frame, and reports the simulation step rate and the
+frame rate of every client.
+'''
+import argparse
+import json
+import platform
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+
+import binframe
+from model import CityModel, Agent, PedestrianAgent, params
+import mapgen
+from messages import SimState, DeltaEncoder, Viewport, ViewState, ViewEncoder
+from utils import Encodable
+
+# Side of the viewport of the view-* frames, in the middle of the map
+VIEW_SIZE = 64
+
+# name: (map, cars, pedestrians, engine). The map is a number of tiles of the
+# base map or 'ROWSxCOLS' for a generated one
+SCENARIOS = {
+    'base': (1, 10, 15, 'agent'),
+    'base-dense': (1, 80, 80, 'agent'),
+    'tiled4': (4, 400, 300, 'agent'),
+    'tiled4-vector': (4, 400, 300, 'vector'),
+    'tiled12-vector': (12, 10000, 300, 'vector'),
+    'city1k-vector': ('1000x1000', 20000, 100, 'vector'),
+    'city1k-parallel': ('1000x1000', 20000, 100, 'parallel'),
+}
+
+def scanOccupied(self, move):
+    for agent in self.model.agents:
+        if agent.getPos() == move:
+            return True
+    return False
+
+def scanIntention(self, next_pos):
+    for agent in self.model.agents:
+        if isinstance(agent, PedestrianAgent) and agent.getPos() == next_pos:
+            return
+
+def tiledParams(tiles: int, numAgents: int, seed=0, engine='agent'):
+    '''
+    Model parameters for a `tiles`x`tiles` copy of the base map with half of
+    the agents being cars and the other half pedestrians
+    '''
+    road, dir, lights = mapgen.tile(tiles)
+    return dict(
+        params,
+        road=road,
+        dir=dir,
+        lights=lights,
+        numCars=numAgents // 2,
+        numPedestrians=numAgents - numAgents // 2,
+        seed=seed,
+        engine=engine,
+    )
+
+def mapParams(spec, seed=0, engine='agent'):
+    '''
+    Model parameters for a scenario map: a number of tiles or 'ROWSxCOLS'
+    '''
+    if isinstance(spec, int):
+        return tiledParams(spec, 0, seed, engine)
+    rows, cols = (int(n) for n in spec.split('x'))
+    road, dir, lights = mapgen.generate(rows, cols)
+    # City-scale maps use the hierarchical pathfinder
+    return dict(params, road=road, dir=dir, lights=lights, seed=seed, engine=engine, pathCluster=16)
+
+def timeSteps(p, steps):
+    # Seeds both random generators of the model, so every engine steps the
+    # same simulation
+    model = CityModel(p)
+    model.sim_setup(steps=steps, seed=p['seed'])
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.step()
+    return (time.perf_counter() - start) / steps
+
+def percentiles(samples) -> dict:
+    samples = np.asarray(samples, dtype=float)
+    if len(samples) == 0:
+        return { 'mean': 0.0, 'p50': 0.0, 'p99': 0.0 }
+    return {
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p99': float(np.percentile(samples, 99)),
+    }
+
+def runScenario(name, spec, cars, peds, engine, steps, queries, seed=0) -> dict:
+    '''
+    Run one scenario and measure it. Times are in milliseconds
+    '''
+    p = dict(mapParams(spec, seed, engine), numCars=cars, numPedestrians=peds)
+    model = CityModel(p)
+
+    start = time.perf_counter()
+    model.sim_setup(steps=steps, seed=seed)
+    setup = time.perf_counter() - start
+
+    # Step throughput and latency
+    latency = []
+    for _ in range(steps):
+        start = time.perf_counter()
+        model.sim_step()
+        latency.append(time.perf_counter() - start)
+    latency = np.array(latency) * 1e3
+
+    # Path queries between random tiles of the same kind
+    rng = np.random.default_rng(seed)
+    pathTimes = []
+    for i in range(queries):
+        tiles = model.index.tiles(i % 2 == 0)
+        a, b = tiles[rng.integers(len(tiles), size=2)]
+        start = time.perf_counter()
+        model.pathfinder.find_path(tuple(a), tuple(b), i % 2 == 0)
+        pathTimes.append((time.perf_counter() - start) * 1e3)
+
+    # Frame encoding, measured on the last state of the run
+    rows, cols = model.env.shape
+    x0, y0 = max(0, (rows - VIEW_SIZE) // 2), max(0, (cols - VIEW_SIZE) // 2)
+    view = Viewport(x0, y0, x0 + VIEW_SIZE, y0 + VIEW_SIZE, 0, model.env.shape)
+    encoders = {
+        'json': lambda: SimState.fromModel(model).toJSON().encode('utf-8'),
+        # The reflective Encodable.toJSON the compiled writers replaced
+        'json-reflect': lambda: Encodable.toJSON(SimState.fromModel(model)).encode('utf-8'),
+        'binary': lambda: binframe.encode(SimState.fromModel(model), model),
+        'view-json': lambda: ViewState.fromModel(model, view).toJSON().encode('utf-8'),
+        'view-binary': lambda: binframe.encode(ViewState.fromModel(model, view), model),
+    }
+    frames = {}
+    for fmt, encode in encoders.items():
+        times, data = [], b''
+        for _ in range(5):
+            start = time.perf_counter()
+            data = encode()
+            times.append((time.perf_counter() - start) * 1e3)
+        frames[fmt] = { 'encodeMs': float(np.median(times)), 'bytes': len(data) }
+
+    # Delta frames need the previous state, so step once between frames
+    for fmt in ['json', 'binary', 'view-json', 'view-binary']:
+        encoder = ViewEncoder(view) if fmt.startswith('view') else DeltaEncoder()
+        encoder.encode(model)
+        times, sizes = [], []
+        for _ in range(5):
+            model.sim_step()
+            start = time.perf_counter()
+            frame = encoder.encode(model)
+            data = binframe.encode(frame, model) if fmt.endswith('binary') else frame.toJSON().encode('utf-8')
+            times.append((time.perf_counter() - start) * 1e3)
+            sizes.append(len(data))
+        frames[f'delta-{fmt}'] = { 'encodeMs': float(np.median(times)), 'bytes': int(np.mean(sizes)) }
+
+    return {
+        'map': list(model.env.shape),
+        'cars': cars,
+        'pedestrians': peds,
+        'engine': engine,
+        'steps': steps,
+        'setupMs': setup * 1e3,
+        'stepsPerSec': float(steps / (latency.sum() / 1e3)),
+        'stepMs': percentiles(latency),
+        'findPathMs': percentiles(pathTimes),
+        'pathCache': model.pathfinder.cache_info(),
+        'frames': frames,
+        # ru_maxrss is in KiB on Linux
+        'peakMemoryMB': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def suite(scenarios: dict, steps=50, queries=200, seed=0) -> dict:
+    '''
+    Run every scenario in its own process so the peak memory of one does not
+    leak into the next
+    '''
+    results = {}
+    for name, (spec, cars, peds, engine) in scenarios.items():
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+            results[name] = pool.submit(
+                runScenario, name, spec, cars, peds, engine, steps, queries, seed
+            ).result()
+
+        r = results[name]
+        print(
+            f'{name:>16} {r["map"][0]}x{r["map"][1]} | {r["stepsPerSec"]:8.1f} steps/s'
+            f' | step p50 {r["stepMs"]["p50"]:8.2f} p99 {r["stepMs"]["p99"]:8.2f} ms'
+            f' | path p50 {r["findPathMs"]["p50"]:7.3f} ms'
+            f' | json {r["frames"]["json"]["bytes"]/1024:8.1f} KiB {r["frames"]["json"]["encodeMs"]:7.2f} ms'
+            f' | {r["peakMemoryMB"]:7.1f} MB'
+        )
+
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        rev = ''
+
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'revision': rev,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'steps': steps,
+            'queries': queries,
+            'seed': seed,
+        },
+        'scenarios': results,
+    }
+
+def flatten(results: dict, prefix='') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare(before: dict, after: dict):
+    '''
+    Print every metric of the scenarios found in both result files with the
+    ratio between them
+    '''
+    for name in before['scenarios']:
+        if name not in after['scenarios']:
+            continue
+        print(f'== {name}')
+        a = flatten(before['scenarios'][name])
+        b = flatten(after['scenarios'][name])
+        for metric in a:
+            if metric in b:
+                ratio = b[metric] / a[metric] if a[metric] else float('nan')
+                print(f'  {metric:<36} {a[metric]:>14.3f} {b[metric]:>14.3f}   x{ratio:.2f}')
+
+def run(agentCounts, steps, scan=True, engine='agent'):
+    rows = []
+    for n in agentCounts:
+        # Enough tiles so every agent gets its own starting tile
+        tiles = max(1, int(np.ceil(np.sqrt(n / 140))))
+        p = tiledParams(tiles, n, engine=engine)
+
+        grid = timeSteps(p, steps)
+
+        linear = None
+        if scan:
+            patched = Agent.isOccupied, PedestrianAgent.communicate_intention
+            Agent.isOccupied = scanOccupied
+            PedestrianAgent.communicate_intention = scanIntention
+            try:
+                linear = timeSteps(p, steps)
+            finally:
+                Agent.isOccupied, PedestrianAgent.communicate_intention = patched
+
+        rows.append((n, grid, linear))
+        print(
+            f'{n:>7} agents | grid {grid*1e3:9.2f} ms/step'
+            + (f' | scan {linear*1e3:9.2f} ms/step | x{linear/grid:.1f}' if scan else '')
+        )
+    return rows
+
+def recvFrame(sock) -> bytes:
+    def recvExactly(n):
+        data = b''
+        while len(data) < n:
+            chunk = sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('Server closed the connection')
+            data += chunk
+        return data
+    return recvExactly(struct.unpack('>I', recvExactly(4))[0])
+
+def launchServer(port: int, map=None, *options) -> subprocess.Popen:
+    cmd = [sys.executable, 'main.py', '--port', str(port), *options]
+    if map:
+        cmd += ['--map', map]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def connect(server: subprocess.Popen, port: int) -> socket.socket:
+    # Retry until the server listens
+    while True:
+        try:
+            return socket.create_connection(('127.0.0.1', port))
+        except ConnectionRefusedError:
+            if server.poll() is not None:
+                raise RuntimeError('The server exited')
+            time.sleep(0.005)
+
+def startup(pool: int, restarts=20, interval=0.5, port=42170, map=None) -> dict:
+    '''
+    Start the server with `pool` models in its pool and time the first start
+    command and `restarts` more, `interval` seconds apart
+    '''
+    begin = time.perf_counter()
+    server = launchServer(port, map, '--pool', str(pool))
+    try:
+        sock = connect(server, port)
+        listening = time.perf_counter() - begin
+
+        with sock:
+            sock.sendall(b'start\n')
+            recvFrame(sock)
+            first = time.perf_counter() - begin
+
+            latencies = []
+            for _ in range(restarts):
+                time.sleep(interval)
+                start = time.perf_counter()
+                sock.sendall(b'start\n')
+                recvFrame(sock)
+                latencies.append((time.perf_counter() - start) * 1e3)
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        'pool': pool,
+        'listenMs': listening * 1e3,
+        'firstStartMs': first * 1e3,
+        'restartMs': percentiles(latencies),
+    }
+
+def clockRates(delays, seconds=5.0, tick=0.0, port=42171, map=None) -> dict:
+    '''
+    Run a simulation on its clock with one client pulling frames per value
+    in `delays` (seconds it spends on every frame, like a slow renderer) and
+    report the simulation and client rates separately
+    '''
+    server = launchServer(port, map, '--pool', '0')
+    try:
+        owner = connect(server, port)
+        owner.sendall(b'start\nshare bench\n')
+        recvFrame(owner)
+        owner.sendall(f'clock {tick}\n'.encode())
+
+        clients = []
+        for _ in delays:
+            sock = connect(server, port)
+            sock.sendall(b'binary\ndelta\nattach bench\n')
+            recvFrame(sock)
+            clients.append(sock)
+
+        end = time.monotonic() + seconds
+        def pull(sock, delay):
+            while time.monotonic() < end:
+                sock.sendall(b'step\n')
+                recvFrame(sock)
+                time.sleep(delay)
+        threads = [threading.Thread(target=pull, args=args) for args in zip(clients, delays)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        owner.sendall(b'load\n')
+        load = json.loads(recvFrame(owner))
+    finally:
+        server.terminate()
+        server.wait()
+
+    clock = next(sim for sim in load['simulations'] if sim['name'] == 'bench')['clock']
+    byName = { client['name']: client for client in clock['clients'] }
+    return {
+        'stepsPerSec': clock['stepsPerSec'],
+        'clients': [
+            dict(byName['%s:%d' % sock.getsockname()], delay=delay)
+            for sock, delay in zip(clients, delays)
+        ],
+    }
+
+def parseScenario(text: str):
+    # name:map:cars:pedestrians[:engine], the map being tiles or ROWSxCOLS
+    name, spec, cars, peds, *engine = text.split(':')
+    spec = int(spec) if spec.isdigit() else spec
+    return name, (spec, int(cars), int(peds), engine[0] if engine else 'agent')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    suiteArgs = commands.add_parser('suite', help='Run the benchmark scenarios')
+    suiteArgs.add_argument('--scenario', type=parseScenario, action='append',
+                           help='name:map:cars:pedestrians[:engine] with the map being a number of tiles'
+                                ' or ROWSxCOLS (repeatable, replaces the defaults)')
+    suiteArgs.add_argument('--only', nargs='+', help='Run only these default scenarios')
+    suiteArgs.add_argument('--steps', type=int, default=50)
+    suiteArgs.add_argument('--queries', type=int, default=200, help='find_path calls per scenario')
+    suiteArgs.add_argument('--seed', type=int, default=0)
+    suiteArgs.add_argument('--out', default='benchmark.json')
+
+    compareArgs = commands.add_parser('compare', help='Compare two result files')
+    compareArgs.add_argument('before')
+    compareArgs.add_argument('after')
+
+    scalingArgs = commands.add_parser('scaling', help='Step time against agent count')
+    scalingArgs.add_argument('--agents', type=int, nargs='+', default=[250, 500, 1000, 2000])
+    scalingArgs.add_argument('--steps', type=int, default=10)
+    scalingArgs.add_argument('--no-scan', action='store_true', help='Skip the linear scan baseline')
+    scalingArgs.add_argument('--engine', choices=['agent', 'vector'], default='agent')
+
+    startupArgs = commands.add_parser('startup', help='Server startup and start command latency')
+    startupArgs.add_argument('--pool', type=int, nargs='+', default=[0, 2], help='Pool sizes to compare')
+    startupArgs.add_argument('--restarts', type=int, default=20)
+    startupArgs.add_argument('--interval', type=float, default=0.5, help='Seconds between start commands')
+    startupArgs.add_argument('--port', type=int, default=42170)
+    startupArgs.add_argument('--map', help='Directory with a map saved by mapgen.py')
+
+    clockArgs = commands.add_parser('clock', help='Free-running simulation against slow clients')
+    clockArgs.add_argument('--delays', type=float, nargs='+', default=[0, 0.05, 0.2],
+                           help='Seconds every client spends on each frame')
+    clockArgs.add_argument('--seconds', type=float, default=5)
+    clockArgs.add_argument('--tick', type=float, default=0, help='Steps per second (0 for as fast as possible)')
+    clockArgs.add_argument('--port', type=int, default=42171)
+    clockArgs.add_argument('--map', help='Directory with a map saved by mapgen.py')
+    args = parser.parse_args()
+
+    if args.command == 'suite':
+        scenarios = dict(args.scenario) if args.scenario else dict(SCENARIOS)
+        if args.only:
+            scenarios = { name: scenarios[name] for name in args.only }
+        results = suite(scenarios, args.steps, args.queries, args.seed)
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results saved to {args.out}')
+
+    elif args.command == 'compare':
+        with open(args.before) as a, open(args.after) as b:
+            compare(json.load(a), json.load(b))
+
+    elif args.command == 'startup':
+        for pool in args.pool:
+            r = startup(pool, args.restarts, args.interval, args.port, args.map)
+            print(
+                f'pool {pool:>3} | listening {r["listenMs"]:8.1f} ms | first start {r["firstStartMs"]:8.1f} ms'
+                f' | restart p50 {r["restartMs"]["p50"]:8.2f} p99 {r["restartMs"]["p99"]:8.2f} ms'
+            )
+
+    elif args.command == 'clock':
+        r = clockRates(args.delays, args.seconds, args.tick, args.port, args.map)
+        print(f'simulation {r["stepsPerSec"]:8.1f} steps/s')
+        for client in r['clients']:
+            print(
+                f'client delay {client["delay"]:5.3f} s | {client["framesPerSec"]:8.1f} frames/s'
+                f' | {client["skipped"]} steps skipped'
+            )
+
+    else:
+        run(args.agents, args.steps, scan=not args.no_scan, engine=args.engine)
+
+if __name__ == '__main__':
+    main()
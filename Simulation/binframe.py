@@ -0,0 +1,180 @@
+'''
+Compact binary encoding of the simulation frames.
+
+Every frame is a fixed little-endian header followed by its sections, in
+this order and only when their count is not zero:
+
+    header   MAGIC, version u8, kind u8, flags u16, seq u32, rows u32,
+             cols u32 and the number of agents, moves, goals, deleted ids
+             and lights (u32 each)
+    view     x0, y0, x1, y1 i32 (only when FLAG_VIEW is set): the frame only
+             covers rows x0 to x1 and columns y0 to y1 (not included)
+    grid     rows * cols u32 tile values (only when FLAG_GRID is set), or
+             the tiles of the view
+    agents   AGENT_DTYPE records
+    moved    MOVE_DTYPE records
+    goals    MOVE_DTYPE records with the new goal (-1, -1 for none)
+    deleted  u32 agent ids
+    lights   LIGHT_DTYPE records
+
+Every section size is a multiple of 4 bytes so all of them stay aligned and
+can be read in place from the receiving buffer.
+'''
+import struct
+import numpy as np
+
+from constants import AGENT_TYPES, RED, GREEN
+
+MAGIC = b'CSIM'
+VERSION = 1
+
+# Frame kinds
+FULL = 0   # SimState: every agent plus the grid
+KEY = 1    # KeyFrame of the delta stream
+DELTA = 2  # DeltaFrame of the delta stream
+
+FLAG_GRID = 1
+FLAG_VIEW = 2
+
+HEADER = struct.Struct('<4sBBHIIIIIIII')
+
+AGENT_DTYPE = np.dtype({
+    'names': ['id', 'type', 'x', 'y', 'gx', 'gy'],
+    'formats': ['<u4', 'u1', '<i4', '<i4', '<i4', '<i4'],
+    'offsets': [0, 4, 8, 12, 16, 20],
+    'itemsize': 24,
+})
+MOVE_DTYPE = np.dtype([('id', '<u4'), ('x', '<i4'), ('y', '<i4')])
+LIGHT_DTYPE = np.dtype({
+    'names': ['id', 'state'],
+    'formats': ['<u4', 'u1'],
+    'offsets': [0, 4],
+    'itemsize': 8,
+})
+
+LIGHT_CODES = { 'red': RED, 'green': GREEN }
+LIGHT_NAMES = { code: name for name, code in LIGHT_CODES.items() }
+NO_GOAL = (-1, -1)
+
+_gridCache = (None, None)
+
+def gridBytes(road: np.ndarray) -> bytes:
+    '''
+    Raw u32 buffer of the grid. The road grid never changes during a run so
+    the last one is kept around
+    '''
+    global _gridCache
+    cached, data = _gridCache
+    if cached is not road:
+        data = np.ascontiguousarray(road, dtype='<u4').tobytes()
+        _gridCache = (road, data)
+    return data
+
+def agentRecords(agents) -> np.ndarray:
+    if isinstance(agents, np.ndarray):
+        # Already records (like the ones of a replay)
+        return agents.astype(AGENT_DTYPE, copy=False)
+
+    def rows():
+        for agent in agents:
+            x, y = agent.getPos()
+            gx, gy = NO_GOAL if agent.goal is None else agent.goal
+            yield (agent.id, agent.typeCode, x, y, gx, gy)
+    return np.fromiter(rows(), dtype=AGENT_DTYPE, count=len(agents))
+
+def lightRecords(lights: list) -> np.ndarray:
+    if isinstance(lights, np.ndarray):
+        return lights.astype(LIGHT_DTYPE, copy=False)
+    return np.array(
+        [(light['id'], LIGHT_CODES[light['state']]) for light in lights],
+        dtype=LIGHT_DTYPE
+    )
+
+def pack(kind, seq, dims, grid=None, agents=(), moved=(), goals=(), deleted=(), lights=(), view=None) -> bytes:
+    agents = agentRecords(agents)
+    moved = np.array([tuple(m) for m in moved], dtype=MOVE_DTYPE)
+    goals = np.array([(g[0], *(NO_GOAL if g[1] is None else g[1:])) for g in goals], dtype=MOVE_DTYPE)
+    deleted = np.asarray(deleted, dtype='<u4')
+    lights = lightRecords(lights)
+
+    rows, cols = dims
+    flags = (FLAG_GRID if grid is not None else 0) | (FLAG_VIEW if view is not None else 0)
+    header = HEADER.pack(
+        MAGIC, VERSION, kind, flags, seq, rows, cols,
+        len(agents), len(moved), len(goals), len(deleted), len(lights),
+    )
+    parts = [header]
+    if view is not None:
+        parts.append(np.asarray(view, dtype='<i4').tobytes())
+    if grid is not None:
+        # Only the whole grid stays the same between frames
+        parts.append(gridBytes(grid) if view is None else np.ascontiguousarray(grid, dtype='<u4').tobytes())
+    parts += [agents.tobytes(), moved.tobytes(), goals.tobytes(), deleted.tobytes(), lights.tobytes()]
+    return b''.join(parts)
+
+def encode(frame, model) -> bytes:
+    '''
+    Binary version of a SimState, KeyFrame or DeltaFrame, or of their
+    viewport versions. Agents that entered a viewport go with the spawned
+    ones and the ones that left it with the deleted ones
+    '''
+    kind = getattr(frame, 'frame', None)
+    view = getattr(frame, 'view', None)
+    grid = model.env.road if view is None else frame.grid
+    if kind == 'key':
+        return pack(KEY, frame.seq, frame.dims, grid, agents=frame.agents, lights=frame.lights, view=view)
+    if kind == 'delta' and hasattr(frame, 'entered'):
+        return pack(
+            DELTA, frame.seq, model.env.shape, agents=frame.entered, moved=frame.moved,
+            goals=frame.goals, deleted=frame.left + frame.deleted, lights=frame.lights,
+        )
+    if kind == 'delta':
+        return pack(
+            DELTA, frame.seq, model.env.shape, agents=frame.spawned, moved=frame.moved,
+            goals=frame.goals, deleted=frame.deleted, lights=frame.lights,
+        )
+    return pack(FULL, 0, frame.dims, grid, agents=frame.agents, deleted=frame.deleted, view=view)
+
+def decode(buf) -> dict:
+    '''
+    Parse a binary frame into NumPy arrays (views over `buf`). Meant for
+    tests and Python clients
+    '''
+    (magic, version, kind, flags, seq, rows, cols,
+     nAgents, nMoved, nGoals, nDeleted, nLights) = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'Not a version {VERSION} frame')
+
+    offset = HEADER.size
+    def take(dtype, count):
+        nonlocal offset
+        arr = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        offset += arr.nbytes
+        return arr
+
+    frame = { 'kind': kind, 'seq': seq, 'dims': (rows, cols) }
+    frame['view'] = tuple(take('<i4', 4).tolist()) if flags & FLAG_VIEW else None
+    if frame['view'] is not None:
+        x0, y0, x1, y1 = frame['view']
+        rows, cols = x1 - x0, y1 - y0
+    frame['grid'] = take('<u4', rows * cols).reshape(rows, cols) if flags & FLAG_GRID else None
+    frame['agents'] = take(AGENT_DTYPE, nAgents)
+    frame['moved'] = take(MOVE_DTYPE, nMoved)
+    frame['goals'] = take(MOVE_DTYPE, nGoals)
+    frame['deleted'] = take('<u4', nDeleted)
+    frame['lights'] = take(LIGHT_DTYPE, nLights)
+    return frame
+
+def agentDicts(records: np.ndarray) -> list:
+    '''
+    Decoded agent records in the same shape as their JSON version
+    '''
+    return [
+        {
+            'id': int(r['id']),
+            'pos': [int(r['x']), int(r['y'])],
+            'type': AGENT_TYPES[r['type']],
+            'goal': None if r['gx'] < 0 else [int(r['gx']), int(r['gy'])],
+        }
+        for r in records
+    ]
@@ -0,0 +1,278 @@
+'''
+Free-running simulations.
+
+A SimClock steps a simulation on a thread of its own at `tick` steps per
+second (or as fast as it can) instead of waiting for `step` commands. After a
+step it publishes a Snapshot: the agents as records sorted by id and the
+light states. Publishing only swaps the reference to the latest snapshot, so
+readers always get a whole step and the snapshot they hold stays valid while
+the clock builds the next one.
+
+Every client is pushed the latest snapshot whenever it is ready for another
+frame and skips the ones published meanwhile, so a slow client neither slows
+the simulation down nor falls behind it. Delta frames are the difference
+between the last snapshot a client got and the latest one, and full frames
+list the agents that are gone since then as deleted. Snapshots are only
+built after a step when some client is waiting for one.
+
+Anything else that reads the model while the clock runs is handed to the
+clock thread with `call` and runs between two steps.
+'''
+import asyncio
+import queue
+import threading
+import time
+
+import numpy as np
+
+import binframe
+from binframe import KEY, DELTA, FULL
+from messages import SimState, KeyFrame, DeltaFrame, ViewState, ViewKeyFrame, ViewDeltaFrame, Viewport, lightList
+
+class Snapshot:
+    '''
+    State of a simulation after step `seq`, shared by every client. Full
+    frames of the whole map are encoded once per format and deleted ids. The
+    frames of a Viewport only have the agents, tiles and lights inside it
+    '''
+    def __init__(self, seq: int, model):
+        self.seq = seq
+        self.dims = model.env.shape
+        self.grid = model.env.road
+        self.agents = np.sort(binframe.agentRecords(model.agents), order='id')
+        self.lightSystem = model.env.lights
+        self.lights = model.env.lights.crossings
+        self.frames = {}
+        self.lock = threading.Lock()
+
+    def visible(self, view: Viewport):
+        '''
+        Agents and light states inside `view`
+        '''
+        if view is None:
+            return self.agents, self.lights
+        states = self.lights
+        return self.agents[view.contains(self.agents)], { ID: states[ID] for ID in view.lights(self.lightSystem) if ID in states }
+
+    def gone(self, ids: np.ndarray) -> np.ndarray:
+        '''
+        Agents of `ids` that are not in the snapshot
+        '''
+        return np.setdiff1d(ids, self.agents['id'])
+
+    def full(self, binary: bool, view: Viewport = None, deleted=()) -> bytes:
+        deleted = np.asarray(deleted, dtype='<u4')
+        if view is not None:
+            agents, _ = self.visible(view)
+            if binary:
+                return binframe.pack(
+                    FULL, 0, self.dims, view.grid(self.grid), agents=agents, deleted=deleted, view=view.rect,
+                )
+            return ViewState(
+                dims=self.dims,
+                view=view.rect,
+                agents=agents,
+                grid=view.grid(self.grid),
+                deleted=deleted.tolist(),
+            ).toJSON().encode('utf-8')
+
+        # Clients that got the same snapshots before get the same frame
+        key = (binary, deleted.tobytes())
+        with self.lock:
+            if key not in self.frames:
+                if binary:
+                    data = binframe.pack(FULL, 0, self.dims, self.grid, agents=self.agents, deleted=deleted)
+                else:
+                    data = SimState(
+                        dims=self.dims,
+                        agents=self.agents,
+                        grid=self.grid,
+                        deleted=deleted.tolist(),
+                    ).toJSON().encode('utf-8')
+                self.frames[key] = data
+            return self.frames[key]
+
+    def key(self, seq: int, binary: bool, view: Viewport = None) -> bytes:
+        agents, lights = self.visible(view)
+        lights = lightList(lights)
+        if view is not None:
+            if binary:
+                return binframe.pack(
+                    KEY, seq, self.dims, view.grid(self.grid), agents=agents, lights=lights, view=view.rect,
+                )
+            return ViewKeyFrame(
+                frame='key',
+                seq=seq,
+                dims=self.dims,
+                view=view.rect,
+                grid=view.grid(self.grid),
+                agents=agents,
+                lights=lights,
+            ).toJSON().encode('utf-8')
+
+        if binary:
+            return binframe.pack(KEY, seq, self.dims, self.grid, agents=agents, lights=lights)
+        return KeyFrame(
+            frame='key',
+            seq=seq,
+            dims=self.dims,
+            grid=self.grid,
+            agents=self.agents,
+            lights=lights,
+        ).toJSON().encode('utf-8')
+
+    def delta(self, prev: 'Snapshot', seq: int, binary: bool, view: Viewport = None) -> bytes:
+        '''
+        Changes since snapshot `prev`, numbered `seq`. With a view, agents
+        that are not in it anymore but still in the map have left it
+        '''
+        cur, states = self.visible(view)
+        old, oldStates = prev.visible(view)
+        kept = np.isin(cur['id'], old['id'])
+        gone = ~np.isin(old['id'], cur['id'])
+        # Both are sorted by id so the agents in both line up
+        a, b = cur[kept], old[~gone]
+        moved = a[(a['x'] != b['x']) | (a['y'] != b['y'])]
+        goals = a[(a['gx'] != b['gx']) | (a['gy'] != b['gy'])]
+
+        spawned = cur[~kept]
+        moved = [[i, x, y] for i, x, y in zip(*(moved[f].tolist() for f in ('id', 'x', 'y')))]
+        goals = [[i] + ([None] if x < 0 else [x, y]) for i, x, y in zip(*(goals[f].tolist() for f in ('id', 'gx', 'gy')))]
+        deleted = old['id'][gone]
+        lights = lightList({ ID: s for ID, s in states.items() if oldStates.get(ID) != s })
+
+        if view is not None:
+            alive = np.isin(deleted, self.agents['id'])
+            left, deleted = deleted[alive].tolist(), deleted[~alive].tolist()
+            if binary:
+                return binframe.pack(
+                    DELTA, seq, self.dims, agents=spawned, moved=moved, goals=goals,
+                    deleted=left + deleted, lights=lights,
+                )
+            return ViewDeltaFrame(
+                frame='delta',
+                seq=seq,
+                entered=spawned,
+                moved=moved,
+                goals=goals,
+                left=left,
+                deleted=deleted,
+                lights=lights,
+            ).toJSON().encode('utf-8')
+
+        deleted = deleted.tolist()
+
+        if binary:
+            return binframe.pack(
+                DELTA, seq, self.dims, agents=spawned, moved=moved, goals=goals, deleted=deleted, lights=lights,
+            )
+        return DeltaFrame(
+            frame='delta',
+            seq=seq,
+            spawned=spawned,
+            moved=moved,
+            goals=goals,
+            deleted=deleted,
+            lights=lights,
+        ).toJSON().encode('utf-8')
+
+def settle(future: asyncio.Future, result, error: Exception):
+    if not future.cancelled():
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+class SimClock:
+    '''
+    Steps `sim` on its own thread at `tick` steps per second (0 for as fast
+    as possible) and publishes snapshots for the clients waiting on `next`
+    '''
+    def __init__(self, sim, tick: float, loop: asyncio.AbstractEventLoop):
+        self.sim = sim
+        self.tick = tick
+        self.loop = loop
+        self.latest: Snapshot = None
+        self.published = asyncio.Event()
+        # Set by clients waiting for a snapshot newer than the latest one
+        self.wanted = threading.Event()
+        self.wanted.set()
+        # Calls waiting for the current step to end
+        self.calls = queue.SimpleQueue()
+        self.running = True
+        self.steps = 0
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name=f'clock-{sim.name}', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        sim = self.sim
+        deadline = time.monotonic()
+        while self.running:
+            sim.step()
+            self.steps += 1
+            self.runCalls()
+            if self.wanted.is_set():
+                self.wanted.clear()
+                clock = sim.stats.clock()
+                self.latest = Snapshot(sim.steps, sim.model)
+                sim.stats.record('snapshot', clock)
+                self.loop.call_soon_threadsafe(self.notify)
+
+            if self.tick > 0:
+                # Don't try to catch up on more than a second of lag
+                deadline = max(deadline + 1 / self.tick, time.monotonic() - 1)
+                time.sleep(max(0, deadline - time.monotonic()))
+        self.runCalls()
+
+    def runCalls(self):
+        while not self.calls.empty():
+            future, fn, args = self.calls.get()
+            try:
+                result, error = fn(*args), None
+            except Exception as e:
+                result, error = None, e
+            self.loop.call_soon_threadsafe(settle, future, result, error)
+
+    def call(self, fn, *args) -> asyncio.Future:
+        '''
+        Run `fn` on the clock thread once the current step is done
+        '''
+        future = self.loop.create_future()
+        self.calls.put((future, fn, args))
+        return future
+
+    def notify(self):
+        # Wake everyone waiting and start a new event for the next snapshot
+        published, self.published = self.published, asyncio.Event()
+        published.set()
+
+    async def next(self, last: Snapshot) -> Snapshot:
+        '''
+        Wait for a snapshot newer than `last`, or None once the clock stops
+        '''
+        while self.latest is None or self.latest is last:
+            if not self.running:
+                return None
+            published = self.published
+            self.wanted.set()
+            await published.wait()
+        return self.latest
+
+    def load(self) -> dict:
+        alive = time.monotonic() - self.started
+        return {
+            'tick': self.tick,
+            'stepsPerSec': self.steps / alive if alive else 0.0,
+            'clients': [conn.clockLoad() for conn in self.sim.connections if conn.last is not None],
+        }
+
+    def stop(self, wait=True):
+        '''
+        Stop stepping once the current step is done (blocking until then with
+        `wait`) and wake everyone waiting for a snapshot
+        '''
+        self.running = False
+        self.loop.call_soon_threadsafe(self.notify)
+        if wait:
+            self.thread.join()
@@ -39,3 +39,12 @@ DIR_VECS = {
 }
 
 LIGHT_SHIFT = 16 # Traffic light IDs will start at this bit index
+
+# Traffic light state codes
+RED=0
+GREEN=1
+
+# Agent type codes, also used as the index of each occupancy layer
+CAR=0
+PEDESTRIAN=1
+AGENT_TYPES = ['car', 'pedestrian']
@@ -0,0 +1,106 @@
+import numpy as np
+from constants import *
+
+def pickMoves(moves, valid, moving, rand):
+    '''
+    New position of the `moving` cars (the ones with a valid candidate),
+    chosen uniformly between their candidates with one `rand` value in [0, 1)
+    per moving car
+    '''
+    count = valid[moving].sum(axis=1)
+    pick = (rand * count).astype(np.int64)
+    column = np.argmax(np.cumsum(valid[moving], axis=1) > pick[:, None], axis=1)
+    return moves[moving, column]
+
+class CarEngine:
+    '''
+    Struct-of-arrays stepping for every CarAgent of a model.
+
+    Car positions live in a NumPy array and the candidate moves of all the cars
+    are looked up at once in the car movement graph (see movegraph.py) given
+    the light state, with the same rules as CarAgent.getRoads: regular moves
+    first and lane changes only when every regular move is blocked. The random
+    choice between candidates is drawn in bulk from `model.nprandom`.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.env = model.env
+        self.graph = model.moves[False]
+        self.cars = []
+        self.slot = {}
+        self.xy = np.empty((0, 2), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.cars)
+
+    def add(self, cars, positions):
+        '''
+        Start tracking some cars at the given positions
+        '''
+        for car in cars:
+            self.slot[car] = len(self.cars)
+            self.cars.append(car)
+        self.xy = np.concatenate([self.xy, np.asarray(positions, dtype=np.int64).reshape(-1, 2)])
+
+    def remove(self, cars):
+        '''
+        Stop tracking some cars, filling their slots with the last ones
+        '''
+        for car in cars:
+            i = self.slot.pop(car)
+            last = self.cars.pop()
+            if last is not car:
+                self.cars[i] = last
+                self.slot[last] = i
+                self.xy[i] = self.xy[len(self.cars)]
+        self.xy = self.xy[:len(self.cars)]
+
+    def candidates(self):
+        '''
+        Candidate moves of every car as a (cars, width, 2) array and a mask
+        with the valid ones, see MoveGraph.candidates
+        '''
+        return self.graph.candidates(self.xy, self.env.lights.state)
+
+    def step(self):
+        '''
+        Move every car and return the ones that ended up on the map border
+        '''
+        if not self.cars:
+            return []
+
+        self.apply(*self.propose())
+        return self.onBorder()
+
+    def propose(self):
+        '''
+        Moves the cars would make this step, without making them: the slots
+        of the cars that move and their new positions
+        '''
+        if not self.cars:
+            return np.empty(0, dtype=np.int64), np.empty((0, 2), dtype=np.int64)
+
+        moves, valid = self.candidates()
+        moving = np.flatnonzero(valid.any(axis=1))
+        return moving, pickMoves(moves, valid, moving, self.model.nprandom.random(len(moving)))
+
+    def apply(self, slots, new):
+        '''
+        Move the cars in `slots` to `new`
+        '''
+        self.model.metrics.carsMoved(self.xy[slots], new)
+        self.env.moveMany([self.cars[i] for i in slots], self.xy[slots], new)
+        self.xy[slots] = new
+
+    def onBorder(self):
+        '''
+        Cars standing on the map border
+        '''
+        r, c = self.env.shape
+        x, y = self.xy[:, 0], self.xy[:, 1]
+        out = np.flatnonzero((x <= 0) | (y <= 0) | (x + 1 >= r) | (y + 1 >= c))
+        return [self.cars[i] for i in out]
+
+    def close(self):
+        # Nothing to release, see PartitionedEngine
+        pass
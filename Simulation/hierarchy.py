@@ -0,0 +1,336 @@
+'''
+Hierarchical pathfinding (HPA*).
+
+The map is cut into square clusters of `size` cells. Wherever an agent can
+step from one cluster into the next one, the step becomes a transition: the
+cells on both sides are abstract nodes joined by an edge of cost 1. For
+pedestrians, who can always walk along the border, only the middle step of
+every run of steps next to each other is kept. Inside every cluster the abstract
+nodes are joined by the length of the shortest path between them that stays
+in the cluster. All of this is computed once per map and agent type, from
+the regular moves of its MoveGraph (the ones PathFinder.get_valid_neighbors
+returns).
+
+A query links the start and the goal to the nodes of their clusters, searches
+the abstract graph and only then refines the abstract path into cells, one
+cluster at a time. Refined segments are cached since many paths share them.
+'''
+import heapq
+import threading
+from collections import OrderedDict
+from typing import List, Tuple, Optional
+
+import numpy as np
+
+from constants import *
+from instrument import Stats
+from movegraph import MoveGraph
+
+# Direction bit and (dx, dy) of every move
+MOVES = [(ND, -1, 0), (SD, 1, 0), (ED, 0, 1), (WD, 0, -1)]
+
+def shifted(dx: int, dy: int, shape) -> Tuple[tuple, tuple]:
+    '''
+    Slices of the cells that have a neighbor at (dx, dy) and of those
+    neighbors
+    '''
+    rows, cols = shape
+    src = (slice(max(0, -dx), rows - max(0, dx)), slice(max(0, -dy), cols - max(0, dy)))
+    dst = (slice(max(0, dx), rows + min(0, dx)), slice(max(0, dy), cols + min(0, dy)))
+    return src, dst
+
+def run_middles(mask: np.ndarray, size: int) -> np.ndarray:
+    '''
+    Flat indices (row-major) of the middle cell of every run of True cells
+    along the rows of `mask`, cutting the runs at cluster borders
+    '''
+    cols = mask.shape[1]
+    cells = np.flatnonzero(mask)
+    if not len(cells):
+        return cells
+    y = cells % cols
+    # A run starts where the previous cell is not in it or in another cluster
+    starts = np.ones(len(cells), dtype=bool)
+    starts[1:] = (cells[1:] != cells[:-1] + 1) | (y[1:] % size == 0)
+    first = np.flatnonzero(starts)
+    lengths = np.diff(np.append(first, len(cells)))
+    return cells[first + (lengths - 1) // 2]
+
+class ClusterGraph:
+    '''
+    Abstract graph of one agent type over a map given its MoveGraph, see the
+    module docstring
+    '''
+    def __init__(self, graph: MoveGraph, is_pedestrian: bool, size: int = 16,
+                 stats: Optional[Stats] = None, segment_cache: int = 1 << 16):
+        self.shape = graph.shape
+        self.rows, self.cols = graph.shape
+        self.size = size
+        self.stats = stats if stats is not None else Stats()
+        self.segments: OrderedDict = OrderedDict()
+        self.segment_cache = segment_cache
+        # The graph of a map can be shared by models stepping on other threads
+        self.lock = threading.Lock()
+
+        clock = self.stats.clock()
+        # Cells the agent can enter and, for every move in MOVES, the cells
+        # that take it, from the regular moves of the graph
+        src, dst = graph.edges()
+        dx, dy = dst // self.cols - src // self.cols, dst % self.cols - src % self.cols
+        enterable = np.zeros(self.shape, dtype=bool)
+        enterable.ravel()[dst] = True
+        masks = []
+        for _, mx, my in MOVES:
+            mask = np.zeros(self.shape, dtype=bool)
+            mask.ravel()[src[(dx == mx) & (dy == my)]] = True
+            masks.append(mask)
+        x, y = np.indices(self.shape)
+        self.cluster_cols = -(-self.cols // size)
+        self.cluster = (x // size) * self.cluster_cols + y // size
+
+        # Split every move between the ones that stay in a cluster and the
+        # ones that cross into the next
+        intra, inter = [], []
+        for mask, (_, dx, dy) in zip(masks, MOVES):
+            src, dst = shifted(dx, dy, self.shape)
+            crossing = np.zeros(self.shape, dtype=bool)
+            crossing[src] = self.cluster[src] != self.cluster[dst]
+            intra.append(mask & ~crossing)
+            inter.append(mask & crossing)
+        self.intra = intra
+        # Bit i set if the i-th move stays in the cluster, for the queries
+        self.intra_bits = sum((m.astype(np.uint8) << i) for i, m in enumerate(intra)).astype(np.uint8)
+
+        # Transitions: (from cell, to cell) of the middle step of every run.
+        # Cars cannot always change lanes, so for them every step is one
+        pairs = []
+        for mask, (_, dx, dy) in zip(inter, MOVES):
+            if not is_pedestrian:
+                u = np.flatnonzero(mask)
+                pairs.append(np.stack([u, u + dx * self.cols + dy], axis=1))
+                continue
+            # Only cells pedestrians can stand on are joined along the border
+            mask = mask & enterable
+            if dx:
+                u = run_middles(mask, size)
+            else:
+                # Runs along the columns, found on the transposed mask
+                t = run_middles(mask.T, size)
+                u = (t % self.rows) * self.cols + t // self.rows
+            pairs.append(np.stack([u, u + dx * self.cols + dy], axis=1))
+        pairs = np.concatenate(pairs) if pairs else np.empty((0, 2), dtype=np.int64)
+
+        self.cells = np.unique(pairs)
+        n = len(self.cells)
+        node = np.searchsorted(self.cells, pairs)
+        edges = [(node[:, 0], node[:, 1], np.ones(len(pairs), dtype=np.int64))]
+        edges.append(self.intra_edges())
+
+        src = np.concatenate([e[0] for e in edges])
+        dst = np.concatenate([e[1] for e in edges])
+        cost = np.concatenate([e[2] for e in edges])
+        order = np.argsort(src, kind='stable')
+        bounds = np.searchsorted(src[order], np.arange(n + 1))
+        dst, cost = dst[order].tolist(), cost[order].tolist()
+        self.adj = [
+            list(zip(dst[bounds[i]:bounds[i + 1]], cost[bounds[i]:bounds[i + 1]]))
+            for i in range(n)
+        ]
+
+        self.node_of = dict(zip(self.cells.tolist(), range(n)))
+        self.node_xy = [divmod(c, self.cols) for c in self.cells.tolist()]
+        self.node_cluster = self.cluster.ravel()[self.cells].tolist()
+        self.stats.record('hpa.build', clock)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def intra_edges(self):
+        '''
+        Edges between the nodes of every cluster, with a BFS restricted to the
+        clusters from the k-th node of all of them at once
+        '''
+        clusters = self.cluster.ravel()[self.cells]
+        order = np.argsort(clusters, kind='stable')
+        first = np.searchsorted(clusters[order], clusters[order])
+        rank = np.empty(len(self.cells), dtype=np.int64)
+        rank[order] = np.arange(len(self.cells)) - first
+
+        # Node of every rank on every cluster (-1 if the cluster has fewer)
+        source = np.full((self.cluster.max() + 1, rank.max(initial=-1) + 1), -1, dtype=np.int64)
+        source[clusters, rank] = np.arange(len(self.cells))
+
+        src, dst, cost = [], [], []
+        for k in range(source.shape[1]):
+            nodes = source[:, k][source[:, k] >= 0]
+            dist = self.bfs(self.cells[nodes])
+            d = dist.ravel()[self.cells]
+            ok = d > 0
+            src.append(source[clusters[ok], k])
+            dst.append(np.flatnonzero(ok))
+            cost.append(d[ok].astype(np.int64))
+        if not src:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        return np.concatenate(src), np.concatenate(dst), np.concatenate(cost)
+
+    def bfs(self, cells: np.ndarray) -> np.ndarray:
+        '''
+        Steps from the nearest of `cells` to every cell without leaving its
+        cluster (-1 if there is no way)
+        '''
+        dist = np.full(self.shape, -1, dtype=np.int32)
+        frontier = np.zeros(self.shape, dtype=bool)
+        frontier.ravel()[cells] = True
+        dist[frontier] = 0
+
+        d = 0
+        while frontier.any():
+            d += 1
+            reached = np.zeros(self.shape, dtype=bool)
+            for mask, (_, dx, dy) in zip(self.intra, MOVES):
+                src, dst = shifted(dx, dy, self.shape)
+                reached[dst] |= frontier[src] & mask[src]
+            reached &= dist < 0
+            dist[reached] = d
+            frontier = reached
+        return dist
+
+    def local(self, pos: Tuple[int, int], forward: bool) -> dict:
+        '''
+        BFS inside the cluster of `pos`: for every cell reached, its distance
+        and the previous cell (or the next one going backwards, towards `pos`)
+        '''
+        # Move bits of the cluster as nested lists, faster to read one by one
+        size = self.size
+        x0, y0 = pos[0] // size * size, pos[1] // size * size
+        bits = self.intra_bits[x0:x0 + size, y0:y0 + size].tolist()
+        rows, cols = len(bits), len(bits[0])
+
+        seen = {pos: (0, None)}
+        queue = [pos]
+        for cell in queue:
+            d = seen[cell][0] + 1
+            x, y = cell
+            for i, (_, dx, dy) in enumerate(MOVES):
+                if forward:
+                    if not bits[x - x0][y - y0] >> i & 1:
+                        continue
+                    other = (x + dx, y + dy)
+                else:
+                    other = (x - dx, y - dy)
+                    ox, oy = other[0] - x0, other[1] - y0
+                    if not (0 <= ox < rows and 0 <= oy < cols) or not bits[ox][oy] >> i & 1:
+                        continue
+                if other not in seen:
+                    seen[other] = (d, cell)
+                    queue.append(other)
+        return seen
+
+    def segment(self, a: int, b: int) -> List[Tuple[int, int]]:
+        '''
+        Cells after node `a` up to node `b`, both in the same cluster
+        '''
+        key = (a, b)
+        with self.lock:
+            path = self.segments.get(key)
+            if path is not None:
+                self.segments.move_to_end(key)
+                return path
+
+        end = self.node_xy[b]
+        seen = self.local(self.node_xy[a], True)
+        path = []
+        while end != self.node_xy[a]:
+            path.append(end)
+            end = seen[end][1]
+        path.reverse()
+
+        with self.lock:
+            self.segments[key] = path
+            if len(self.segments) > self.segment_cache:
+                self.segments.popitem(last=False)
+        return path
+
+    def find_path(self, start: Tuple[int, int], goal: Tuple[int, int],
+                  stats: Optional[Stats] = None) -> List[Tuple[int, int]]:
+        '''
+        Path from start to goal (both included) or [] if there is none. The
+        counters go to `stats` if given instead of the ones of the graph
+        '''
+        stats = stats if stats is not None else self.stats
+        start = (int(start[0]), int(start[1]))
+        goal = (int(goal[0]), int(goal[1]))
+        if start == goal:
+            return []
+        stats.count('hpa.calls')
+
+        fwd = self.local(start, True)
+        bwd = self.local(goal, False)
+        n = len(self.cells)
+        S, G = n, n + 1
+        gx, gy = goal
+
+        # Links of the start and the goal to the nodes of their clusters
+        links = [(self.node_of[x * self.cols + y], d) for (x, y), (d, _) in fwd.items() if x * self.cols + y in self.node_of]
+        if goal in fwd:
+            links.append((G, fwd[goal][0]))
+        to_goal = {self.node_of[x * self.cols + y]: d for (x, y), (d, _) in bwd.items() if x * self.cols + y in self.node_of}
+
+        # Ties are broken by the longest cost so far, to go deep first
+        frontier = [(0, 0, S)]
+        came_from = {S: None}
+        cost_so_far = {S: 0}
+        expanded = 0
+        while frontier:
+            _, cost, current = heapq.heappop(frontier)
+            cost = -cost
+            if cost > cost_so_far[current]:
+                continue
+            if current == G:
+                break
+            expanded += 1
+
+            nexts = links if current == S else self.adj[current]
+            if current in to_goal:
+                nexts = nexts + [(G, to_goal[current])]
+            for nxt, w in nexts:
+                new_cost = cost + w
+                if new_cost < cost_so_far.get(nxt, new_cost + 1):
+                    cost_so_far[nxt] = new_cost
+                    x, y = goal if nxt == G else self.node_xy[nxt]
+                    heapq.heappush(frontier, (new_cost + abs(x - gx) + abs(y - gy), -new_cost, nxt))
+                    came_from[nxt] = current
+
+        stats.count('hpa.expanded', expanded)
+        if G not in came_from:
+            return []
+
+        nodes = []
+        current = came_from[G]
+        while current != S:
+            nodes.append(current)
+            current = came_from[current]
+        nodes.reverse()
+
+        # Refine: start to the first node, node to node and the last one to
+        # the goal
+        path = []
+        end = goal if not nodes else self.node_xy[nodes[0]]
+        while end is not None:
+            path.append(end)
+            end = fwd[end][1]
+        path.reverse()
+
+        for a, b in zip(nodes, nodes[1:]):
+            if self.node_cluster[a] != self.node_cluster[b]:
+                path.append(self.node_xy[b])
+            else:
+                path.extend(self.segment(a, b))
+
+        if nodes:
+            cell = bwd[self.node_xy[nodes[-1]]][1]
+            while cell is not None:
+                path.append(cell)
+                cell = bwd[cell][1]
+        return path
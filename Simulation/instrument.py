@@ -0,0 +1,93 @@
+import threading
+import time
+import numpy as np
+
+class Histogram:
+    '''
+    Rolling window with the last `size` samples of a value plus the totals
+    since the last reset
+    '''
+    def __init__(self, size=1024):
+        self.samples = np.zeros(size)
+        self.next = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value: float):
+        self.samples[self.next] = value
+        self.next = (self.next + 1) % len(self.samples)
+        self.count += 1
+        self.total += value
+
+    def summary(self) -> dict:
+        window = self.samples[:min(self.count, len(self.samples))]
+        if len(window) == 0:
+            return { 'count': 0 }
+        p50, p90, p99 = np.percentile(window, [50, 90, 99])
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count,
+            'p50': float(p50),
+            'p90': float(p90),
+            'p99': float(p99),
+            'max': float(window.max()),
+        }
+
+class Stats:
+    '''
+    Timers and counters for the simulation phases. Every method returns right
+    away while `enabled` is False, so it can stay wired into the hot paths.
+    Steps, encoders and the clock write to it from different threads, so
+    everything else holds `lock`
+    '''
+    def __init__(self, enabled=False, window=1024):
+        self.enabled = enabled
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers: dict[str, Histogram] = {}
+            self.counters: dict[str, int] = {}
+            self.started = time.monotonic()
+
+    def clock(self) -> float:
+        '''
+        Start of a timed section (0 when disabled so the caller can skip the
+        measurement)
+        '''
+        return time.perf_counter() if self.enabled else 0.0
+
+    def record(self, name: str, start: float):
+        '''
+        Record the milliseconds since `start` under `name`
+        '''
+        if not self.enabled:
+            return
+        self.sample(name, (time.perf_counter() - start) * 1e3)
+
+    def sample(self, name: str, value: float):
+        if not self.enabled:
+            return
+        with self.lock:
+            hist = self.timers.get(name)
+            if hist is None:
+                hist = self.timers[name] = Histogram(self.window)
+            hist.add(value)
+
+    def count(self, name: str, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'seconds': time.monotonic() - self.started,
+                'timers': { name: hist.summary() for name, hist in self.timers.items() },
+                'counters': dict(self.counters),
+            }
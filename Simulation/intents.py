@@ -0,0 +1,51 @@
+'''
+Two-phase movement.
+
+Instead of moving one after another, every agent first proposes the cell it
+wants to move to (its intent) looking at the state at the start of the step.
+`resolveMoves` then decides in bulk which intents go through:
+
+* agents can not swap cells, since they would walk through each other
+* when several agents want the same cell the one with the lowest priority
+  value gets it
+* nobody can enter a cell where an agent stays, and losing a conflict means
+  staying, so this is repeated until no more intents are dropped
+
+Winners are all moved at once afterwards, so the result does not depend on
+the order of the agents.
+'''
+import numpy as np
+
+def resolveMoves(cur, want, shape, priority, allowed=None) -> np.ndarray:
+    '''
+    Mask of the agents whose move from `cur` to `want` ((n, 2) arrays of
+    cells, equal for agents that stay) goes through. `priority` has one value
+    per agent to break ties and `allowed` optionally drops some intents up
+    front (like pedestrians walking into a crossing with a green light)
+    '''
+    cols = shape[1]
+    size = shape[0] * cols
+    c = cur[:, 0] * cols + cur[:, 1]
+    w = want[:, 0] * cols + want[:, 1]
+
+    moving = w != c
+    if allowed is not None:
+        moving &= allowed
+
+    # Swaps: someone wants to move from our target cell into ours
+    pairs = c * size + w
+    moving &= ~np.isin(w * size + c, pairs[moving])
+
+    # Claims: only the first intent of every cell, by priority
+    idx = np.flatnonzero(moving)
+    order = idx[np.lexsort((priority[idx], w[idx]))]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = w[order[1:]] != w[order[:-1]]
+    moving[order[~first]] = False
+
+    # Cells of the agents that stay block the moves into them
+    while True:
+        blocked = moving & np.isin(w, c[~moving])
+        if not blocked.any():
+            return moving
+        moving &= ~blocked
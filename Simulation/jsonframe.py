@@ -0,0 +1,121 @@
+'''
+JSON encoding of the simulation frames.
+
+`Encodable.toJSON` walks the frame with isinstance checks on every value and
+leaves json.dumps to stringify whatever it does not know, like NumPy integers.
+Here every frame dataclass gets a writer compiled once from its fields: each
+field has its own encoder, picked by name, and the writer only fills a
+template with their output. The text is the same json.dumps would give for
+`frame.toObject()` (same key order and separators) with NumPy values written
+as plain numbers.
+
+Agents are written from AGENT_DTYPE records (see binframe.agentRecords) with
+one format string per agent instead of a dict, and the grid text is kept
+around since it never changes during a run.
+'''
+import dataclasses
+import json
+
+import numpy as np
+
+from binframe import agentRecords
+from constants import AGENT_TYPES
+
+def plain(value):
+    '''
+    `default` for json.dumps: NumPy values as the Python ones
+    '''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return list(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+def writeValue(value) -> str:
+    return json.dumps(value, default=plain)
+
+def writeInts(values) -> str:
+    return '[' + ', '.join(str(int(v)) for v in values) + ']'
+
+_gridCache = (None, None)
+
+def writeGrid(grid) -> str:
+    '''
+    The grid rows. The road grid never changes during a run so the text of
+    the last one is kept around
+    '''
+    global _gridCache
+    if not isinstance(grid, np.ndarray):
+        return writeValue(grid)
+    if grid.base is not None:
+        # Part of a grid (a viewport), which changes with every view
+        return json.dumps(grid.tolist())
+    cached, text = _gridCache
+    if cached is not grid:
+        text = json.dumps(grid.tolist())
+        _gridCache = (grid, text)
+    return text
+
+# Template of one agent by type code and whether it has a goal
+AGENT_TEMPLATES = [
+    [
+        '{"id": %d, "pos": [%d, %d], "type": "' + name + '", "goal": null}',
+        '{"id": %d, "pos": [%d, %d], "type": "' + name + '", "goal": [%d, %d]}',
+    ]
+    for name in AGENT_TYPES
+]
+
+def writeAgents(agents) -> str:
+    '''
+    Agents (or agent records) as a list of {id, pos, type, goal} objects. The
+    template of the whole list is filled in a single % with the numbers of
+    every agent
+    '''
+    records = agentRecords(agents)
+    if not len(records):
+        return '[]'
+    hasGoal = records['gx'] >= 0
+    templates = [t for pair in AGENT_TEMPLATES for t in pair]
+    kinds = (records['type'].astype(np.int64) * 2 + hasGoal).tolist()
+    template = '[' + ', '.join([templates[k] for k in kinds]) + ']'
+
+    values = np.stack([records[name].astype(np.int64) for name in ('id', 'x', 'y', 'gx', 'gy')], axis=1)
+    # Agents without a goal have no numbers for it in their template
+    keep = np.ones(values.shape, dtype=bool)
+    keep[~hasGoal, 3:] = False
+    return template % tuple(values[keep].tolist())
+
+# Encoder of every field by name, anything else goes through json.dumps
+FIELDS = {
+    'dims': writeInts,
+    'view': writeInts,
+    'grid': writeGrid,
+    'agents': writeAgents,
+    'spawned': writeAgents,
+    'entered': writeAgents,
+}
+
+def compileWriter(cls):
+    '''
+    Writer of the frames of dataclass `cls`
+    '''
+    names = [field.name for field in dataclasses.fields(cls)]
+    encoders = [FIELDS.get(name, writeValue) for name in names]
+    template = '{' + ', '.join(json.dumps(name) + ': %s' for name in names) + '}'
+
+    def write(frame) -> str:
+        return template % tuple(encode(getattr(frame, name)) for name, encode in zip(names, encoders))
+    return write
+
+_writers = {}
+
+def encode(frame) -> str:
+    '''
+    JSON text of a frame, compiling the writer of its type the first time
+    '''
+    write = _writers.get(type(frame))
+    if write is None:
+        write = _writers[type(frame)] = compileWriter(type(frame))
+    return write(frame)
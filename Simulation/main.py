@@ -1,58 +1,114 @@
-from socket import socket, AF_INET, SOCK_STREAM
-from messages import Commands as cmds
-from messages import SimState
-import struct
-from model import CityModel, params
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# The simulation modules (and agentpy) are imported once the server is already
+# listening, see serve
 
 HOST = '127.0.0.1'
 PORT = 42069
 
-model = CityModel(params)
-def ModelStateMessage():
-    # Serialize the state to JSON
-    jsonStr = SimState.fromModel(model).toJSON()
-    # Encode the string into a byte array
-    jsonBytes = jsonStr.encode('utf-8')
+async def handleClient(ready: asyncio.Future, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # Clients that connect while the server starts wait for it here
+    registry = await ready
+    from session import Connection, CommandReader
+    registry.connections += 1
+    peer = writer.get_extra_info('peername')
+    print(f'Client connected {peer}')
 
-    # Prefix the package with its length in big-endian format (network)
-    lengthPrefix = struct.pack('>I', len(jsonBytes))
-    return lengthPrefix + jsonBytes;
+    # Every connection gets its own simulation until it attaches to a shared one
+    conn = Connection(registry, writer, name=f'{peer[0]}:{peer[1]}')
+    commands = CommandReader()
+    try:
+        while True:
+            # Read messages until the connection is closed
+            data = await reader.read(4096)
+            if not data:
+                break
 
-def OnMessage(msg: str, sender: socket):
-    if msg == cmds.START.value:
-        model.setup()
-        sender.sendall(ModelStateMessage())
+            # Handle every complete command
+            for msg in commands.feed(data):
+                try:
+                    await conn.onMessage(msg)
+                except ValueError:
+                    print(f'Malformed command from {peer}: {msg!r}')
+    except ConnectionError:
+        pass
+    finally:
+        await conn.close()
+        registry.connections -= 1
+        writer.close()
+        print(f'Client disconnected {peer}')
 
-    if msg == cmds.STEP.value:
-        model.step()
-        sender.sendall(ModelStateMessage())
-        
+async def reportLoad(ready: asyncio.Future, every: float):
+    registry = await ready
+    while True:
+        await asyncio.sleep(every)
+        print(json.dumps(registry.load()))
 
-def main():
-    # Create a socket
-    server = socket(AF_INET, SOCK_STREAM)
-    server.bind((HOST, PORT))
-    server.listen()
+def createRegistry(executor, stats=False, map=None, record=None, keyEvery=100, pool=0):
+    '''
+    Import the simulation and build the registry of the server, the slow part
+    of starting it
+    '''
+    from mapgen import loadMap
+    from model import params, MapData
+    from session import Registry
 
-    # Wait for a connection
-    print('Waiting for connection')
-    client, _ = server.accept()
-    print('Client connected')
+    parameters = dict(params, stats=stats)
+    if map:
+        # Memory mapped, so the files are only read once into the padded copy
+        # MapData.of keeps for every simulation below
+        parameters.update(loadMap(map))
+    # Padded map and its index, built once for every simulation
+    MapData.of(parameters['road'], parameters['dir'])
+    return Registry(executor, parameters, record, keyEvery, pool)
 
-    while True:
-        # Read messages until the connection is closed
-        data = client.recv(4096)
-
-        if not data:
-            break
-        
-        # Handle message
-        OnMessage(data.decode('utf-8'), client)
-    
-#     # Cleanup
-#     client.close()
-#     server.close()
+async def serve(host, port, workers, report, stats=False, map=None, record=None, keyEvery=100, pool=0):
+    # Steps run on this pool so the event loop keeps serving other clients
+    executor = ThreadPoolExecutor(max_workers=workers)
+    if record:
+        os.makedirs(record, exist_ok=True)
+
+    # Listen first and load the simulation meanwhile
+    loop = asyncio.get_running_loop()
+    ready = loop.run_in_executor(executor, createRegistry, executor, stats, map, record, keyEvery, pool)
+    server = await asyncio.start_server(
+        lambda r, w: handleClient(ready, r, w), host, port
+    )
+    print(f'Waiting for connections on {host}:{port}')
+
+    if report:
+        asyncio.create_task(reportLoad(ready, report))
+
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='City simulation server')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Threads used to step the simulations')
+    parser.add_argument('--report', type=float, default=0,
+                        help='Print the server load every N seconds')
+    parser.add_argument('--stats', action='store_true',
+                        help='Time the phases of every simulation (shown in the load report)')
+    parser.add_argument('--map', help='Directory with a map saved by mapgen.py')
+    parser.add_argument('--record', metavar='DIR',
+                        help='Record every run to DIR, where clients can replay them from')
+    parser.add_argument('--keyframes', type=int, default=100,
+                        help='Steps between the keyframes of the recorded runs')
+    parser.add_argument('--pool', type=int, default=2,
+                        help='Models kept set up in the background for the next start commands')
+    args = parser.parse_args()
 
+    asyncio.run(serve(
+        args.host, args.port, args.workers, args.report, args.stats, args.map,
+        args.record, args.keyframes, args.pool,
+    ))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,156 @@
+'''
+City-scale maps.
+
+`generate` lays out a grid of square blocks with sidewalks around them and
+two way roads between them, with pedestrian crossings and a pair of traffic
+lights on every intersection. `tile` repeats an existing map (like the one in
+modelmap.py) giving every copy its own lights.
+
+Maps are saved as a directory with one .npy file per layer so they can be
+memory mapped when loaded:
+
+    road.npy    ROAD_DTYPE tile types with the light ids from LIGHT_SHIFT
+    dir.npy     DIR_DTYPE direction bits
+    lights.npy  one row of light ids per intersection, padded with zeros
+
+    python mapgen.py --rows 1000 --cols 1000 --out city1k
+'''
+import argparse
+import os
+import numpy as np
+
+from constants import *
+from modelmap import roadType, directions, INTERSECTIONS, ROAD_DTYPE, DIR_DTYPE
+
+# Largest light id that fits above LIGHT_SHIFT in a ROAD_DTYPE tile
+MAX_LIGHT = (1 << (np.iinfo(ROAD_DTYPE).bits - LIGHT_SHIFT)) - 1
+
+def axisLayout(n: int, period: int, lanes: int, sidewalk: int):
+    '''
+    Layout of the cells along one axis: the lane of every road cell (-1
+    elsewhere), which cells are sidewalk, which ones are the sidewalk next to a
+    road (where the crossings go) and the index of the intersection each road
+    or crossing belongs to
+    '''
+    pos = np.arange(n) % period
+    block = np.arange(n) // period
+
+    road = 2 * lanes
+    lane = np.where(pos < road, pos, -1)
+    walk = (pos >= road) & ((pos < road + sidewalk) | (pos >= period - sidewalk))
+    cross = (pos == road) | (pos == period - 1)
+    # Crossings right before a road belong to the next intersection
+    owner = np.where(pos == period - 1, block + 1, block)
+    return lane, walk, cross, owner
+
+def generate(rows: int, cols: int, block=8, lanes=2, sidewalk=2):
+    '''
+    Manhattan-style map of `rows` x `cols` cells. Returns the road and
+    direction layers and the light groups, like the ones in modelmap.py.
+
+    Horizontal roads have `lanes` lanes going west and `lanes` going east,
+    vertical ones `lanes` going south and `lanes` going north. Every
+    intersection gets two lights: one for the crossings on its horizontal road
+    and one for the vertical road, which take turns being green
+    '''
+    period = 2 * lanes + 2 * sidewalk + block
+    rLane, rWalk, rCross, rOwner = axisLayout(rows, period, lanes, sidewalk)
+    cLane, cWalk, cCross, cOwner = axisLayout(cols, period, lanes, sidewalk)
+
+    intersections = (rOwner.max() + 1) * (cOwner.max() + 1)
+    if 2 * intersections > MAX_LIGHT:
+        raise ValueError(f'{intersections} intersections need more than {MAX_LIGHT} light ids, use bigger blocks')
+
+    hRoad = (rLane >= 0)[:, None]
+    vRoad = (cLane >= 0)[None, :]
+    walk = rWalk[:, None] | cWalk[None, :]
+
+    road = np.zeros((rows, cols), dtype=ROAD_DTYPE)
+    road[walk] = SI
+    road[hRoad | vRoad] = RO
+
+    # Lights are numbered from 1 two per intersection, horizontal road first
+    ids = (rOwner[:, None] * (cOwner.max() + 1) + cOwner[None, :]) * 2 + 1
+    hCross = hRoad & cCross[None, :] & ~vRoad
+    vCross = vRoad & rCross[:, None] & ~hRoad
+    road[hCross] = RC | (ids[hCross].astype(ROAD_DTYPE) << LIGHT_SHIFT)
+    road[vCross] = RC | ((ids[vCross] + 1).astype(ROAD_DTYPE) << LIGHT_SHIFT)
+
+    hDir = np.where(rLane < lanes, WD, ED) * (rLane >= 0)
+    vDir = np.where(cLane < lanes, SD, ND) * (cLane >= 0)
+    dir = (hDir[:, None] | vDir[None, :]).astype(DIR_DTYPE)
+
+    lights = [
+        ((2 * i + 1) << LIGHT_SHIFT, (2 * i + 2) << LIGHT_SHIFT)
+        for i in range(intersections)
+    ]
+    return road, dir, lights
+
+def tile(reps: int, road=roadType, dir=directions, lights=INTERSECTIONS):
+    '''
+    Repeat a map `reps` x `reps` times. The lights of every copy get their
+    own ids so each intersection can be switched on its own
+    '''
+    lightIds = (road >> LIGHT_SHIFT).astype(ROAD_DTYPE)
+    top = int(lightIds.max())
+    if top * reps * reps > MAX_LIGHT:
+        raise ValueError(f'{reps}x{reps} copies need more than {MAX_LIGHT} light ids')
+
+    tiles = np.tile(road & ((1 << LIGHT_SHIFT) - 1), (reps, reps)).astype(ROAD_DTYPE)
+    # Copy k gets its light ids moved up by k * top
+    copy = np.arange(reps * reps, dtype=ROAD_DTYPE).reshape(reps, reps)
+    copy = np.kron(copy, np.ones(road.shape, dtype=ROAD_DTYPE))
+    tiledIds = np.tile(lightIds, (reps, reps))
+    tiles |= np.where(tiledIds > 0, tiledIds + copy * top, 0).astype(ROAD_DTYPE) << LIGHT_SHIFT
+
+    groups = [
+        tuple(((light >> LIGHT_SHIFT) + k * top) << LIGHT_SHIFT for light in group)
+        for k in range(reps * reps)
+        for group in lights
+    ]
+    return tiles, np.tile(dir, (reps, reps)).astype(DIR_DTYPE), groups
+
+def saveMap(path: str, road: np.ndarray, dir: np.ndarray, lights: list):
+    os.makedirs(path, exist_ok=True)
+    width = max((len(group) for group in lights), default=0)
+    groups = np.zeros((len(lights), width), dtype=ROAD_DTYPE)
+    for i, group in enumerate(lights):
+        groups[i, :len(group)] = group
+
+    np.save(os.path.join(path, 'road.npy'), np.asarray(road, dtype=ROAD_DTYPE))
+    np.save(os.path.join(path, 'dir.npy'), np.asarray(dir, dtype=DIR_DTYPE))
+    np.save(os.path.join(path, 'lights.npy'), groups)
+
+def loadMap(path: str, mmap=True) -> dict:
+    '''
+    Map saved with saveMap as model parameters (road, dir and lights). The
+    layers are read-only memory maps unless `mmap` is False
+    '''
+    mode = 'r' if mmap else None
+    road = np.load(os.path.join(path, 'road.npy'), mmap_mode=mode)
+    dir = np.load(os.path.join(path, 'dir.npy'), mmap_mode=mode)
+    groups = np.load(os.path.join(path, 'lights.npy'))
+    lights = [tuple(int(light) for light in group if light) for group in groups]
+    return { 'road': road, 'dir': dir, 'lights': lights }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--cols', type=int, default=1000)
+    parser.add_argument('--block', type=int, default=8, help='Side of the blocks between roads')
+    parser.add_argument('--lanes', type=int, default=2, help='Lanes per direction')
+    parser.add_argument('--sidewalk', type=int, default=2, help='Width of the sidewalks')
+    parser.add_argument('--tile', type=int, default=0,
+                        help='Tile the base map N x N times instead of generating one')
+    parser.add_argument('--out', required=True, help='Directory to save the map to')
+    args = parser.parse_args()
+
+    if args.tile:
+        road, dir, lights = tile(args.tile)
+    else:
+        road, dir, lights = generate(args.rows, args.cols, args.block, args.lanes, args.sidewalk)
+    saveMap(args.out, road, dir, lights)
+    print(f'{road.shape[0]}x{road.shape[1]} map with {len(lights)} intersections -> {args.out}')
+
+if __name__ == '__main__':
+    main()
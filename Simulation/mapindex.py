@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from constants import *
+from modelmap import ROAD_DTYPE, DIR_DTYPE
+from hierarchy import ClusterGraph
+from movegraph import MoveGraph
+from instrument import Stats
+
+class MapIndex:
+    '''
+    Coordinates of the sidewalk, road and crossing tiles of a map, built once
+    per map. Cells on the border are left out since agents standing there get
+    despawned.
+    '''
+    def __init__(self, road: np.ndarray):
+        self.shape = road.shape
+
+        interior = np.zeros(road.shape, dtype=bool)
+        interior[1:-1, 1:-1] = True
+
+        self.sidewalks = np.argwhere(((road & SI) == SI) & interior)
+        self.roads = np.argwhere(((road & RO) == RO) & interior)
+        self.crossings = np.argwhere(((road & RC) == RC) & interior)
+
+    def tiles(self, is_pedestrian: bool) -> np.ndarray:
+        '''
+        Tiles an agent can have as a goal
+        '''
+        return self.sidewalks if is_pedestrian else self.roads
+
+    def sample(self, tiles: np.ndarray, rng: np.random.Generator, start=None, minDist=0, tries=32):
+        '''
+        Random tile further than `minDist` (Manhattan) from `start`. Uses
+        rejection sampling and only filters the whole array if every try
+        lands too close. Returns None if there is no such tile
+        '''
+        n = len(tiles)
+        if n == 0:
+            return None
+        if start is None:
+            return tuple(tiles[rng.integers(n)].tolist())
+
+        sx, sy = int(start[0]), int(start[1])
+        for i in rng.integers(n, size=tries):
+            x, y = tiles[i].tolist()
+            if abs(x - sx) + abs(y - sy) > minDist:
+                return (x, y)
+
+        far = np.flatnonzero(np.abs(tiles - (sx, sy)).sum(axis=1) > minDist)
+        if len(far) == 0:
+            return None
+        return tuple(tiles[far[rng.integers(len(far))]].tolist())
+
+class MapData:
+    '''
+    Everything about a map that does not change while it is simulated: the
+    layers padded with the despawn border, the MapIndex, the movement graphs
+    and the cluster graphs of the hierarchical pathfinder. Built once per map and shared by every
+    model simulating it, see MapData.of
+    '''
+    # Last maps used, by the ids of their road and direction layers
+    cache: OrderedDict = OrderedDict()
+    cacheSize = 4
+    lock = threading.Lock()
+
+    def __init__(self, road: np.ndarray, dir: np.ndarray):
+        # Kept so the ids used as the cache key stay valid
+        self.source = (road, dir)
+        self.road = np.pad(np.asarray(road, dtype=ROAD_DTYPE), 1, 'edge')
+        self.dir = np.pad(np.asarray(dir, dtype=DIR_DTYPE), 1)
+        self.road.flags.writeable = False
+        self.dir.flags.writeable = False
+        self.index = MapIndex(self.road)
+        self.graphs = {}
+        self.graphLock = threading.Lock()
+        self._moves = None
+
+    @classmethod
+    def of(cls, road: np.ndarray, dir: np.ndarray) -> 'MapData':
+        key = (id(road), id(dir))
+        with cls.lock:
+            data = cls.cache.get(key)
+            if data is None:
+                data = cls.cache[key] = cls(road, dir)
+                if len(cls.cache) > cls.cacheSize:
+                    cls.cache.popitem(last=False)
+            cls.cache.move_to_end(key)
+        return data
+
+    def moveGraphs(self) -> dict:
+        '''
+        Movement graphs of cars (False) and pedestrians (True), compiled the
+        first time they are asked for
+        '''
+        with self.graphLock:
+            if self._moves is None:
+                self._moves = {
+                    is_pedestrian: MoveGraph.compile(self.road, self.dir, is_pedestrian)
+                    for is_pedestrian in (False, True)
+                }
+            return self._moves
+
+    def clusterGraphs(self, size: int, stats: Stats = None) -> dict:
+        '''
+        Cluster graphs of cars (False) and pedestrians (True) for clusters of
+        `size` cells, built the first time they are asked for
+        '''
+        moves = self.moveGraphs()
+        with self.graphLock:
+            if size not in self.graphs:
+                self.graphs[size] = {
+                    is_pedestrian: ClusterGraph(moves[is_pedestrian], is_pedestrian, size, stats)
+                    for is_pedestrian in (False, True)
+                }
+            return self.graphs[size]
@@ -2,6 +2,8 @@ from enum import Enum
 from dataclasses import dataclass
 import numpy as np
 
+import jsonframe
+from constants import LIGHT_SHIFT
 from model import CityModel
 from utils import Encodable
 
@@ -9,9 +11,32 @@ class Commands(Enum):
     START = 'start'
     STEP = 'step'
     STOP = 'stop'
+    DELTA = 'delta'
+    KEYFRAME = 'keyframe'
+    BINARY = 'binary'
+    JSON = 'json'
+    SHARE = 'share'
+    ATTACH = 'attach'
+    LOAD = 'load'
+    RUN = 'run'
+    RATE = 'rate'
+    STATS = 'stats'
+    REPLAY = 'replay'
+    SEEK = 'seek'
+    CLOCK = 'clock'
+    VIEW = 'view'
+    METRICS = 'metrics'
+
+class Frame(Encodable):
+    '''
+    Message written by the writer compiled for its type (see jsonframe.py)
+    instead of walking it
+    '''
+    def toJSON(self):
+        return jsonframe.encode(self)
 
 @dataclass
-class SimState(Encodable):
+class SimState(Frame):
     dims: tuple
     agents: list
     grid: list
@@ -22,6 +47,272 @@ class SimState(Encodable):
         return SimState(
             dims=model.env.shape,
             agents=model.agents,
-            grid=model.env.road.tolist(),
+            grid=model.env.road,
+            deleted=model.deleted,
+        )
+
+def lightStates(lights) -> dict:
+    return { ID: state for ID, state in lights.crossings.items() }
+
+def lightList(states: dict) -> list:
+    return [{ 'id': ID, 'state': state } for ID, state in states.items()]
+
+@dataclass
+class KeyFrame(Frame):
+    '''
+    Full state of the simulation, sent first in delta mode and whenever the
+    client asks for it
+    '''
+    frame: str
+    seq: int
+    dims: tuple
+    grid: list
+    agents: list
+    lights: list
+
+@dataclass
+class DeltaFrame(Frame):
+    '''
+    Changes since the previous frame: agents that appeared, `[id, x, y]` for
+    the agents that moved, `[id, x, y]` (or `[id, null]`) for the agents that
+    got a new goal, deleted agent ids and the lights that switched
+    '''
+    frame: str
+    seq: int
+    spawned: list
+    moved: list
+    goals: list
+    deleted: list
+    lights: list
+
+    def toObject(self):
+        # Everything but the spawned agents is already plain data
+        obj = dict(self.__dict__)
+        obj['spawned'] = [self.serialize(agent) for agent in self.spawned]
+        return obj
+
+class DeltaEncoder:
+    '''
+    Keeps what a client already knows and builds the frames it needs
+    '''
+    def __init__(self):
+        self.seq = 0
+        self.needKey = True
+        self.known = {}  # id -> (pos, goal)
+        self.lights = {}
+
+    def reset(self):
+        '''
+        Send a keyframe next
+        '''
+        self.needKey = True
+
+    def encode(self, model: CityModel):
+        self.seq += 1
+        if self.needKey:
+            return self.keyframe(model)
+
+        spawned, moved, goals = [], [], []
+        known = {}
+        for agent in model.agents:
+            pos, goal = agent.getPos(), agent.goal
+            last = self.known.pop(agent.id, None)
+            known[agent.id] = (pos, goal)
+
+            if last is None:
+                spawned.append(agent)
+                continue
+            if last[0] != pos:
+                moved.append([agent.id, int(pos[0]), int(pos[1])])
+            if last[1] != goal:
+                goals.append([agent.id] + ([None] if goal is None else [int(goal[0]), int(goal[1])]))
+
+        # Whatever is left was not found in the model anymore
+        deleted = list(self.known)
+        self.known = known
+
+        states = lightStates(model.env.lights)
+        changed = { ID: s for ID, s in states.items() if self.lights.get(ID) != s }
+        self.lights = states
+
+        return DeltaFrame(
+            frame='delta',
+            seq=self.seq,
+            spawned=spawned,
+            moved=moved,
+            goals=goals,
+            deleted=deleted,
+            lights=lightList(changed),
+        )
+
+    def keyframe(self, model: CityModel):
+        self.needKey = False
+        self.known = { a.id: (a.getPos(), a.goal) for a in model.agents }
+        self.lights = lightStates(model.env.lights)
+
+        return KeyFrame(
+            frame='key',
+            seq=self.seq,
+            dims=model.env.shape,
+            grid=model.env.road,
+            agents=model.agents,
+            lights=lightList(self.lights),
+        )
+
+class Viewport:
+    '''
+    Part of the map a client wants frames of: rows x0 to x1 and columns y0 to
+    y1 (not included), grown by `margin` cells on every side and clipped to
+    the map
+    '''
+    def __init__(self, x0: int, y0: int, x1: int, y1: int, margin: int, shape):
+        rows, cols = shape
+        self.x0, self.y0 = max(0, x0 - margin), max(0, y0 - margin)
+        self.x1, self.y1 = min(rows, x1 + margin), min(cols, y1 + margin)
+        self.x1, self.y1 = max(self.x0, self.x1), max(self.y0, self.y1)
+        self._lights = None
+
+    @property
+    def rect(self) -> list:
+        return [self.x0, self.y0, self.x1, self.y1]
+
+    def grid(self, road: np.ndarray) -> np.ndarray:
+        return road[self.x0:self.x1, self.y0:self.y1]
+
+    def agents(self, env) -> list:
+        return env.within(self.x0, self.y0, self.x1, self.y1)
+
+    def contains(self, records: np.ndarray) -> np.ndarray:
+        '''
+        Mask of the agent records inside the view
+        '''
+        x, y = records['x'], records['y']
+        return (x >= self.x0) & (x < self.x1) & (y >= self.y0) & (y < self.y1)
+
+    def lights(self, lights) -> set:
+        '''
+        Ids of the lights with a tile inside the view
+        '''
+        if self._lights is None:
+            numbers = np.unique(self.grid(lights.tileLights))
+            self._lights = { int(n) << LIGHT_SHIFT for n in numbers[numbers > 0] }
+        return self._lights
+
+    def lightStates(self, lights) -> dict:
+        states = lights.crossings
+        return { ID: states[ID] for ID in self.lights(lights) if ID in states }
+
+@dataclass
+class ViewState(Frame):
+    '''
+    SimState of a viewport: the agents and grid tiles inside `view`
+    '''
+    dims: tuple
+    view: list
+    agents: list
+    grid: list
+    deleted: list
+
+    @staticmethod
+    def fromModel(model: CityModel, view: Viewport):
+        return ViewState(
+            dims=model.env.shape,
+            view=view.rect,
+            agents=view.agents(model.env),
+            grid=view.grid(model.env.road),
             deleted=model.deleted,
         )
+
+@dataclass
+class ViewKeyFrame(Frame):
+    '''
+    KeyFrame of a viewport
+    '''
+    frame: str
+    seq: int
+    dims: tuple
+    view: list
+    grid: list
+    agents: list
+    lights: list
+
+@dataclass
+class ViewDeltaFrame(Frame):
+    '''
+    DeltaFrame of a viewport: agents that entered it (spawned there or walked
+    in), ids of the ones that left it and of the ones deleted inside it
+    '''
+    frame: str
+    seq: int
+    entered: list
+    moved: list
+    goals: list
+    left: list
+    deleted: list
+    lights: list
+
+class ViewEncoder(DeltaEncoder):
+    '''
+    DeltaEncoder that only looks at the agents inside a viewport, found with
+    the occupancy grid instead of going through every agent
+    '''
+    def __init__(self, view: Viewport):
+        super().__init__()
+        self.view = view
+
+    def encode(self, model: CityModel):
+        self.seq += 1
+        if self.needKey:
+            return self.keyframe(model)
+
+        entered, moved, goals = [], [], []
+        known = {}
+        for agent in self.view.agents(model.env):
+            pos, goal = agent.getPos(), agent.goal
+            last = self.known.pop(agent.id, None)
+            known[agent.id] = (pos, goal, agent)
+
+            if last is None:
+                entered.append(agent)
+                continue
+            if last[0] != pos:
+                moved.append([agent.id, int(pos[0]), int(pos[1])])
+            if last[1] != goal:
+                goals.append([agent.id] + ([None] if goal is None else [int(goal[0]), int(goal[1])]))
+
+        # Agents no longer inside either walked out or are gone
+        positions = model.env.positions
+        left = [ID for ID, (_, _, agent) in self.known.items() if agent in positions]
+        deleted = [ID for ID, (_, _, agent) in self.known.items() if agent not in positions]
+        self.known = known
+
+        states = self.view.lightStates(model.env.lights)
+        changed = { ID: s for ID, s in states.items() if self.lights.get(ID) != s }
+        self.lights = states
+
+        return ViewDeltaFrame(
+            frame='delta',
+            seq=self.seq,
+            entered=entered,
+            moved=moved,
+            goals=goals,
+            left=left,
+            deleted=deleted,
+            lights=lightList(changed),
+        )
+
+    def keyframe(self, model: CityModel):
+        self.needKey = False
+        agents = self.view.agents(model.env)
+        self.known = { a.id: (a.getPos(), a.goal, a) for a in agents }
+        self.lights = self.view.lightStates(model.env.lights)
+
+        return ViewKeyFrame(
+            frame='key',
+            seq=self.seq,
+            dims=model.env.shape,
+            view=self.view.rect,
+            grid=self.view.grid(model.env.road),
+            agents=agents,
+            lights=lightList(self.lights),
+        )
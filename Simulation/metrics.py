@@ -0,0 +1,215 @@
+'''
+Traffic metrics kept up to date while the model runs.
+
+Instead of working the metrics out of whole frames afterwards, the model
+reports the events they come from as they happen and TrafficMetrics folds
+them into a few counters. At the end of every step those become one row of
+fixed-size ring buffers, so the memory is bounded and the cost of a step does
+not grow with the length of the run:
+
+* `queue`: cars waiting at the red lights of every intersection (a group of
+  lights of the LightSystem), that is, cars on the tiles with a move into a
+  light tile while that light is red
+* `through`: cars that drove into the light tiles of every intersection
+* `pedWaiting`: pedestrians that wanted to move but could not (their next
+  cell was taken or the light did not let them cross)
+* `spawned` and `despawned`: agents of every type code
+
+Every time an intersection switches lights the phase that ended is kept with
+the number of cars that went through it, and every time a pedestrian moves
+again after waiting the number of steps it waited is kept.
+'''
+import numpy as np
+
+from constants import *
+from instrument import Histogram
+
+class Ring:
+    '''
+    The last `size` rows of a time series whose rows have `shape`
+    '''
+    def __init__(self, size: int, shape=(), dtype=np.int64):
+        self.data = np.zeros((size, *shape), dtype=dtype)
+        self.count = 0
+
+    def push(self, row):
+        self.data[self.count % len(self.data)] = row
+        self.count += 1
+
+    def last(self, n: int = None) -> np.ndarray:
+        '''
+        Copy of the last `n` rows kept (all of them by default), oldest first
+        '''
+        kept = min(self.count, len(self.data))
+        n = kept if n is None else max(0, min(n, kept))
+        return self.data[np.arange(self.count - n, self.count) % len(self.data)]
+
+class TrafficMetrics:
+    '''
+    Running traffic metrics of `model` over its last `window` steps. Like
+    Stats, every method returns right away while `enabled` is False
+    '''
+    def __init__(self, model, window=1024, enabled=True):
+        self.model = model
+        self.enabled = enabled
+        self.window = window
+        lights = model.env.lights
+        groups = len(lights.groupSize)
+
+        # Light number of every tile and intersection of every light number
+        self.tileLights = lights.tileLights
+        used = np.arange(lights.groupLights.shape[1]) < lights.groupSize[:, None]
+        self.lightGroup = np.full(len(lights.state), -1, dtype=np.int64)
+        self.lightGroup[lights.groupLights[used]] = np.nonzero(used)[0]
+
+        # Tiles in front of every light: the ones with a regular car move into
+        # one of its tiles, not counting the light tiles themselves
+        graph = model.moves[False]
+        regular = np.arange(len(graph.dst)) < np.repeat(graph.mid, np.diff(graph.ptr))
+        src = np.repeat(np.arange(len(graph.mid)), np.diff(graph.ptr))
+        light = graph.light.astype(np.int64)
+        front = regular & (light > 0) & (self.tileLights.ravel()[src] != light)
+        front &= self.lightGroup[light] >= 0
+        pairs = np.unique(np.stack([src[front], light[front]], axis=1), axis=0)
+        self.approach, self.approachLight = pairs[:, 0], pairs[:, 1]
+
+        # Steps ended so far (the model is not always stepped through
+        # sim_step, so model.t can stay behind) and counters of the current one
+        self.t = 0
+        self.arrivals = np.zeros(len(lights.state), dtype=np.int64)
+        self.waiting = 0
+        self.phaseCars = np.zeros(groups, dtype=np.int64)
+        self.phaseStart = np.zeros(groups, dtype=np.int64)
+        self.green = lights.greenIdx.copy()
+        self.lastSpawned = np.zeros(len(AGENT_TYPES), dtype=np.int64)
+        self.lastDespawned = np.zeros(len(AGENT_TYPES), dtype=np.int64)
+
+        self.steps = Ring(window)
+        self.series = {
+            'queue': Ring(window, (groups,), np.int32),
+            'through': Ring(window, (groups,), np.int32),
+            'pedWaiting': Ring(window, (), np.int32),
+            'spawned': Ring(window, (len(AGENT_TYPES),), np.int32),
+            'despawned': Ring(window, (len(AGENT_TYPES),), np.int32),
+        }
+        # Phases that ended: step, intersection, green light number, length
+        # in steps and cars through
+        self.phases = Ring(window, (5,))
+        self.waits = Histogram(window)
+
+    def carMoved(self, old, new):
+        '''
+        A car moved from cell `old` to `new`
+        '''
+        if not self.enabled:
+            return
+        light = self.tileLights[new]
+        if light and light != self.tileLights[old]:
+            self.arrivals[light] += 1
+
+    def carsMoved(self, old: np.ndarray, new: np.ndarray):
+        '''
+        Cars moved from the cells in `old` to the ones in `new` ((n, 2) arrays)
+        '''
+        if not self.enabled or not len(new):
+            return
+        light = self.tileLights[new[:, 0], new[:, 1]]
+        entered = (light != 0) & (light != self.tileLights[old[:, 0], old[:, 1]])
+        if entered.any():
+            np.add.at(self.arrivals, light[entered], 1)
+
+    def pedWaited(self, steps: int):
+        '''
+        A pedestrian moved again after waiting `steps` steps
+        '''
+        if self.enabled:
+            self.waits.add(steps)
+
+    def pedBlocked(self):
+        '''
+        A pedestrian could not move this step
+        '''
+        if self.enabled:
+            self.waiting += 1
+
+    def endStep(self):
+        '''
+        Turn the counters of the step that just ended into a row of every
+        series
+        '''
+        if not self.enabled:
+            return
+        model = self.model
+        lights = model.env.lights
+        groups = len(self.phaseCars)
+        self.t += 1
+        t = self.t
+
+        red = lights.state[self.approachLight] == RED
+        cars = model.env.occupancy[CAR].ravel()[self.approach[red]]
+        queue = np.bincount(self.lightGroup[self.approachLight[red]], weights=cars, minlength=groups)
+
+        through = np.zeros(groups, dtype=np.int64)
+        used = self.lightGroup >= 0
+        np.add.at(through, self.lightGroup[used], self.arrivals[used])
+        self.arrivals[:] = 0
+
+        # The lights switch at the start of a step, so the cars of this step
+        # already belong to the new phase
+        switched = np.flatnonzero(lights.greenIdx != self.green)
+        for g in switched.tolist():
+            if self.green[g] >= 0:
+                light = lights.groupLights[g, self.green[g]]
+                self.phases.push((t, g, light, t - self.phaseStart[g], self.phaseCars[g]))
+            self.phaseCars[g] = 0
+            self.phaseStart[g] = t
+        self.green[switched] = lights.greenIdx[switched]
+        self.phaseCars += through
+
+        self.steps.push(t)
+        series = self.series
+        series['queue'].push(queue)
+        series['through'].push(through)
+        series['pedWaiting'].push(self.waiting)
+        series['spawned'].push(model.spawned - self.lastSpawned)
+        series['despawned'].push(model.despawned - self.lastDespawned)
+        self.waiting = 0
+        self.lastSpawned = model.spawned.copy()
+        self.lastDespawned = model.despawned.copy()
+
+    def history(self, n: int = None) -> dict:
+        '''
+        The last `n` steps of every series (all the ones kept by default) as
+        arrays, oldest first, plus the step numbers under 'step'
+        '''
+        return { 'step': self.steps.last(n), **{ name: ring.last(n) for name, ring in self.series.items() } }
+
+    def phaseHistory(self, n: int = None) -> dict:
+        '''
+        The last `n` phases that ended, as columns
+        '''
+        rows = self.phases.last(n)
+        return { name: rows[:, i] for i, name in enumerate(('step', 'group', 'light', 'steps', 'cars')) }
+
+    def report(self, n: int = 0) -> dict:
+        '''
+        Totals over the steps kept, by intersection or type code, and the last
+        `n` steps of every series, as plain Python values
+        '''
+        history = self.history()
+        kept = len(history['step'])
+        groups = len(self.phaseCars)
+        phases = self.phaseHistory()
+        ended = [phases['cars'][phases['group'] == g] for g in range(groups)]
+        return {
+            'enabled': self.enabled,
+            'steps': kept,
+            'meanQueue': history['queue'].mean(axis=0).tolist() if kept else [0.0] * groups,
+            'maxQueue': history['queue'].max(axis=0, initial=0).tolist(),
+            'through': history['through'].sum(axis=0).tolist(),
+            'carsPerPhase': [float(cars.mean()) if len(cars) else 0.0 for cars in ended],
+            'pedWait': self.waits.summary(),
+            'spawned': dict(zip(AGENT_TYPES, history['spawned'].sum(axis=0).tolist())),
+            'despawned': dict(zip(AGENT_TYPES, history['despawned'].sum(axis=0).tolist())),
+            'series': { name: values.tolist() for name, values in self.history(n).items() },
+        }
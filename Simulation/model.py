@@ -1,9 +1,16 @@
+import os
 import numpy as np
 import agentpy as ap
 from utils import Encodable
 from typing import List, Tuple, Optional
 from modelmap import *
 from pathfinding import PathFinder
+from mapindex import MapData
+from engine import CarEngine
+from partition import PartitionedEngine
+from instrument import Stats
+from intents import resolveMoves
+from metrics import TrafficMetrics
 
 class Agent(ap.Agent, Encodable):
     def __init__(self, model, *args, **kwargs):
@@ -23,6 +30,14 @@ class Agent(ap.Agent, Encodable):
     
     def getPos(self) -> tuple[int, int]:
         return self.model.env.positions[self]
+
+    def reset(self):
+        '''
+        Clear the state of a recycled agent before it is spawned again
+        '''
+        self.current_path = []
+        self.goal = None
+        self.setup()
     
     def isOutOfBounds(self):
         '''
@@ -34,14 +49,13 @@ class Agent(ap.Agent, Encodable):
 
     def isOccupied(self, move):
         """Verifica si una celda está ocupada por otro agente, incluidos peatones."""
-        for agent in self.model.agents:
-            if agent.getPos() == move:
-                return True
-        return False
+        return self.env.isOccupied(move)
 
     
     def set_new_goal(self):
         """Establece un nuevo objetivo aleatorio válido"""
+        stats = self.model.stats
+        clock = stats.clock()
         start = self.getPos()
         self.goal = self.model.pathfinder.find_random_valid_goal(
             start, 
@@ -55,123 +69,140 @@ class Agent(ap.Agent, Encodable):
         if not self.current_path:
             self.current_path = []
             self.goal = None
+        stats.record('replan', clock)
+        stats.count('replans')
 
 class CarAgent(Agent):
+    typeCode = CAR
+
     def setup(self):
         self.agentType = 'car'
 
+    def getPos(self) -> tuple[int, int]:
+        # The partitioned engine only syncs the car positions when needed
+        env = self.env
+        if env.deferred is not None:
+            env.sync()
+        return env.positions[self]
+
     def update(self):
         moves = self.getRoads()
 
         if len(moves) != 0:
             choice = self.model.random.choice(moves)
+            self.model.metrics.carMoved(self.getPos(), choice)
             self.env.move_to(self, choice)
 
     def canCross(self, move):
-        tile = self.env.road[move]
-        # Checks if the tile is accessible
-        return self.env.lights.getState(tile) == 'green'
+        # Road tile without a red light
+        return self.env.lights.carPass[move]
 
     def getRoads(self):
-        dir = self.env.getDir(self)
-        moves = []
-        x, y = self.getPos()
-
-        primary_moves = []
-        alternative_moves = []
-
-        if dir & ND:
-            move = (x-1, y)
-            if self.canCross(move) and self.env.road[move] != NO:
-                primary_moves.append(move)  # North
-            else:
-                # Look for an alternative lane to the left or right
-                for offset in [-1, 1]:
-                    alt_move = (x-1, y + offset)
-                    if self.canCross(alt_move) and self.env.road[alt_move] != NO:
-                        alternative_moves.append(alt_move)
-
-        if dir & SD:
-            move = (x+1, y)
-            if self.canCross(move) and self.env.road[move] != NO:
-                primary_moves.append(move)  # South
-            else:
-                for offset in [-1, 1]:
-                    alt_move = (x+1, y + offset)
-                    if self.canCross(alt_move) and self.env.road[alt_move] != NO:
-                        alternative_moves.append(alt_move)
-
-        if dir & ED:
-            move = (x, y+1)
-            if self.canCross(move) and self.env.road[move] != NO:
-                primary_moves.append(move)  # East
-            else:
-                for offset in [-1, 1]:
-                    alt_move = (x + offset, y+1)
-                    if self.canCross(alt_move) and self.env.road[alt_move] != NO:
-                        alternative_moves.append(alt_move)
-
-        if dir & WD:
-            move = (x, y-1)
-            if self.canCross(move) and self.env.road[move] != NO:
-                primary_moves.append(move)  # West
-            else:
-                for offset in [-1, 1]:
-                    alt_move = (x + offset, y-1)
-                    if self.canCross(alt_move) and self.env.road[alt_move] != NO:
-                        alternative_moves.append(alt_move)
-
-        # Prioritize primary moves, but if blocked, use alternative lanes
-        return primary_moves if primary_moves else alternative_moves
+        # Regular moves without a red light, or the lane changes next to them
+        # when all of those are blocked (see movegraph.py)
+        carPass = self.env.lights.carPass
+        regular, lanes = self.model.moves[False].moves(self.getPos())
+        moves = [move for move in regular if carPass[move]]
+        return moves if moves else [move for move in lanes if carPass[move]]
 
 class PedestrianAgent(Agent):
+    typeCode = PEDESTRIAN
+
     def setup(self):
         self.agentType = 'pedestrian'
+        # Pasos que lleva esperando a que se libere su camino
+        self.waiting = 0
+        # Pasos sin moverse desde el último movimiento, para las métricas
+        self.waited = 0
+        # Siguiente celda a la que quiere moverse
+        self.intention = None
         #self.set_new_goal()
     def initialize_goal(self):
         """Call this method after the agent's position is set."""
         self.set_new_goal()
         
     def update(self):
+        next_pos = self.intent()
+        if next_pos is None:
+            return
+
+        # Si la siguiente posición está ocupada, buscamos un rodeo local
+        if self.isOccupied(next_pos):
+            next_pos = self.blocked()
+            if next_pos is None:
+                self.wait()
+                return
+
+        # Si no hay obstáculos, continuamos con el movimiento
+        self.env.move_to(self, next_pos)
+        self.advance()
+
+    def intent(self):
+        """
+        Siguiente celda del camino (sin moverse), o None si hubo que buscar
+        una meta nueva
+        """
+        self.intention = None
         if not self.current_path or not self.goal:
             self.set_new_goal()
-            return
+            return None
             
         if len(self.current_path) <= 1:
             self.set_new_goal()
-            return
+            return None
 
         next_pos = self.current_path[1]  # Tomamos el siguiente punto en el camino
         
         # Actualizamos la intención (por ejemplo, indicamos el siguiente objetivo)
         self.intention = next_pos
-
-        # Si la siguiente posición está ocupada, intentamos movernos hacia atrás
-        if self.isOccupied(next_pos):
-            # Intentamos retroceder a la posición anterior
-            previous_pos = self.current_path[0]
-            # Verificamos si la posición anterior está libre
-            if not self.isOccupied(previous_pos):
-                self.env.move_to(self, previous_pos)
-                self.current_path.pop(1)  # Removemos la posición actual
-                return
-            else:
-                # Si no se puede retroceder, intentamos una nueva posición aleatoria
-                self.set_new_goal()
-                return
-
-        # Si no hay obstáculos, continuamos con el movimiento
-        self.env.move_to(self, next_pos)
+        return next_pos
+
+    def blocked(self):
+        """
+        La siguiente celda está ocupada: buscamos un rodeo local que regrese
+        al mismo camino. Si no lo hay esperamos hasta `patience` pasos a que
+        se libere y solo entonces replaneamos todo. Regresa la nueva
+        siguiente celda si hubo rodeo
+        """
+        path = self.model.pathfinder.repair_path(self.current_path, self.isOccupied, True)
+        if path:
+            self.current_path = path
+            self.intention = path[1]
+            self.waiting = 0
+            self.model.stats.count('replans.avoided')
+            return path[1]
+        if self.waiting < self.p.get('patience', 2):
+            self.waiting += 1
+        else:
+            # Con el camino nuevo la espera vuelve a empezar
+            self.waiting = 0
+            self.set_new_goal()
+        return None
+
+    def wait(self):
+        """Se quedó sin moverse este paso aunque tenía a dónde ir"""
+        self.waited += 1
+        self.model.metrics.pedBlocked()
+
+    def advance(self):
+        """Avanza el camino después de moverse a la siguiente celda"""
+        if self.waiting:
+            # Esperar bastó para no replanear
+            self.waiting = 0
+            self.model.stats.count('replans.avoided')
+        if self.waited:
+            self.model.metrics.pedWaited(self.waited)
+            self.waited = 0
+        next_pos = self.current_path[1]
         self.current_path.pop(0)  # Removemos la posición actual
 
-            # Aquí podrías comunicar la intención a otros agentes si lo deseas
+        # Aquí podrías comunicar la intención a otros agentes si lo deseas
         self.communicate_intention(next_pos)
 
     def communicate_intention(self, next_pos):
         """Método para comunicar la intención de movimiento a otros agentes"""
-        for agent in self.model.agents:
-            if isinstance(agent, PedestrianAgent) and agent.getPos() == next_pos:
-                return  # Se detiene si el siguiente peatón está en el camino
+        if self.env.isOccupied(next_pos, PEDESTRIAN):
+            return  # Se detiene si el siguiente peatón está en el camino
 
 
     def is_nearby(self, agent):
@@ -180,54 +211,311 @@ class PedestrianAgent(Agent):
         x2, y2 = agent.getPos()
         return abs(x1 - x2) <= 1 and abs(y1 - y2) <= 1  # Definir cercanía
 
+    def nearby_agents(self, kind=None):
+        """Agentes en las celdas vecinas (incluye la celda propia)"""
+        return [a for a in self.env.nearby(self.getPos(), 1, kind) if a is not self]
+
     def canCross(self, move):
-        tile = self.env.road[move]
-        return (((tile & RC) == RC) and self.env.lights.getState(tile) == 'red')
+        # Pedestrian crossing with a red light for the cars
+        return self.env.lights.pedPass[move]
+
+class AgentPool:
+    '''
+    Despawned agents kept to be spawned again, with the same id, instead of
+    allocating a new agentpy object every time
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.free: dict[type, list[Agent]] = {}
+
+    def __len__(self):
+        return sum(len(free) for free in self.free.values())
+
+    def acquire(self, cls):
+        '''
+        Agent of class `cls`, recycled if there is one available
+        '''
+        free = self.free.get(cls)
+        if free:
+            agent = free.pop()
+            agent.reset()
+            return agent
+        return cls(self.model)
+
+    def release(self, agents):
+        '''
+        Keep agents that already left the environment for later spawns
+        '''
+        for agent in agents:
+            self.free.setdefault(type(agent), []).append(agent)
 
 class LightSystem():
-    def __init__(self, lights):
-        # Each light group will have the light ids and the current index for the
-        # green light
-        self.groups = [[group, -1] for group in lights]
-        self.crossings = { }
-        self.step()
+    '''
+    Traffic lights as arrays indexed by light number (the id without the
+    LIGHT_SHIFT bits). Every group of lights is an intersection where one
+    light at a time is green, switching to the next one every `period` steps
+    of that intersection (shifted by its `offset`).
+
+    `carPass` and `pedPass` are the tiles cars can drive into and pedestrians
+    can cross right now. They are only recomputed when a light changes, and
+    `version` is bumped every time they are
+    '''
+    def __init__(self, lights, road, period=8, periods=None, offsets=None):
+        numbers = [[ID >> LIGHT_SHIFT for ID in group] for group in lights]
+        width = max((len(group) for group in numbers), default=0)
+        # Light numbers of every group, padded with 0 (the "no light" number)
+        self.groupLights = np.zeros((len(numbers), width), dtype=np.int64)
+        for i, group in enumerate(numbers):
+            self.groupLights[i, :len(group)] = group
+        self.groupSize = np.array([len(group) for group in numbers], dtype=np.int64)
+        self.greenIdx = np.full(len(numbers), -1, dtype=np.int64)
+
+        self.periods = np.full(len(numbers), period, dtype=np.int64) if periods is None else np.asarray(periods, dtype=np.int64)
+        self.offsets = np.zeros(len(numbers), dtype=np.int64) if offsets is None else np.asarray(offsets, dtype=np.int64)
+
+        top = max(int(self.groupLights.max(initial=0)), int((np.asarray(road) >> LIGHT_SHIFT).max(initial=0)))
+        # Tiles without a light read the state of light 0, which stays green
+        self.state = np.full(top + 1, GREEN, dtype=np.uint8)
+
+        road = np.asarray(road)
+        self.tileLights = (road >> LIGHT_SHIFT).astype(np.int64)
+        self.drivable = road != NO
+        self.crossing = (road & RC) == RC
+        # Only the tiles with a light ever change
+        self.lit = np.flatnonzero(self.tileLights)
+        self.carPass = self.drivable.copy()
+        self.pedPass = np.zeros(road.shape, dtype=bool)
+
+        self.version = 0
+        self._crossings = None
+        self._switch(np.arange(len(numbers)))
+        # Steps so far, counted here since the model is not always stepped
+        # through sim_step (the server calls step directly, so model.t stays 0)
+        self.t = 0
 
     def step(self):
-        # TODO: There has to be a better way to do this idk
-        for idx, (group, greenIdx) in enumerate(self.groups):
-            # Increment the green index and wrap around
-            greenIdx = (greenIdx + 1) % len(group)
-            # Update the green index
-            self.groups[idx][1] = greenIdx
-
-            # Update the lights dictionary
-            for i, lightID in enumerate(group):
-                self.crossings[lightID] = 'green' if greenIdx == i else 'red'
+        '''
+        Switch the intersections due at the next step, numbered from 1 like
+        the steps of sim_step
+        '''
+        self.t += 1
+        due = np.flatnonzero((self.t - self.offsets) % self.periods == 0)
+        if len(due):
+            self._switch(due)
+
+    def _switch(self, groups):
+        # Turn the next light of each group green and the rest red
+        self.greenIdx[groups] = (self.greenIdx[groups] + 1) % self.groupSize[groups]
+        lights = self.groupLights[groups]
+        used = np.arange(lights.shape[1]) < self.groupSize[groups, None]
+        green = np.arange(lights.shape[1]) == self.greenIdx[groups, None]
+        self.state[lights[used]] = np.where(green[used], GREEN, RED)
+        self.state[0] = GREEN
+
+        green = self.state[self.tileLights.flat[self.lit]] == GREEN
+        self.carPass.flat[self.lit] = self.drivable.flat[self.lit] & green
+        self.pedPass.flat[self.lit] = self.crossing.flat[self.lit] & ~green
+        self.version += 1
+
+    @property
+    def crossings(self) -> dict:
+        '''
+        State name of every light by id
+        '''
+        if self._crossings is None or self._crossings[0] != self.version:
+            ids = self.groupLights[np.arange(self.groupLights.shape[1]) < self.groupSize[:, None]]
+            states = { int(n) << LIGHT_SHIFT: 'green' if self.state[n] == GREEN else 'red' for n in ids }
+            self._crossings = (self.version, states)
+        return self._crossings[1]
 
     def getState(self, ID):
-        # Ignore the first 16 most significant bits
-        ID = ID & 0xffff0000
-        # If there is no ID associated with the tile just return green
-        return self.crossings.get(ID, 'green')
+        # Ignore the first 16 least significant bits
+        n = int(ID) >> LIGHT_SHIFT
+        # If there is no light with that number just return green
+        if n >= len(self.state) or self.state[n] == GREEN:
+            return 'green'
+        return 'red'
 
 class CityEnv(ap.Grid):
     def setup(self):
-        self.road: np.ndarray = self.p.road
-        self.dir: np.ndarray = self.p.dir
-        self.lights = LightSystem(self.p.lights)
+        self.road: np.ndarray = self.model.map.road
+        self.dir: np.ndarray = self.model.map.dir
+        self.lights = LightSystem(
+            self.p.lights, self.road,
+            period=self.p.get('lightPeriod', 8),
+            periods=self.p.get('lightPeriods'),
+            offsets=self.p.get('lightOffsets'),
+        )
         self.positions = {}  # Initialize the positions dictionary
 
+        # Occupancy index kept in sync with every add/move/remove. Each agent
+        # type has its own layer with the number of agents on every cell, and
+        # `cellIds` holds the id of one of the agents on the cell (-1 if empty)
+        self.occupancy = np.zeros((len(AGENT_TYPES), *self.shape), dtype=np.int32)
+        self.counts = np.zeros(self.shape, dtype=np.int32)
+        self.cellIds = np.full(self.shape, -1, dtype=np.int64)
+        # Engine whose last moves are only in the occupancy counts so far
+        self.deferred = None
+
     def getDir(self, agent: Agent):
         return self.dir[agent.getPos()]
 
+    def add_agents(self, agents, positions=None, **kwargs):
+        super().add_agents(agents, positions=positions, **kwargs)
+        for agent in agents:
+            self._occupy(agent, self.positions[agent])
+
+    def move_to(self, agent, pos):
+        old = self.positions[agent]
+        super().move_to(agent, pos)
+        new = self.positions[agent]
+        if new != old:
+            self._vacate(agent, old)
+            self._occupy(agent, new)
+
+    def moveMany(self, agents, old, new):
+        '''
+        Move several agents at once. `old` and `new` are (n, 2) arrays with
+        the current and target positions of each agent
+        '''
+        if not agents:
+            return
+        codes = np.array([agent.typeCode for agent in agents])
+        ox, oy = old[:, 0], old[:, 1]
+        nx, ny = new[:, 0], new[:, 1]
+
+        np.subtract.at(self.occupancy, (codes, ox, oy), 1)
+        np.add.at(self.occupancy, (codes, nx, ny), 1)
+        np.subtract.at(self.counts, (ox, oy), 1)
+        np.add.at(self.counts, (nx, ny), 1)
+        self.relink(agents, old, new)
+
+    def relink(self, agents, old, new):
+        '''
+        Move agents between the cell sets and update their positions and the
+        cell ids, leaving the occupancy counts as they are
+        '''
+        if not len(agents):
+            return
+        ids = np.array([agent.id for agent in agents])
+        ox, oy = old[:, 0], old[:, 1]
+        nx, ny = new[:, 0], new[:, 1]
+
+        cells = self.grid.agents
+        oldPos = list(zip(ox.tolist(), oy.tolist()))
+        newPos = list(zip(nx.tolist(), ny.tolist()))
+        for agent, o, n in zip(agents, oldPos, newPos):
+            cells[o].remove(agent)
+            cells[n].add(agent)
+        self.positions.update(zip(agents, newPos))
+
+        self.cellIds[nx, ny] = ids
+        for i in np.flatnonzero(self.cellIds[ox, oy] == ids):
+            left = cells[oldPos[i]]
+            self.cellIds[oldPos[i]] = next(iter(left)).id if left else -1
+
+    def sync(self):
+        '''
+        Bring the positions and cell sets up to date with the agents an
+        engine moved without touching them (see PartitionedEngine)
+        '''
+        if self.deferred is not None:
+            deferred, self.deferred = self.deferred, None
+            deferred.sync()
+
+    def remove_agents(self, agents):
+        for agent in agents:
+            pos = self.positions[agent]
+            super().remove_agents([agent])
+            self._vacate(agent, pos)
+
+    def _occupy(self, agent, pos):
+        self.occupancy[agent.typeCode][pos] += 1
+        self.counts[pos] += 1
+        self.cellIds[pos] = agent.id
+
+    def _vacate(self, agent, pos):
+        self.occupancy[agent.typeCode][pos] -= 1
+        self.counts[pos] -= 1
+        if self.cellIds[pos] == agent.id:
+            # Hand the cell over to any other agent still standing on it
+            if self.counts[pos]:
+                self.sync()
+            left = self.grid.agents[pos]
+            self.cellIds[pos] = next(iter(left)).id if left else -1
+
+    def isOccupied(self, pos, kind=None) -> bool:
+        '''
+        Check if there is any agent (of the given type code) on a cell
+        '''
+        if kind is None:
+            return self.counts[pos] > 0
+        return self.occupancy[kind][pos] > 0
+
+    def agentsAt(self, pos) -> set:
+        '''
+        Agents standing on a cell
+        '''
+        self.sync()
+        return self.grid.agents[pos] if self.counts[pos] else set()
+
+    def within(self, x0, y0, x1, y1) -> list:
+        '''
+        Agents on rows x0 to x1 and columns y0 to y1 (not included), looking
+        only at the occupied cells of the window
+        '''
+        self.sync()
+        cells = self.grid.agents
+        agents = []
+        for i, j in zip(*np.nonzero(self.counts[x0:x1, y0:y1])):
+            agents.extend(cells[x0 + i, y0 + j])
+        return agents
+
+    def nearby(self, pos, radius=1, kind=None) -> list:
+        '''
+        Agents (of the given type code) within `radius` cells of `pos`,
+        including the cell itself
+        '''
+        self.sync()
+        x, y = pos
+        x0, y0 = max(x - radius, 0), max(y - radius, 0)
+        layer = self.counts if kind is None else self.occupancy[kind]
+        window = layer[x0:x + radius + 1, y0:y + radius + 1]
+
+        agents = []
+        for i, j in zip(*np.nonzero(window)):
+            for agent in self.grid.agents[x0 + i, y0 + j]:
+                if kind is None or agent.typeCode == kind:
+                    agents.append(agent)
+        return agents
+
 class CityModel(ap.Model):
     def setup(self):
-        # Pad the environment for despawn purposes
-        self.p.road = np.pad(self.p.road, 1, 'edge')
-        self.p.dir = np.pad(self.p.dir, 1)
-
-        self.env = CityEnv(self, self.p.road.shape)
-        self.pathfinder = PathFinder(self.p.road, self.p.dir)
+        # Map padded for despawn purposes, shared with the other models of
+        # the same map. The parameters are left as they are, so setting up
+        # again does not pad them twice
+        self.map = MapData.of(self.p.road, self.p.dir)
+
+        # Timers and counters, kept across restarts of the same model
+        if getattr(self, 'stats', None) is None:
+            self.stats = Stats(enabled=self.p.get('stats', False))
+
+        self.env = CityEnv(self, self.map.road.shape)
+        # Walkable tiles of the map, used for goals and spawn points
+        self.index = self.map.index
+        cluster = self.p.get('pathCluster', 0)
+        # Moves of every agent class, read by pathfinding and car movement
+        self.moves = self.map.moveGraphs()
+        self.pathfinder = PathFinder(
+            self.map.road, self.map.dir,
+            cache_bytes=int(self.p.get('pathCacheMB', 64) * 2**20),
+            index=self.index,
+            rng=self.nprandom,
+            stats=self.stats,
+            cluster=cluster,
+            graphs=self.map.clusterGraphs(cluster, self.stats) if cluster > 0 else None,
+            moves=self.moves,
+        )
         
         self.agents: list[Agent]
         self.agents, agentPos = self.GenAgents(
@@ -236,30 +524,48 @@ class CityModel(ap.Model):
         )
         self.env.add_agents(self.agents, positions=agentPos)
         self.deleted = []
+        # Despawned agents waiting to be spawned again
+        self.pool = AgentPool(self)
+
+        # Optional vectorized engine that moves every car in bulk, on this
+        # process or split in row bands between worker processes
+        if getattr(self, 'engine', None) is not None:
+            self.engine.close()
+        self.engine = None
+        engine = self.p.get('engine', 'agent')
+        if engine == 'vector':
+            self.engine = CarEngine(self)
+        elif engine == 'parallel':
+            self.engine = PartitionedEngine(self, self.p.get('workers', 0) or os.cpu_count())
+        if self.engine is not None:
+            cars = [(a, p) for a, p in zip(self.agents, agentPos) if isinstance(a, CarAgent)]
+            self.engine.add([a for a, _ in cars], [p for _, p in cars])
 
         # Add a counter for spawning new cars
         self.car_spawn_counter = 0
+        # Agents spawned and despawned over the whole run, by type code
+        self.spawned = np.zeros(len(AGENT_TYPES), dtype=np.int64)
+        self.despawned = np.zeros(len(AGENT_TYPES), dtype=np.int64)
+        # Traffic metrics of the last steps (see metrics.py)
+        self.metrics = TrafficMetrics(self, self.p.get('metricsWindow', 1024), self.p.get('metrics', True))
+
+    def attachStats(self, stats: Stats):
+        '''
+        Report to `stats` from now on, for models set up somewhere else
+        '''
+        self.stats = self.pathfinder.stats = stats
 
     def GenAgents(self, numCars, numPed):
         '''
         Initialize the agents and place them on random tiles they can walk on
         '''
-        # Get all possible positions on the roads
-        roads = list(zip(*np.where((self.env.road & RO) == RO)))  # Road tiles
- 
-    # Exclude positions that are directly on the edge of the grid
-        roads = [(x, y) for x, y in roads if 1 <= x < self.env.road.shape[0] - 1 and 1 <= y < self.env.road.shape[1] - 1]
- 
-    # Shuffle the roads for random distribution
-        self.random.shuffle(roads)
-
-    # Limit the number of cars to numCars
-        carPos = roads[:numCars]
-
-    # Use the existing logic for pedestrians (sidewalks)
-        sidewalks = list(zip(*np.where((self.env.road & SI) == SI)))  # Sidewalk tiles
-        self.random.shuffle(sidewalks)
-        pedPos = sidewalks[:numPed]
+        # Random road and sidewalk tiles (the index already leaves out the
+        # edges of the grid)
+        roads, sidewalks = self.index.roads, self.index.sidewalks
+        carIdx = self.random.sample(range(len(roads)), min(numCars, len(roads)))
+        pedIdx = self.random.sample(range(len(sidewalks)), min(numPed, len(sidewalks)))
+        carPos = [tuple(pos) for pos in roads[carIdx].tolist()]
+        pedPos = [tuple(pos) for pos in sidewalks[pedIdx].tolist()]
 
     # Create agents
         agents = []
@@ -288,49 +594,178 @@ class CityModel(ap.Model):
 
 
     def step(self):
-        # Step traffic lights every 8 steps
-        if self.t % 8 == 0:
-            self.env.lights.step()
+        stats = self.stats
+        stepClock = clock = stats.clock()
+
+        # Switch the traffic lights due this step
+        self.env.lights.step()
+        stats.record('lights', clock)
 
-        # Spawn a new car every 5 steps
+        # Spawn a new car every 10 steps
+        clock = stats.clock()
         self.car_spawn_counter += 1
-        if self.car_spawn_counter % 10 == 0:
+        if self.car_spawn_counter % self.p.get('spawnEvery', 10) == 0:
             self.spawn_new_car()
+        stats.record('spawn', clock)
 
-        alive = []
+        # The agents that stay are compacted in place at the front of the list
+        agents = self.agents
+        keep = 0
         deleted: list[Agent] = []
-        for agent in self.agents:
-            agent.update()
-
-            # Despawn agents on the edges
-            if agent.isOutOfBounds():
-                deleted.append(agent)
-            else:
-                alive.append(agent)
-
+        if self.p.get('movement', 'sequential') == 'intents':
+            out = self.moveIntents()
+            for agent, gone in zip(agents, out.tolist()):
+                if gone:
+                    deleted.append(agent)
+                else:
+                    agents[keep] = agent
+                    keep += 1
+            if self.engine is not None:
+                self.engine.remove([agent for agent in deleted if agent.typeCode == CAR])
+        elif self.engine is None:
+            clock = stats.clock()
+            for agent in agents:
+                agent.update()
+
+                # Despawn agents on the edges
+                if agent.isOutOfBounds():
+                    deleted.append(agent)
+                else:
+                    agents[keep] = agent
+                    keep += 1
+            stats.record('agents', clock)
+        else:
+            # Cars are moved all at once before the pedestrians update
+            clock = stats.clock()
+            deleted = self.engine.step()
+            self.engine.remove(deleted)
+            stats.record('cars', clock)
+
+            clock = stats.clock()
+            gone = set(deleted)
+            for agent in agents:
+                if agent.typeCode == CAR:
+                    if agent not in gone:
+                        agents[keep] = agent
+                        keep += 1
+                    continue
+
+                agent.update()
+                if agent.isOutOfBounds():
+                    deleted.append(agent)
+                else:
+                    agents[keep] = agent
+                    keep += 1
+            stats.record('pedestrians', clock)
+
+        clock = stats.clock()
+        del agents[keep:]
         self.env.remove_agents(deleted)
-        self.agents = alive
         # Save the deleted agents IDs to send later to the simulation
         self.deleted = [x.id for x in deleted]
+        for agent in deleted:
+            self.despawned[agent.typeCode] += 1
+        # Only cars are spawned again during a run
+        self.pool.release([agent for agent in deleted if agent.typeCode == CAR])
+        stats.count('despawned', len(deleted))
+        stats.record('despawn', clock)
+
+        clock = stats.clock()
+        self.metrics.endStep()
+        stats.record('metrics', clock)
+
+        stats.record('step', stepClock)
+
+    def moveIntents(self) -> np.ndarray:
+        '''
+        Two-phase movement (see intents.py): collect the intent of every
+        agent, resolve the conflicts in bulk and move the winners at once.
+        Returns which agents ended up on the map border
+        '''
+        stats = self.stats
+        env = self.env
+        agents = self.agents
+        engine = self.engine
+
+        clock = stats.clock()
+        env.sync()
+        cur = np.array([env.positions[agent] for agent in agents], dtype=np.int64).reshape(-1, 2)
+        want = cur.copy()
+        isPed = np.array([agent.typeCode == PEDESTRIAN for agent in agents], dtype=bool)
+
+        if engine is None:
+            for i in np.flatnonzero(~isPed).tolist():
+                moves = agents[i].getRoads()
+                if moves:
+                    want[i] = self.random.choice(moves)
+        else:
+            slots, new = engine.propose()
+            index = { agent: i for i, agent in enumerate(agents) }
+            want[[index[engine.cars[slot]] for slot in slots.tolist()]] = new
+
+        peds = np.flatnonzero(isPed).tolist()
+        for i in peds:
+            intent = agents[i].intent()
+            if intent is not None:
+                want[i] = intent
+        stats.record('intents', clock)
+
+        # Pedestrians only step into a crossing while cars have a red light
+        # there, unless they are already crossing
+        clock = stats.clock()
+        lights = env.lights
+        wx, wy = want[:, 0], want[:, 1]
+        allowed = ~isPed | ~lights.crossing[wx, wy] | lights.pedPass[wx, wy] | lights.crossing[cur[:, 0], cur[:, 1]]
+        moving = resolveMoves(cur, want, env.shape, self.nprandom.random(len(agents)), allowed)
+        stats.record('resolve', clock)
+
+        clock = stats.clock()
+        won = np.flatnonzero(moving & isPed)
+        if engine is None:
+            won = np.flatnonzero(moving)
+        else:
+            cars = np.flatnonzero(moving & ~isPed)
+            engine.apply(np.array([engine.slot[agents[i]] for i in cars.tolist()], dtype=np.int64), want[cars])
+        env.moveMany([agents[i] for i in won.tolist()], cur[won], want[won])
+        if engine is None:
+            cars = won[~isPed[won]]
+            self.metrics.carsMoved(cur[cars], want[cars])
+
+        for i in peds:
+            ped = agents[i]
+            if moving[i]:
+                ped.advance()
+            elif ped.intention is not None:
+                if allowed[i]:
+                    ped.blocked()
+                ped.wait()
+        stats.record('apply', clock)
+
+        cur[moving] = want[moving]
+        r, c = env.shape
+        x, y = cur[:, 0], cur[:, 1]
+        return (x <= 0) | (y <= 0) | (x + 1 >= r) | (y + 1 >= c)
 
     def spawn_new_car(self):
         '''
         Spawns a new car agent at a valid road position.
         '''
-        # Get all valid road positions (excluding edges)
-        roads = list(zip(*np.where((self.env.road & RO) == RO)))
-        roads = [(x, y) for x, y in roads if 1 <= x < self.env.road.shape[0] - 1 and 1 <= y < self.env.road.shape[1] - 1]
+        roads = self.index.roads
 
-        if roads:  # Ensure there are valid positions available
+        if len(roads):  # Ensure there are valid positions available
             # Choose a random position for the new car
-            new_pos = self.random.choice(roads)
+            new_pos = tuple(roads[self.random.randrange(len(roads))].tolist())
 
-            # Create the new car agent
-            new_car = CarAgent(self)
+            # Reuse a despawned car if there is one
+            new_car = self.pool.acquire(CarAgent)
 
             # Add the new car to the list of agents and the environment
             self.agents.append(new_car)
             self.env.add_agents([new_car], positions=[new_pos])
+            self.spawned[CAR] += 1
+            self.stats.count('spawned')
+            if self.engine is not None:
+                self.engine.add([new_car], [new_pos])
 
 params = {
     'steps': 40,
@@ -339,4 +774,17 @@ params = {
     'numPedestrians': 15,
     'numCars': 10,
     'lights': INTERSECTIONS,
+    'engine': 'agent', # 'agent', 'vector' (bulk car movement) or 'parallel'
+    'workers': 0, # Processes of the 'parallel' engine (0 for one per core)
+    'movement': 'sequential', # 'sequential' (agents move one after another) or 'intents' (see intents.py)
+    'pathCacheMB': 64, # Memory for cached distance fields (0 to always run A*)
+    'pathCluster': 0, # Side of the clusters of the hierarchical pathfinder (0 to search the whole grid)
+    'spawnEvery': 10, # Steps between new cars
+    'lightPeriod': 8, # Steps between traffic light changes
+    'lightPeriods': None, # Optional period of every intersection, in the order of 'lights'
+    'lightOffsets': None, # Optional step every intersection starts counting from
+    'patience': 2, # Steps a blocked pedestrian waits before replanning its whole path
+    'stats': False, # Per-phase timers and counters (see instrument.py)
+    'metrics': True, # Traffic metrics kept while running (see metrics.py)
+    'metricsWindow': 1024, # Steps of traffic metrics kept
 }
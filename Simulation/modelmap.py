@@ -1,6 +1,11 @@
 from constants import *
 import numpy as np
 
+# Tile types with the light id from LIGHT_SHIFT up need 32 bits, the direction
+# bits fit in one byte
+ROAD_DTYPE = np.uint32
+DIR_DTYPE = np.uint8
+
 L1 = 1 << LIGHT_SHIFT
 L2 = 2 << LIGHT_SHIFT
 L3 = 3 << LIGHT_SHIFT
@@ -26,7 +31,7 @@ roadType = np.array([
     [NO,NO,NO,NO,NO,NO,SI,SI,RO,RO,NO,RO,SI,SI,NO,NO,SI,SI,RO,RO,SI,SI,NO,NO,NO],
     [NO,NO,NO,NO,NO,NO,SI,SI,RO,RO,RO,RO,SI,SI,NO,NO,SI,SI,RO,RO,SI,SI,NO,NO,NO],
     [NO,NO,NO,NO,NO,NO,SI,SI,RO,RO,RO,RO,SI,SI,NO,NO,SI,SI,RO,RO,SI,SI,NO,NO,NO],
-])
+], dtype=ROAD_DTYPE)
 
 directions = np.array([
     [NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO,NO],
@@ -46,4 +51,4 @@ directions = np.array([
     [NO,NO,NO,NO,NO,NO,NO,NO,SD,SD,ND,ND,NO,NO,NO,NO,NO,NO,SD,ND,NO,NO,NO,NO,NO],
     [NO,NO,NO,NO,NO,NO,NO,NO,SD,SD,ND,ND,NO,NO,NO,NO,NO,NO,SD,ND,NO,NO,NO,NO,NO],
     [NO,NO,NO,NO,NO,NO,NO,NO,SD,SD,ND,ND,NO,NO,NO,NO,NO,NO,SD,ND,NO,NO,NO,NO,NO],
-])
+], dtype=DIR_DTYPE)
@@ -0,0 +1,174 @@
+'''
+Movement graphs.
+
+The moves an agent can make only depend on the road and direction layers, so
+they are compiled once per map and agent class into CSR arrays instead of
+being worked out from the bitmasks on every call. Pathfinding, CarAgent.getRoads
+and the vectorized car engines all read the same arrays.
+
+Pedestrians step to any of the 4 neighbours that is a sidewalk or a crossing.
+Cars take the moves set in the direction layer into any tile that is not NO
+(the regular moves) and, for each of those, the lanes on both sides of the
+tile ahead (the lane changes), which they only use when every regular move is
+blocked. Edges into a tile with a traffic light carry the number of that
+light, so whether an edge is open right now is `state[light[e]] == GREEN`
+(light 0 stays green).
+'''
+from typing import Tuple
+
+import numpy as np
+
+from constants import *
+
+# Direction bit, offset of the regular move and offsets of the lane changes.
+# The order matches the one cars have always picked their moves in
+CAR_MOVES = [
+    (ND, (-1, 0), [(-1, -1), (-1, 1)]),
+    (SD, ( 1, 0), [( 1, -1), ( 1, 1)]),
+    (ED, ( 0, 1), [(-1,  1), ( 1, 1)]),
+    (WD, ( 0,-1), [(-1, -1), ( 1,-1)]),
+]
+
+# Offsets of the pedestrian moves, in the order PathFinder has always used
+PEDESTRIAN_MOVES = [(0, 1), (0, -1), (1, 0), (-1, 0)]
+
+# Most cells whose moves are kept as lists before starting over
+LIST_CELLS = 1 << 18
+
+def remember(lists: dict, key, value):
+    if len(lists) >= LIST_CELLS:
+        lists.clear()
+    lists[key] = value
+
+class MoveGraph:
+    '''
+    Moves of one agent class on a map as CSR arrays over the cells in
+    row-major order. The edges leaving cell c are ptr[c] to ptr[c+1]: the
+    regular moves up to mid[c] and the lane changes after it. dst[e] is the
+    cell edge e goes into and light[e] the number of its light
+    '''
+    ARRAYS = ('ptr', 'mid', 'dst', 'light')
+
+    def __init__(self, shape, ptr, mid, dst, light):
+        self.shape = tuple(shape)
+        self.cols = self.shape[1]
+        self.ptr = ptr
+        self.mid = mid
+        self.dst = dst
+        self.light = light
+        # Most edges leaving a single cell
+        self.width = int(np.diff(ptr).max(initial=0))
+        self._reverse = None
+        # Moves of the cells asked for so far as Python lists, which are much
+        # faster to read one cell at a time than the arrays
+        self._moves = {}
+        self._sources = {}
+
+    @classmethod
+    def compile(cls, road: np.ndarray, dirs: np.ndarray, is_pedestrian: bool) -> 'MoveGraph':
+        road = np.asarray(road)
+        rows, cols = road.shape
+        x, y = np.indices(road.shape)
+
+        if is_pedestrian:
+            enterable = ((road & SI) == SI) | ((road & RC) == RC)
+            # Every cell can take every move
+            moves = [(None, off) for off in PEDESTRIAN_MOVES]
+            regular = len(moves)
+        else:
+            enterable = road != NO
+            moves = [(bit, off) for bit, off, _ in CAR_MOVES]
+            moves += [(bit, alt) for bit, _, alts in CAR_MOVES for alt in alts]
+            regular = len(CAR_MOVES)
+
+        # One column per move, in the order the moves of a cell are listed
+        ok = np.zeros((road.size, len(moves)), dtype=bool)
+        dst = np.zeros((road.size, len(moves)), dtype=np.int32)
+        for k, (bit, (dx, dy)) in enumerate(moves):
+            tx, ty = x + dx, y + dy
+            inside = (tx >= 0) & (tx < rows) & (ty >= 0) & (ty < cols)
+            tx, ty = np.clip(tx, 0, rows - 1), np.clip(ty, 0, cols - 1)
+            valid = inside & enterable[tx, ty]
+            if bit is not None:
+                valid &= (dirs & bit) != 0
+            ok[:, k] = valid.ravel()
+            dst[:, k] = (tx * cols + ty).ravel()
+
+        counts = ok.sum(axis=1)
+        ptr = np.zeros(road.size + 1, dtype=np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        mid = ptr[:-1] + ok[:, :regular].sum(axis=1)
+        dst = dst[ok]
+        light = (road.ravel()[dst] >> LIGHT_SHIFT).astype(np.int32)
+        return cls(road.shape, ptr, mid, dst, light)
+
+    def arrays(self) -> dict:
+        return { name: getattr(self, name) for name in self.ARRAYS }
+
+    def moves(self, pos) -> Tuple[list, list]:
+        '''
+        Cells the regular moves and the lane changes from `pos` go into
+        '''
+        moves = self._moves.get(pos)
+        if moves is None:
+            c = pos[0] * self.cols + pos[1]
+            lo, hi = self.ptr[c:c + 2].tolist()
+            cells = [divmod(v, self.cols) for v in self.dst[lo:hi].tolist()]
+            split = int(self.mid[c]) - lo
+            moves = (cells[:split], cells[split:])
+            remember(self._moves, pos, moves)
+        return moves
+
+    def neighbors(self, pos) -> list:
+        '''
+        Cells the regular moves from `pos` go into
+        '''
+        return self.moves(pos)[0]
+
+    def edges(self) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Cells every regular move goes from and into, as flat indices
+        '''
+        regular = np.arange(len(self.dst)) < np.repeat(self.mid, np.diff(self.ptr))
+        src = np.repeat(np.arange(len(self.mid)), np.diff(self.ptr))[regular]
+        return src, self.dst[regular].astype(np.int64)
+
+    def sources(self, cell: int) -> list:
+        '''
+        Cells with a regular move into `cell` (both as flat indices). The
+        reverse graph is built the first time
+        '''
+        sources = self._sources.get(cell)
+        if sources is None:
+            if self._reverse is None:
+                src, dst = self.edges()
+                ptr = np.zeros(len(self.mid) + 1, dtype=np.int64)
+                np.cumsum(np.bincount(dst, minlength=len(self.mid)), out=ptr[1:])
+                self._reverse = (ptr, src[np.argsort(dst, kind='stable')])
+            ptr, src = self._reverse
+            sources = src[ptr[cell]:ptr[cell + 1]].tolist()
+            remember(self._sources, cell, sources)
+        return sources
+
+    def candidates(self, xy: np.ndarray, state: np.ndarray):
+        '''
+        Candidate moves of the agents at `xy` as a (agents, width, 2) array and
+        a mask with the ones they can take given the light `state`: the open
+        regular moves, or the open lane changes for agents whose regular moves
+        are all blocked
+        '''
+        cells = xy[:, 0] * self.cols + xy[:, 1]
+        lo, mid, hi = self.ptr[cells], self.mid[cells], self.ptr[cells + 1]
+        edge = lo[:, None] + np.arange(self.width)
+        used = edge < hi[:, None]
+        edge[~used] = 0
+        if not len(self.dst):
+            return np.zeros((len(xy), 0, 2), dtype=np.int64), used
+
+        open = used & (state[self.light[edge]] == GREEN)
+        regular = edge < mid[:, None]
+        regularOk = open & regular
+        valid = np.where(regularOk.any(axis=1)[:, None], regularOk, open & ~regular)
+
+        dst = self.dst[edge].astype(np.int64)
+        return np.stack([dst // self.cols, dst % self.cols], axis=-1), valid
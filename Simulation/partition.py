@@ -0,0 +1,263 @@
+'''
+Car stepping split between worker processes.
+
+The map is cut into bands of rows, one per worker. Every step the cars are
+grouped by the band they stand on and each worker moves the cars of its band
+with the same rules as CarEngine, reading the car movement graph and the
+light states and writing the new positions and the car occupancy of its own
+rows straight into shared memory. Cars that cross into another band are
+handed off: the worker returns the cells they arrived at, the main process
+adds them to the occupancy of the neighbouring band once every worker is
+done, and they belong to that band from the next step on.
+
+The random value each car uses is drawn by the main process from the model
+generator, one per car in slot order, so the moves only depend on the seed and
+not on the number of workers.
+
+The Python side of the moves (agent positions, cell sets and cell ids) is only
+brought up to date when something reads it, see CityEnv.sync.
+'''
+import os
+import shutil
+import tempfile
+import weakref
+from multiprocessing import get_context
+
+import numpy as np
+
+from constants import CAR
+from engine import CarEngine, pickMoves
+from movegraph import MoveGraph
+
+# tmpfs backed directory for the shared arrays when there is one
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def openShared(path, shape, dtype):
+    return np.memmap(path, dtype=dtype, mode='r+', shape=tuple(shape))
+
+def bandWorker(conn):
+    '''
+    Worker process loop. Arrays arrive as ('attach', specs) and every
+    ('step', lo, hi, top, bottom) moves the cars in slots order[lo:hi], which
+    stand on rows top to bottom (not included)
+    '''
+    arrays = {}
+    graph = None
+    conn.send('ready')
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            return
+
+        if msg[0] == 'attach':
+            arrays.update({ name: openShared(*spec) for name, spec in msg[1].items() })
+            if graph is None:
+                graph = MoveGraph(arrays['counts'].shape, *(arrays[name] for name in MoveGraph.ARRAYS))
+
+        elif msg[0] == 'step':
+            _, lo, hi, top, bottom = msg
+            slots = np.array(arrays['order'][lo:hi])
+            xy = arrays['xy']
+            cur = xy[slots]
+
+            moves, valid = graph.candidates(cur, arrays['state'])
+            moving = np.flatnonzero(valid.any(axis=1))
+            new = pickMoves(moves, valid, moving, arrays['rand'][slots[moving]])
+            old = cur[moving]
+
+            # Net change of the number of cars on each cell of the band
+            cols = arrays['counts'].shape[1]
+            bottom = min(bottom, arrays['counts'].shape[0])
+            inside = (new[:, 0] >= top) & (new[:, 0] < bottom)
+            size = (bottom - top) * cols
+            delta = np.bincount((new[inside, 0] - top) * cols + new[inside, 1], minlength=size)
+            delta -= np.bincount((old[:, 0] - top) * cols + old[:, 1], minlength=size)
+            delta = delta.astype(np.int32).reshape(bottom - top, cols)
+            arrays['occupancy'][CAR, top:bottom] += delta
+            arrays['counts'][top:bottom] += delta
+            xy[slots[moving]] = new
+
+            # The cells in other bands are left to the main process
+            conn.send(new[~inside])
+
+        elif msg[0] == 'close':
+            return
+
+class PartitionedEngine(CarEngine):
+    '''
+    CarEngine that moves the cars on `workers` processes, each owning a band
+    of rows of the map
+    '''
+    def __init__(self, model, workers: int):
+        super().__init__(model)
+        self.workers = max(1, workers)
+        rows = self.env.shape[0]
+        self.bandRows = -(-rows // self.workers)
+        self.path = tempfile.mkdtemp(prefix='citysim-', dir=SHM_DIR)
+
+        # Movement graph, light states and the occupancy, which the env keeps
+        # using from here
+        env = self.env
+        self.specs = {}
+        for name, array in self.graph.arrays().items():
+            self.share(name, array)
+        self._state = self.share('state', env.lights.state)
+        self._lightsVersion = env.lights.version
+        env.occupancy = self.share('occupancy', env.occupancy)
+        env.counts = self.share('counts', env.counts)
+
+        # Per car arrays, grown by doubling
+        self.capacity = 0
+        self.synced = np.empty((0, 2), dtype=np.int64)
+        self.grow(1024)
+
+        ctx = get_context('spawn')
+        self.conns, self.procs = [], []
+        for _ in range(self.workers):
+            conn, child = ctx.Pipe()
+            proc = ctx.Process(target=bandWorker, args=(child,), daemon=True)
+            proc.start()
+            child.close()
+            conn.send(('attach', self.specs))
+            self.conns.append(conn)
+            self.procs.append(proc)
+        # Wait for the workers to start so the first step does not pay for it
+        for conn in self.conns:
+            conn.recv()
+
+        self._finalizer = weakref.finalize(self, PartitionedEngine.shutdown, self.conns, self.procs, self.path)
+
+    @staticmethod
+    def shutdown(conns, procs, path):
+        for conn in conns:
+            try:
+                conn.send(('close',))
+            except (OSError, ValueError):
+                pass
+        for proc in procs:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+        for conn in conns:
+            conn.close()
+        # The arrays stay mapped until their last view is gone
+        shutil.rmtree(path, ignore_errors=True)
+
+    def close(self):
+        self._finalizer()
+
+    def share(self, name, array, generation=0):
+        '''
+        Copy `array` to a shared memory file the workers can map
+        '''
+        path = os.path.join(self.path, f'{name}.{generation}')
+        shared = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+        shared[...] = array
+        self.specs[name] = (path, array.shape, array.dtype.str)
+        return shared
+
+    def grow(self, capacity):
+        n = len(self.cars)
+        xy = np.zeros((capacity, 2), dtype=np.int64)
+        xy[:n] = self.xy
+        self._xy = self.share('xy', xy, capacity)
+        self._rand = self.share('rand', np.zeros(capacity), capacity)
+        self._order = self.share('order', np.zeros(capacity, dtype=np.int64), capacity)
+        self.xy = self._xy[:n]
+
+        synced = np.zeros((capacity, 2), dtype=np.int64)
+        synced[:n] = self.synced[:n]
+        self.synced = synced
+        self.capacity = capacity
+
+        for conn in getattr(self, 'conns', []):
+            conn.send(('attach', self.specs))
+
+    def add(self, cars, positions):
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 2)
+        n = len(self.cars)
+        if n + len(cars) > self.capacity:
+            self.grow(max(2 * self.capacity, n + len(cars)))
+
+        for car in cars:
+            self.slot[car] = len(self.cars)
+            self.cars.append(car)
+        self._xy[n:len(self.cars)] = positions
+        self.synced[n:len(self.cars)] = positions
+        self.xy = self._xy[:len(self.cars)]
+
+    def remove(self, cars):
+        # Their positions have to be right before they leave the env
+        self.sync([self.slot[car] for car in cars])
+        for car in cars:
+            i = self.slot.pop(car)
+            last = self.cars.pop()
+            if last is not car:
+                self.cars[i] = last
+                self.slot[last] = i
+                self._xy[i] = self._xy[len(self.cars)]
+                self.synced[i] = self.synced[len(self.cars)]
+        self.xy = self._xy[:len(self.cars)]
+
+    def updateLights(self):
+        '''
+        Copy the light states for the workers if they changed
+        '''
+        lights = self.env.lights
+        if self._lightsVersion != lights.version:
+            self._state[...] = lights.state
+            self._lightsVersion = lights.version
+
+    def apply(self, slots, new):
+        # Moves made on this process, so the env has to be up to date first
+        self.env.sync()
+        super().apply(slots, new)
+        self.synced[slots] = new
+
+    def step(self):
+        n = len(self.cars)
+        if not n:
+            return []
+        self.updateLights()
+        self._rand[:n] = self.model.nprandom.random(n)
+        metrics = self.model.metrics
+        before = self.xy.copy() if metrics.enabled else None
+
+        # Group the cars by band, keeping the slot order inside each band
+        band = np.minimum(self.xy[:, 0] // self.bandRows, self.workers - 1).astype(np.int16)
+        order = np.argsort(band, kind='stable')
+        self._order[:n] = order
+        bounds = np.searchsorted(band[order], np.arange(self.workers + 1))
+        bounds[-1] = n
+
+        busy = []
+        for k, conn in enumerate(self.conns):
+            lo, hi = int(bounds[k]), int(bounds[k + 1])
+            if lo < hi:
+                conn.send(('step', lo, hi, k * self.bandRows, (k + 1) * self.bandRows))
+                busy.append(conn)
+
+        # Handoff of the cars that moved into another band, once every worker
+        # is done writing the occupancy of its own rows
+        arrived = np.concatenate([conn.recv() for conn in busy])
+        layer, counts = self.env.occupancy[CAR], self.env.counts
+        np.add.at(layer, (arrived[:, 0], arrived[:, 1]), 1)
+        np.add.at(counts, (arrived[:, 0], arrived[:, 1]), 1)
+
+        if before is not None:
+            moved = np.flatnonzero((self.xy != before).any(axis=1))
+            metrics.carsMoved(before[moved], self.xy[moved])
+
+        self.env.deferred = self
+        return self.onBorder()
+
+    def sync(self, slots=None):
+        '''
+        Move the agents whose position changed since the last sync between
+        the env cell sets (only the given slots if any)
+        '''
+        slots = np.arange(len(self.cars)) if slots is None else np.asarray(slots, dtype=np.int64)
+        changed = slots[(self.xy[slots] != self.synced[slots]).any(axis=1)]
+        self.env.relink([self.cars[i] for i in changed], self.synced[changed], self.xy[changed])
+        self.synced[changed] = self.xy[changed]
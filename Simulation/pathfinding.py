@@ -1,43 +1,69 @@
 from typing import Tuple, List, Set, Dict, Optional
+from collections import OrderedDict, deque
 import numpy as np
 from constants import *
+from mapindex import MapIndex
+from instrument import Stats
+from hierarchy import ClusterGraph
+from movegraph import MoveGraph
 import heapq
 
 class PathFinder:
-    def __init__(self, road_map: np.ndarray, directions: np.ndarray):
+    def __init__(self, road_map: np.ndarray, directions: np.ndarray, cache_bytes: int = 64 << 20,
+                 index: Optional[MapIndex] = None, rng: Optional[np.random.Generator] = None,
+                 field_admit: int = 2, stats: Optional[Stats] = None, cluster: int = 0,
+                 graphs: Optional[Dict[bool, ClusterGraph]] = None,
+                 moves: Optional[Dict[bool, MoveGraph]] = None):
         self.road_map = road_map
         self.directions = directions
         self.rows, self.cols = road_map.shape
         self.crossing_agents = {}  # Diccionario para almacenar agentes en los cruces
 
+        # Índice de celdas transitables para elegir metas sin recorrer el mapa
+        self.index = index if index is not None else MapIndex(road_map)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.stats = stats if stats is not None else Stats()
+
+        # Caché LRU de campos de distancia por (meta, tipo de agente). Con
+        # cache_bytes = 0 se usa A* en cada consulta
+        self.cache_bytes = cache_bytes
+        self.fields: OrderedDict = OrderedDict()
+        self.cache_used = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+
+        # Construir un campo cuesta más que un A*, así que una meta tiene que
+        # pedirse field_admit veces antes de guardarla; mientras tanto se usa A*
+        self.field_admit = field_admit
+        self.pending: OrderedDict = OrderedDict()
+
+        # Movimientos de cada tipo de agente compilados a arreglos CSR (ver
+        # movegraph.py), compartidos con el movimiento de los coches. Los de
+        # un mismo mapa se pueden pasar en moves
+        self.moves = moves
+        if moves is None:
+            self.moves = {
+                is_pedestrian: MoveGraph.compile(road_map, directions, is_pedestrian)
+                for is_pedestrian in (False, True)
+            }
+
+        # Modo jerárquico: con cluster > 0 las rutas se buscan en un grafo de
+        # clusters de cluster x cluster celdas (ver hierarchy.py) en lugar de
+        # usar campos de distancia o A* sobre todo el mapa. Los grafos ya
+        # construidos del mismo mapa se pueden pasar en graphs
+        self.hierarchy = graphs
+        if graphs is None and cluster > 0:
+            self.hierarchy = {
+                is_pedestrian: ClusterGraph(self.moves[is_pedestrian], is_pedestrian, cluster, self.stats)
+                for is_pedestrian in (False, True)
+            }
+
     def get_valid_neighbors(self, pos: Tuple[int, int], is_pedestrian: bool) -> List[Tuple[int, int]]:
-        x, y = pos
-        neighbors = []
-        
-        # Para peatones, pueden moverse en sidewalks y cruces
-        if is_pedestrian:
-            for dx, dy in [(0, 1), (0, -1), (1, 0), (-1, 0)]:
-                new_x, new_y = x + dx, y + dy
-                if (0 <= new_x < self.rows and 0 <= new_y < self.cols and 
-                    ((self.road_map[new_x, new_y] & SI) == SI or 
-                     (self.road_map[new_x, new_y] & RC) == RC)):
-                    neighbors.append((new_x, new_y))
-        # Para vehículos, seguir las direcciones permitidas
-        else:
-            dir = self.directions[x, y]
-            if dir & ND and x > 0 and (self.road_map[x-1, y] & RO) == RO:
-                neighbors.append((x-1, y))
-            if dir & SD and x < self.rows-1 and (self.road_map[x+1, y] & RO) == RO:
-                neighbors.append((x+1, y))
-            if dir & ED and y < self.cols-1 and (self.road_map[x, y+1] & RO) == RO:
-                neighbors.append((x, y+1))
-            if dir & WD and y > 0 and (self.road_map[x, y-1] & RO) == RO:
-                neighbors.append((x, y-1))
-                
-        return neighbors
-
-    
-    
+        # Peatones: sidewalks y cruces vecinos. Vehículos: las direcciones
+        # permitidas, sin los cambios de carril
+        return self.moves[bool(is_pedestrian)].neighbors(pos)
+
     def is_crossing(self, pos: Tuple[int, int]) -> bool:
         # Aquí se puede verificar si la celda es un cruce (en tu caso, podría ser un cruce de banqueta)
         return (self.road_map[pos[0], pos[1]] & RC) == RC
@@ -56,6 +82,24 @@ class PathFinder:
         return abs(a[0] - b[0]) + abs(a[1] - b[1])  # Manhattan distance
 
     def find_path(self, start: Tuple[int, int], goal: Tuple[int, int], is_pedestrian: bool) -> List[Tuple[int, int]]:
+        """
+        Camino más corto de start a goal (ambos incluidos), o [] si no hay.
+        Usa el grafo de clusters en modo jerárquico y si no el campo de
+        distancia de la meta si el caché está habilitado
+        """
+        if start == goal:
+            return []
+        if self.hierarchy is not None:
+            return self.hierarchy[bool(is_pedestrian)].find_path(start, goal, self.stats)
+        if self.cache_bytes <= 0:
+            return self.find_path_astar(start, goal, is_pedestrian)
+
+        field = self.distance_field(goal, is_pedestrian)
+        if field is None:
+            return self.find_path_astar(start, goal, is_pedestrian)
+        return self.follow_field(field, start, goal, is_pedestrian)
+
+    def find_path_astar(self, start: Tuple[int, int], goal: Tuple[int, int], is_pedestrian: bool) -> List[Tuple[int, int]]:
         """
         Implementa A* pathfinding
         """
@@ -66,9 +110,11 @@ class PathFinder:
         heapq.heappush(frontier, (0, start))
         came_from = {start: None}
         cost_so_far = {start: 0}
+        expanded = 0
 
         while frontier:
             current = heapq.heappop(frontier)[1]
+            expanded += 1
 
             if current == goal:
                 break
@@ -81,6 +127,9 @@ class PathFinder:
                     heapq.heappush(frontier, (priority, next_pos))
                     came_from[next_pos] = current
 
+        self.stats.count('astar.calls')
+        self.stats.count('astar.expanded', expanded)
+
         # Reconstruir el camino
         if goal not in came_from:
             return []
@@ -93,23 +142,164 @@ class PathFinder:
         path.reverse()
         return path
 
+    def repair_path(self, path: List[Tuple[int, int]], blocked, is_pedestrian: bool,
+                    lookahead: int = 8, max_expanded: int = 64) -> List[Tuple[int, int]]:
+        """
+        Rodeo local cuando path[1] está bloqueado: A* acotado desde path[0]
+        hasta alguna de las siguientes `lookahead` celdas del camino, sin
+        pasar por celdas donde blocked(celda) es verdadero. Regresa el camino
+        reparado (la misma meta) o [] si no hay rodeo y hay que replanear
+        """
+        self.stats.count('repair.calls')
+        clock = self.stats.clock()
+        start = path[0]
+        targets = {pos: i for i, pos in enumerate(path[2:2 + lookahead], 2) if pos != start}
+        if not targets:
+            return []
+
+        def h(pos):
+            return min(self.heuristic(pos, t) for t in targets)
+
+        frontier = [(h(start), 0, start)]
+        came_from = {start: None}
+        cost_so_far = {start: 0}
+        expanded = 0
+        end = None
+
+        while frontier and expanded < max_expanded:
+            _, cost, current = heapq.heappop(frontier)
+            if cost > cost_so_far[current]:
+                continue
+            expanded += 1
+
+            if current in targets:
+                end = current
+                break
+
+            for next_pos in self.get_valid_neighbors(current, is_pedestrian):
+                if blocked(next_pos):
+                    continue
+                new_cost = cost + 1
+                if next_pos not in cost_so_far or new_cost < cost_so_far[next_pos]:
+                    cost_so_far[next_pos] = new_cost
+                    heapq.heappush(frontier, (new_cost + h(next_pos), new_cost, next_pos))
+                    came_from[next_pos] = current
+
+        self.stats.count('repair.expanded', expanded)
+        self.stats.record('repair', clock)
+        if end is None:
+            return []
+
+        detour = []
+        current = end
+        while current is not None:
+            detour.append(current)
+            current = came_from[current]
+        detour.reverse()
+        self.stats.count('repair.found')
+        return detour + path[targets[end] + 1:]
+
+    def distance_field(self, goal: Tuple[int, int], is_pedestrian: bool) -> Optional[np.ndarray]:
+        """
+        Campo de distancias (pasos hasta la meta, -1 si no se llega) desde
+        el caché, o construido con un BFS inverso desde la meta. Regresa None
+        si el campo no cabe en el caché o la meta aún no se ha pedido
+        suficientes veces
+        """
+        key = (int(goal[0]), int(goal[1]), bool(is_pedestrian))
+        field = self.fields.get(key)
+        if field is not None:
+            self.cache_hits += 1
+            self.fields.move_to_end(key)
+            return field
+
+        self.cache_misses += 1
+        size = self.rows * self.cols * np.dtype(np.int32).itemsize
+        if size > self.cache_bytes:
+            return None
+
+        requests = self.pending.pop(key, 0) + 1
+        if requests < self.field_admit:
+            self.pending[key] = requests
+            if len(self.pending) > 1 << 16:
+                self.pending.popitem(last=False)
+            return None
+
+        clock = self.stats.clock()
+        field = self.build_field(key[:2], is_pedestrian)
+        self.stats.record('field.build', clock)
+        while self.fields and self.cache_used + size > self.cache_bytes:
+            _, old = self.fields.popitem(last=False)
+            self.cache_used -= old.nbytes
+            self.cache_evictions += 1
+        self.fields[key] = field
+        self.cache_used += size
+        return field
+
+    def build_field(self, goal: Tuple[int, int], is_pedestrian: bool) -> np.ndarray:
+        """
+        BFS inverso desde la meta: para cada celda, el número de pasos del
+        camino más corto hasta la meta
+        """
+        rows, cols = self.rows, self.cols
+        dist = np.full(rows * cols, -1, dtype=np.int32)
+        graph = self.moves[bool(is_pedestrian)]
+
+        start = goal[0] * cols + goal[1]
+        dist[start] = 0
+        queue = deque([start])
+        while queue:
+            v = queue.popleft()
+            d = dist[v] + 1
+            # Celdas u desde las que v es un vecino válido (aristas u -> v).
+            # Solo hay aristas hacia celdas transitables
+            for u in graph.sources(v):
+                if dist[u] < 0:
+                    dist[u] = d
+                    queue.append(u)
+
+        return dist.reshape(rows, cols)
+
+    def follow_field(self, field: np.ndarray, start: Tuple[int, int], goal: Tuple[int, int], is_pedestrian: bool) -> List[Tuple[int, int]]:
+        """
+        Reconstruye el camino bajando por el campo de distancias, en
+        O(largo del camino)
+        """
+        current = (int(start[0]), int(start[1]))
+        if field[current] < 0:
+            return []
+
+        path = [current]
+        while field[current] > 0:
+            d = field[current] - 1
+            for next_pos in self.get_valid_neighbors(current, is_pedestrian):
+                if field[next_pos] == d:
+                    current = next_pos
+                    break
+            else:
+                return []
+            path.append(current)
+        return path
+
+    def cache_info(self) -> Dict[str, float]:
+        """
+        Contadores del caché de campos de distancia
+        """
+        queries = self.cache_hits + self.cache_misses
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'evictions': self.cache_evictions,
+            'hit_rate': self.cache_hits / queries if queries else 0.0,
+            'entries': len(self.fields),
+            'bytes': self.cache_used,
+            'capacity': self.cache_bytes,
+        }
+
     def find_random_valid_goal(self, start: Tuple[int, int], is_pedestrian: bool) -> Tuple[int, int]:
         """
         Encuentra un destino válido aleatorio basado en el tipo de agente
         """
-        valid_positions = []
-        for x in range(self.rows):
-            for y in range(self.cols):
-                if is_pedestrian and (self.road_map[x, y] & SI) == SI:
-                    valid_positions.append((x, y))
-                elif not is_pedestrian and (self.road_map[x, y] & RO) == RO:
-                    valid_positions.append((x, y))
-        
-        # Filtrar posiciones muy cercanas al inicio
-        valid_positions = [pos for pos in valid_positions 
-                         if self.heuristic(start, pos) > 5]  # Distancia mínima
-        
-        if not valid_positions:
-            return start
-            
-        return valid_positions[np.random.randint(len(valid_positions))]
+        # Distancia mínima de 5 (Manhattan) al inicio
+        goal = self.index.sample(self.index.tiles(is_pedestrian), self.rng, start, minDist=5)
+        return start if goal is None else goal
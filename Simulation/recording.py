@@ -0,0 +1,235 @@
+'''
+Recorded runs.
+
+A run is two append-only files next to each other:
+
+    NAME.run  binary frames (see binframe.py) one per step: a keyframe every
+              `keyEvery` steps and delta frames in between. Only the first
+              keyframe carries the grid
+    NAME.idx  INDEX_DTYPE records with the offset, size and kind of every
+              frame, written after the frame itself
+
+Both are memory mapped for reading, so a Replay can seek to any step by
+loading the keyframe before it and applying the deltas up to it, without a
+CityModel. A run that is still being recorded can be replayed too.
+'''
+import os
+import numpy as np
+
+import binframe
+from binframe import KEY, DELTA, AGENT_DTYPE, LIGHT_DTYPE, LIGHT_NAMES
+from messages import SimState, KeyFrame, DeltaFrame, DeltaEncoder
+
+INDEX_DTYPE = np.dtype({
+    'names': ['offset', 'size', 'kind'],
+    'formats': ['<u8', '<u4', 'u1'],
+    'offsets': [0, 8, 12],
+    'itemsize': 16,
+})
+
+class Recorder:
+    '''
+    Appends the state of a model to a run file every time `record` is called
+    '''
+    def __init__(self, path: str, keyEvery=100):
+        self.path = path
+        self.keyEvery = keyEvery
+        self.encoder = DeltaEncoder()
+        self.frames = 0
+        self.data = open(path + '.run', 'xb')
+        self.index = open(path + '.idx', 'xb')
+        self.offset = 0
+
+    def record(self, model):
+        if self.frames % self.keyEvery == 0:
+            self.encoder.reset()
+        frame = self.encoder.encode(model)
+
+        if frame.frame == 'key':
+            # The grid never changes so it is only stored once
+            grid = model.env.road if self.frames == 0 else None
+            data = binframe.pack(KEY, frame.seq, frame.dims, grid, agents=frame.agents, lights=frame.lights)
+        else:
+            data = binframe.encode(frame, model)
+
+        self.data.write(data)
+        self.data.flush()
+        entry = np.array([(self.offset, len(data), KEY if frame.frame == 'key' else DELTA)], dtype=INDEX_DTYPE)
+        self.index.write(entry.tobytes())
+        self.index.flush()
+
+        self.offset += len(data)
+        self.frames += 1
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+class RunFile:
+    '''
+    Read-only view of a run file. `refresh` picks up the frames recorded
+    since it was opened
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        size = os.path.getsize(self.path + '.idx') // INDEX_DTYPE.itemsize
+        self.index = np.memmap(self.path + '.idx', dtype=INDEX_DTYPE, mode='r', shape=(size,)) if size else np.empty(0, INDEX_DTYPE)
+        self.data = np.memmap(self.path + '.run', dtype=np.uint8, mode='r') if size else np.empty(0, np.uint8)
+        self.keys = np.flatnonzero(self.index['kind'] == KEY)
+
+        # The grid is in the first frame
+        if size and not hasattr(self, 'grid'):
+            first = self.frame(0)
+            self.dims, self.grid = first['dims'], np.array(first['grid'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def raw(self, t: int):
+        '''
+        Bytes of the frame recorded at step `t`
+        '''
+        entry = self.index[t]
+        return self.data[int(entry['offset']):int(entry['offset']) + int(entry['size'])]
+
+    def frame(self, t: int) -> dict:
+        return binframe.decode(self.raw(t))
+
+class Replay:
+    '''
+    Position of one viewer in a run and the state of the simulation at that
+    step, rebuilt from the frames
+    '''
+    def __init__(self, run: RunFile):
+        self.run = run
+        self.t = -1
+        self.agents = np.empty(0, dtype=AGENT_DTYPE)  # Sorted by id
+        self.lights = {}
+        # Step of the last frame sent, to know if a delta frame is enough
+        self.sent = None
+        # Ids of the agents in the last full frame sent, to tell the client
+        # which ones are gone however many steps it skipped
+        self.shown = None
+
+    def seek(self, t: int):
+        '''
+        Move to step `t` (clamped to the recorded steps)
+        '''
+        if t >= len(self.run):
+            self.run.refresh()
+        if not len(self.run):
+            return
+        t = max(0, min(t, len(self.run) - 1))
+
+        # Only go back to a keyframe if it is closer than where we are
+        key = self.run.keys[np.searchsorted(self.run.keys, t, side='right') - 1]
+        if not (key <= self.t <= t):
+            self.load(key)
+        while self.t < t:
+            self.apply(self.t + 1)
+        self.sent = None
+
+    def advance(self, n: int):
+        '''
+        Move `n` steps forward. Returns False at the end of the run
+        '''
+        if self.t + n >= len(self.run):
+            self.run.refresh()
+        target = min(self.t + n, len(self.run) - 1)
+        if target <= self.t:
+            return False
+        while self.t < target:
+            self.apply(self.t + 1)
+        return True
+
+    def load(self, t: int):
+        frame = self.run.frame(t)
+        self.agents = np.sort(frame['agents'], order='id')
+        self.lights = { int(l['id']): int(l['state']) for l in frame['lights'] }
+        self.t = t
+
+    def apply(self, t: int):
+        frame = self.run.frame(t)
+        if frame['kind'] == KEY:
+            self.load(t)
+            return
+
+        agents = self.agents
+        if len(frame['deleted']):
+            agents = agents[~np.isin(agents['id'], frame['deleted'])]
+        if len(frame['agents']):
+            agents = np.concatenate([agents, frame['agents']])
+            agents = agents[np.argsort(agents['id'], kind='stable')]
+        else:
+            agents = agents.copy()
+
+        moved = frame['moved']
+        at = np.searchsorted(agents['id'], moved['id'])
+        agents['x'][at] = moved['x']
+        agents['y'][at] = moved['y']
+        goals = frame['goals']
+        at = np.searchsorted(agents['id'], goals['id'])
+        agents['gx'][at] = goals['x']
+        agents['gy'][at] = goals['y']
+
+        self.lights.update((int(l['id']), int(l['state'])) for l in frame['lights'])
+        self.agents = agents
+        self.t = t
+
+    def lightRecords(self) -> np.ndarray:
+        return np.array(list(self.lights.items()), dtype=LIGHT_DTYPE) if self.lights else np.empty(0, LIGHT_DTYPE)
+
+    def lightList(self) -> list:
+        return [{ 'id': ID, 'state': LIGHT_NAMES[code] } for ID, code in self.lights.items()]
+
+    def encode(self, binary=False, delta=False) -> bytes:
+        '''
+        Frame for the current step in the format a client asked for. Delta
+        clients that got the previous step get the recorded delta frame and
+        everyone else the whole state
+        '''
+        run, t = self.run, self.t
+        sequential = self.sent is not None and self.sent == t - 1
+        self.sent = t
+        seq = t + 1
+
+        if delta and sequential and run.index[t]['kind'] == DELTA:
+            if binary:
+                return bytes(run.raw(t))
+            frame = run.frame(t)
+            return DeltaFrame(
+                frame='delta',
+                seq=seq,
+                spawned=frame['agents'],
+                moved=frame['moved'].tolist(),
+                goals=[[i] + ([None] if x < 0 else [x, y]) for i, x, y in frame['goals'].tolist()],
+                deleted=frame['deleted'].tolist(),
+                lights=[{ 'id': int(l['id']), 'state': LIGHT_NAMES[int(l['state'])] } for l in frame['lights']],
+            ).toJSON().encode('utf-8')
+
+        if delta:
+            if binary:
+                return binframe.pack(KEY, seq, run.dims, run.grid, agents=self.agents, lights=self.lightRecords())
+            return KeyFrame(
+                frame='key',
+                seq=seq,
+                dims=run.dims,
+                grid=run.grid,
+                agents=self.agents,
+                lights=self.lightList(),
+            ).toJSON().encode('utf-8')
+
+        ids = self.agents['id']
+        deleted = [] if self.shown is None else np.setdiff1d(self.shown, ids, assume_unique=True).tolist()
+        self.shown = ids
+        if binary:
+            return binframe.pack(binframe.FULL, 0, run.dims, run.grid, agents=self.agents, deleted=deleted)
+        return SimState(
+            dims=run.dims,
+            agents=self.agents,
+            grid=run.grid,
+            deleted=deleted,
+        ).toJSON().encode('utf-8')
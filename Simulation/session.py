@@ -0,0 +1,716 @@
+import asyncio
+import json
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from concurrent.futures import Executor
+
+import numpy as np
+
+import binframe
+from clock import SimClock, Snapshot
+from instrument import Stats
+from messages import Commands as cmds
+from messages import SimState, DeltaEncoder, Viewport, ViewState, ViewEncoder
+from model import CityModel, params
+from recording import Recorder, RunFile, Replay
+
+# Frames are not queued for observers with more than this many bytes pending
+MAX_PENDING = 1 << 22
+
+def framed(payload: bytes) -> bytes:
+    # Prefix the package with its length in big-endian format (network)
+    return struct.pack('>I', len(payload)) + payload
+
+class CommandReader:
+    '''
+    Splits the incoming bytes into newline terminated commands, keeping the
+    start of an unfinished one until the rest arrives
+    '''
+    def __init__(self):
+        self.buffer = b''
+
+    def feed(self, data: bytes) -> list[str]:
+        *lines, self.buffer = (self.buffer + data).split(b'\n')
+        return [line.decode('utf-8').strip() for line in lines if line.strip()]
+
+class ModelPool:
+    '''
+    Keeps up to `size` models set up with `parameters` on a background
+    thread, so starting a simulation only has to take one
+    '''
+    def __init__(self, parameters: dict, size: int):
+        self.params = parameters
+        self.models = queue.Queue(maxsize=size)
+        self.hits = 0
+        self.misses = 0
+        threading.Thread(target=self.fill, name='model-pool', daemon=True).start()
+
+    def fill(self):
+        while True:
+            model = CityModel(self.params)
+            model.setup()
+            # Blocks while the pool is full
+            self.models.put(model)
+
+    def take(self) -> CityModel:
+        '''
+        A model ready to step or None if the pool is empty
+        '''
+        try:
+            model = self.models.get_nowait()
+        except queue.Empty:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return model
+
+    def load(self) -> dict:
+        return { 'ready': self.models.qsize(), 'hits': self.hits, 'misses': self.misses }
+
+class Simulation:
+    '''
+    A CityModel with the connections watching it. The model is only touched
+    from executor threads while holding `lock`, so one slow simulation does not
+    block the event loop or the other simulations
+    '''
+    def __init__(self, name: str, parameters: dict, record: str = None, keyEvery=100, pool: 'ModelPool' = None):
+        self.name = name
+        self.model = CityModel(parameters)
+        # Models already set up, so a start does not wait for the setup
+        self.pool = pool
+        # Directory to record the runs of this simulation to, if any
+        self.record = record
+        self.keyEvery = keyEvery
+        self.recorder: Recorder = None
+        # Created here so the model keeps it across restarts
+        self.stats = self.model.stats = Stats(enabled=parameters.get('stats', False))
+        self.lock = asyncio.Lock()
+        self.connections: set['Connection'] = set()
+        self.started = False
+        # Steps the model on its own thread while set, see clock.py
+        self.clock: SimClock = None
+
+        # Load counters
+        self.created = time.monotonic()
+        self.steps = 0
+        self.busy = 0.0
+        # Agents deleted in the steps of the last call to step
+        self.deleted: list = []
+
+    def setup(self):
+        start = time.perf_counter()
+        model = self.pool.take() if self.pool is not None else None
+        if model is not None:
+            if getattr(self.model, 'engine', None) is not None:
+                self.model.engine.close()
+            model.attachStats(self.stats)
+            self.model = model
+        else:
+            self.model.setup()
+        self.started = True
+        self.deleted = []
+        if self.record:
+            # Every restart is a new run
+            if self.recorder is not None:
+                self.recorder.close()
+            self.recorder = Recorder(self.runPath(), self.keyEvery)
+            self.recorder.record(self.model)
+        self.busy += time.perf_counter() - start
+
+    def step(self, n=1):
+        start = time.perf_counter()
+        deleted = []
+        for _ in range(n):
+            self.model.step()
+            deleted += self.model.deleted
+            if self.recorder is not None:
+                self.recorder.record(self.model)
+        self.deleted = deleted
+        self.steps += n
+        self.busy += time.perf_counter() - start
+
+    def runPath(self) -> str:
+        name = re.sub(r'[^\w.-]', '_', self.name) + time.strftime('-%Y%m%d-%H%M%S')
+        path, n = os.path.join(self.record, name), 1
+        while os.path.exists(path + '.run'):
+            n += 1
+            path = os.path.join(self.record, f'{name}-{n}')
+        return path
+
+    def agentIds(self) -> np.ndarray:
+        return np.sort(np.fromiter((agent.id for agent in self.model.agents), dtype='<u4', count=len(self.model.agents)))
+
+    def startClock(self, tick: float):
+        # The full frames of the clock list what is gone since the frame
+        # every client got last
+        ids = self.agentIds()
+        for conn in self.connections:
+            conn.shown = ids
+        self.clock = SimClock(self, tick, asyncio.get_running_loop())
+
+    def stopClock(self, wait=True):
+        '''
+        Back to stepping on commands. Without `wait` the clock finishes its
+        current step on its own
+        '''
+        clock, self.clock = self.clock, None
+        clock.stop(wait)
+        if wait:
+            # The next full frames also list what is gone since the last
+            # snapshot sent
+            ids = self.agentIds()
+            for conn in self.connections:
+                if conn.shown is not None:
+                    conn.missed += np.setdiff1d(conn.shown, ids, assume_unique=True).tolist()
+                    conn.shown = None
+
+    def close(self):
+        if self.clock is not None:
+            self.stopClock(wait=False)
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def load(self) -> dict:
+        alive = time.monotonic() - self.created
+        return {
+            'name': self.name,
+            'connections': len(self.connections),
+            'agents': len(self.model.agents) if self.started else 0,
+            'steps': self.steps,
+            'stepsPerSec': self.steps / alive if alive else 0.0,
+            'meanStepMs': self.busy / self.steps * 1e3 if self.steps else 0.0,
+            # Fraction of wall time this simulation kept a core busy
+            'busy': self.busy / alive if alive else 0.0,
+            'recording': os.path.basename(self.recorder.path) if self.recorder else None,
+            **({ 'clock': self.clock.load() } if self.clock is not None else {}),
+            **({ 'stats': self.stats.snapshot() } if self.stats.enabled else {}),
+        }
+
+class Registry:
+    '''
+    Every simulation the server is running, shared ones by name
+    '''
+    def __init__(self, executor: Executor, parameters: dict = params, record: str = None, keyEvery=100, pool=0):
+        self.executor = executor
+        self.params = parameters
+        # Models set up ahead of the start commands
+        self.pool = ModelPool(parameters, pool) if pool > 0 else None
+        # Runs are recorded to and replayed from this directory
+        self.record = record
+        self.keyEvery = keyEvery
+        self.runs: dict[str, RunFile] = {}
+        self.shared: dict[str, Simulation] = {}
+        self.simulations: set[Simulation] = set()
+        self.connections = 0
+        self.started = time.monotonic()
+        self.cpuStart = time.process_time()
+
+    def create(self, name: str) -> Simulation:
+        sim = Simulation(name, self.params, self.record, self.keyEvery, self.pool)
+        self.simulations.add(sim)
+        return sim
+
+    def release(self, sim: Simulation):
+        # Forget simulations nobody is watching anymore
+        if not sim.connections:
+            sim.close()
+            self.simulations.discard(sim)
+            if self.shared.get(sim.name) is sim:
+                del self.shared[sim.name]
+
+    def listRuns(self) -> list:
+        if not self.record:
+            return []
+        return sorted(name[:-4] for name in os.listdir(self.record) if name.endswith('.idx'))
+
+    def openRun(self, name: str) -> RunFile:
+        '''
+        Recorded run by name, shared between all its viewers
+        '''
+        if name not in self.listRuns():
+            return None
+        if name not in self.runs:
+            self.runs[name] = RunFile(os.path.join(self.record, name))
+        return self.runs[name]
+
+    def load(self) -> dict:
+        wall = time.monotonic() - self.started
+        return {
+            'connections': self.connections,
+            'sessions': len(self.simulations),
+            # Average number of cores the process kept busy since it started
+            'cpu': (time.process_time() - self.cpuStart) / wall if wall else 0.0,
+            'simulations': [sim.load() for sim in self.simulations],
+            **({ 'pool': self.pool.load() } if self.pool is not None else {}),
+        }
+
+    async def run(self, fn, *args):
+        '''
+        Run `fn` in the executor. A cancelled caller still waits for it to
+        return, since the thread can't be stopped and the lock of the caller
+        must not be released while it is still touching the model
+        '''
+        call = asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        try:
+            return await asyncio.shield(call)
+        except asyncio.CancelledError:
+            await asyncio.wait([call])
+            raise
+
+class Connection:
+    '''
+    Protocol state of one client: the simulation it drives or observes and
+    how it wants its frames encoded
+    '''
+    def __init__(self, registry: Registry, writer: asyncio.StreamWriter, name: str):
+        self.name = name
+        self.registry = registry
+        self.writer = writer
+        # Set when the client asks for delta frames instead of the full state
+        self.encoder: DeltaEncoder = None
+        # Frames are sent as JSON unless the client asks for binary frames
+        self.binary = False
+        # Part of the map the client wants frames of (None for all of it)
+        self.view: Viewport = None
+        # Only the owner of a simulation can start or step it
+        self.owner = True
+        self.sim = registry.create(name)
+        self.sim.connections.add(self)
+
+        # Streaming state for 'run': steps per second (0 means as fast as the
+        # client can take them) and the task doing it
+        self.rate = 10.0
+        self.streaming: asyncio.Task = None
+        # Set while the client watches a recorded run instead of its simulation
+        self.replay: Replay = None
+        # Agents deleted since the last full frame sent to the client, which
+        # can cover several steps, and while the clock runs the ids of the
+        # agents in the last snapshot sent as a full frame
+        self.missed: list = []
+        self.shown: np.ndarray = None
+
+        # Task pushing the snapshots of the clock, the last one sent and how
+        # many were sent and skipped since the first one
+        self.pushing: asyncio.Task = None
+        self.last: Snapshot = None
+        self.sent = 0
+        self.skipped = 0
+        self.firstSent = 0.0
+
+    def frame(self) -> bytes:
+        '''
+        Encoded state of the simulation (runs in the executor)
+        '''
+        model = self.sim.model
+        stats = self.sim.stats
+        clock = stats.clock()
+        if self.encoder is not None:
+            state = self.encoder.encode(model)
+        else:
+            state = SimState.fromModel(model) if self.view is None else ViewState.fromModel(model, self.view)
+            # Recycled agents keep their id, so some of the agents deleted
+            # since the last frame can be back by now
+            deleted = self.missed
+            if deleted:
+                deleted = np.setdiff1d(deleted, self.sim.agentIds()).tolist()
+            state.deleted, self.missed = deleted, []
+        if self.binary:
+            data = framed(binframe.encode(state, model))
+        else:
+            data = framed(state.toJSON().encode('utf-8'))
+        stats.record('encode', clock)
+        stats.count('frames')
+        stats.count('bytesSent', len(data))
+        return data
+
+    def clockFrame(self, snap: Snapshot) -> bytes:
+        '''
+        Encoded snapshot of the clock, a delta against the last one sent in
+        delta mode (runs in the executor)
+        '''
+        stats = self.sim.stats
+        clock = stats.clock()
+        last, self.last = self.last, snap
+        if last is None:
+            self.sent = self.skipped = 0
+            self.firstSent = time.monotonic()
+        else:
+            self.skipped += snap.seq - last.seq - 1
+        self.sent += 1
+
+        encoder = self.encoder
+        if encoder is None:
+            # Agents the client can still have that are gone: the ones it was
+            # not told about yet and the ones in the last snapshot it got.
+            # Recycled agents keep their id, so some of the first can be back
+            sent = np.asarray(self.missed, dtype='<u4')
+            if self.shown is not None:
+                sent = np.concatenate([sent, self.shown])
+            deleted = snap.gone(sent)
+            self.missed, self.shown = [], snap.agents['id']
+            data = framed(snap.full(self.binary, self.view, deleted))
+        else:
+            encoder.seq += 1
+            if encoder.needKey or last is None:
+                encoder.needKey = False
+                data = framed(snap.key(encoder.seq, self.binary, self.view))
+            else:
+                data = framed(snap.delta(last, encoder.seq, self.binary, self.view))
+        stats.record('encode', clock)
+        stats.count('frames')
+        stats.count('bytesSent', len(data))
+        return data
+
+    async def push(self):
+        '''
+        Send the latest snapshot of the clock every time the client is ready
+        for another frame, skipping the ones published meanwhile
+        '''
+        try:
+            while (snap := await self.nextSnapshot()) is not None:
+                await self.send(await self.registry.run(self.clockFrame, snap))
+        except ConnectionError:
+            pass
+        self.pushing = None
+
+    async def nextSnapshot(self) -> Snapshot:
+        '''
+        Wait for a snapshot newer than the last one sent, from whichever clock
+        the simulation runs by then. None if it stops running one
+        '''
+        while self.sim.clock is not None:
+            snap = await self.sim.clock.next(self.last)
+            if snap is not None:
+                return snap
+        return None
+
+    def startPushing(self):
+        self.last = None
+        if self.pushing is None:
+            self.pushing = asyncio.create_task(self.push())
+
+    async def stopPushing(self):
+        pushing, self.pushing = self.pushing, None
+        if pushing is not None:
+            pushing.cancel()
+            await asyncio.wait([pushing])
+        # What the client knows came from snapshots, so start over
+        if self.last is not None and self.encoder is not None:
+            self.encoder.reset()
+        self.last = None
+
+    def clockLoad(self) -> dict:
+        alive = time.monotonic() - self.firstSent
+        return {
+            'name': self.name,
+            'mode': 'push' if self.pushing is not None else 'pull',
+            'frames': self.sent,
+            'framesPerSec': self.sent / alive if alive else 0.0,
+            'skipped': self.skipped,
+        }
+
+    async def stopClock(self):
+        sim = self.sim
+        for conn in list(sim.connections):
+            await conn.stopPushing()
+        await self.registry.run(sim.stopClock)
+
+    async def betweenSteps(self, fn, *args):
+        '''
+        Run `fn` on the model between two steps: on the clock thread while
+        the clock runs, or in the executor holding the lock
+        '''
+        sim = self.sim
+        async with sim.lock:
+            if sim.clock is not None:
+                return await sim.clock.call(fn, *args)
+            return await self.registry.run(fn, *args)
+
+    async def send(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def broadcast(self):
+        '''
+        Send the current state of the simulation to everyone watching it
+        '''
+        frames = await self.registry.run(self._frames)
+        for conn, data in frames:
+            if conn is self:
+                await self.send(data)
+            else:
+                conn.writer.write(data)
+
+    def _frames(self):
+        frames = []
+        for conn in list(self.sim.connections):
+            if conn.encoder is None:
+                conn.missed += self.sim.deleted
+            # Observers that can't keep up skip frames, which is fine for delta
+            # encoders since they diff against what the client already has and
+            # full frames since they keep the deletions until one is sent
+            if conn is not self and conn.writer.transport.get_write_buffer_size() > MAX_PENDING:
+                continue
+            frames.append((conn, conn.frame()))
+        return frames
+
+    async def advance(self, steps: int, every: int = 0):
+        '''
+        Step the simulation `steps` times sending a frame every `every` steps
+        (or only the last one). Returns the number of steps done
+        '''
+        sim = self.sim
+        every = every if every > 0 else steps
+        done = 0
+        if self.replay is not None:
+            while done < steps:
+                n = min(every, steps - done)
+                if not await self.registry.run(self.replay.advance, n):
+                    break
+                done += n
+                await self.send(await self.registry.run(self.replayFrame))
+            return done
+
+        async with sim.lock:
+            while done < steps:
+                n = min(every, steps - done)
+                await self.registry.run(sim.step, n)
+                done += n
+                await self.broadcast()
+        return done
+
+    async def stream(self):
+        '''
+        Step and send frames at `rate` steps per second until stopped. Waiting
+        for the socket to drain keeps a slow client from piling up frames
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        try:
+            while True:
+                if not await self.advance(1):
+                    # End of a replay, wait for more steps to be recorded
+                    await asyncio.sleep(0.1)
+                elif self.rate > 0:
+                    # Don't try to catch up on more than a second of lag
+                    deadline = max(deadline + 1 / self.rate, loop.time() - 1)
+                    await asyncio.sleep(max(0, deadline - loop.time()))
+        except ConnectionError:
+            self.streaming = None
+
+    def replayFrame(self) -> bytes:
+        return framed(self.replay.encode(self.binary, self.encoder is not None))
+
+    async def stop(self):
+        '''
+        Stop streaming or being pushed snapshots. Returns once the step or
+        frame in progress is done, so the next command has the model to itself
+        '''
+        streaming, self.streaming = self.streaming, None
+        if streaming is not None:
+            streaming.cancel()
+            await asyncio.wait([streaming])
+        await self.stopPushing()
+
+    async def close(self):
+        await self.stop()
+        self.detach()
+
+    async def attach(self, sim: Simulation, owner: bool):
+        await self.stop()
+        self.detach()
+        self.sim = sim
+        self.owner = owner
+        self.missed, self.shown = [], None
+        sim.connections.add(self)
+        if self.encoder is not None:
+            self.encoder.reset()
+
+    def detach(self):
+        self.sim.connections.discard(self)
+        self.registry.release(self.sim)
+
+    async def onMessage(self, msg: str):
+        if not msg.split():
+            return
+        command, *args = msg.split()
+        command = command.lower()
+        sim = self.sim
+
+        if command in (cmds.BINARY.value, cmds.JSON.value):
+            self.binary = command == cmds.BINARY.value
+
+        elif command == cmds.DELTA.value:
+            # The next frame will be a keyframe
+            self.encoder = DeltaEncoder() if self.view is None else ViewEncoder(self.view)
+
+        elif command == cmds.VIEW.value and self.replay is None and sim.started:
+            # view x0 y0 x1 y1 [margin] or view off: frames of part of the map
+            if args and args[0] == 'off':
+                self.view = None
+            elif len(args) >= 4:
+                x0, y0, x1, y1 = (int(a) for a in args[:4])
+                margin = int(args[4]) if len(args) > 4 else 0
+                self.view = Viewport(x0, y0, x1, y1, margin, sim.model.env.shape)
+            else:
+                raise ValueError(msg)
+            if self.encoder is not None:
+                # Starts over with a keyframe of the new view
+                seq = self.encoder.seq
+                self.encoder = DeltaEncoder() if self.view is None else ViewEncoder(self.view)
+                self.encoder.seq = seq
+            if sim.clock is None:
+                async with sim.lock:
+                    await self.send(await self.registry.run(self.frame))
+
+        elif command == cmds.START.value and self.owner:
+            # Back to the live simulation
+            await self.stop()
+            self.replay = None
+            async with sim.lock:
+                clock = sim.clock
+                if clock is not None:
+                    pushed = [conn for conn in sim.connections if conn.pushing is not None]
+                    await self.stopClock()
+                await self.registry.run(sim.setup)
+                for conn in sim.connections:
+                    conn.missed = []
+                    if conn.encoder is not None:
+                        conn.encoder.reset()
+                await self.broadcast()
+                # A running clock keeps running on the new simulation
+                if clock is not None:
+                    sim.startClock(clock.tick)
+                    for conn in pushed:
+                        conn.startPushing()
+
+        elif command == cmds.STEP.value and self.replay is not None:
+            steps = int(args[0]) if args else 1
+            every = int(args[1]) if len(args) > 1 else 0
+            await self.advance(max(steps, 1), every)
+
+        elif command == cmds.STEP.value and sim.clock is not None:
+            # Pull the next snapshot of the clock instead of stepping, or the
+            # current state if the clock stops meanwhile
+            snap = await self.nextSnapshot()
+            if snap is not None:
+                await self.send(await self.registry.run(self.clockFrame, snap))
+            else:
+                async with sim.lock:
+                    await self.send(await self.registry.run(self.frame))
+
+        elif command == cmds.STEP.value and self.owner and sim.started:
+            # step [N [k]]: advance N steps sending every k-th frame
+            steps = int(args[0]) if args else 1
+            every = int(args[1]) if len(args) > 1 else 0
+            await self.advance(max(steps, 1), every)
+
+        elif command == cmds.RUN.value and sim.clock is not None and self.replay is None:
+            # Get pushed the latest snapshots of the clock
+            self.startPushing()
+
+        elif command == cmds.RUN.value and (self.replay is not None or self.owner and sim.started):
+            if args:
+                self.rate = float(args[0])
+            if self.streaming is None:
+                self.streaming = asyncio.create_task(self.stream())
+
+        elif command == cmds.RATE.value and args:
+            self.rate = float(args[0])
+
+        elif command == cmds.CLOCK.value and args and args[0] == 'off' and self.owner:
+            # Back to stepping on commands
+            async with sim.lock:
+                if sim.clock is not None:
+                    await self.stopClock()
+
+        elif command == cmds.CLOCK.value and self.owner and sim.started and self.replay is None:
+            # clock [tick]: step on a thread of its own at tick steps per
+            # second (0 for as fast as possible)
+            tick = float(args[0]) if args else 0.0
+            if sim.clock is not None:
+                sim.clock.tick = tick
+            else:
+                for conn in list(sim.connections):
+                    await conn.stop()
+                # Frames being encoded for other clients still read the model
+                async with sim.lock:
+                    if sim.clock is None:
+                        sim.startClock(tick)
+
+        elif command == cmds.STOP.value:
+            await self.stop()
+
+        elif command == cmds.KEYFRAME.value and self.replay is not None:
+            self.replay.sent = None
+            await self.send(await self.registry.run(self.replayFrame))
+
+        elif command == cmds.KEYFRAME.value and sim.clock is not None:
+            # The next snapshot sent goes as a keyframe
+            if self.encoder is not None:
+                self.encoder.reset()
+
+        elif command == cmds.KEYFRAME.value and sim.started:
+            if self.encoder is not None:
+                self.encoder.reset()
+            async with sim.lock:
+                await self.send(await self.registry.run(self.frame))
+
+        elif command == cmds.SHARE.value and args:
+            # Let other clients attach to this simulation under a name
+            sim.name = args[0]
+            self.registry.shared[args[0]] = sim
+
+        elif command == cmds.ATTACH.value and args:
+            shared = self.registry.shared.get(args[0])
+            if shared is not None:
+                await self.attach(shared, owner=False)
+                snap = await self.nextSnapshot() if shared.clock is not None else None
+                if snap is not None:
+                    await self.send(await self.registry.run(self.clockFrame, snap))
+                elif shared.started:
+                    async with shared.lock:
+                        await self.send(await self.registry.run(self.frame))
+
+        elif command == cmds.REPLAY.value and not args:
+            await self.send(framed(json.dumps(self.registry.listRuns()).encode('utf-8')))
+
+        elif command == cmds.REPLAY.value:
+            # Watch a recorded run from its first step
+            run = self.registry.openRun(args[0])
+            if run is not None:
+                await self.stop()
+                self.replay = Replay(run)
+                await self.registry.run(self.replay.seek, 0)
+                await self.send(await self.registry.run(self.replayFrame))
+
+        elif command == cmds.SEEK.value and self.replay is not None and args:
+            await self.stop()
+            await self.registry.run(self.replay.seek, int(args[0]))
+            await self.send(await self.registry.run(self.replayFrame))
+
+        elif command == cmds.LOAD.value:
+            await self.send(framed(json.dumps(self.registry.load()).encode('utf-8')))
+
+        elif command == cmds.STATS.value:
+            # stats [on|off|reset]: toggle or clear the timers, then report them
+            stats = sim.stats
+            if args and args[0] in ('on', 'off'):
+                stats.enabled = args[0] == 'on'
+            elif args and args[0] == 'reset':
+                stats.reset()
+            report = stats.snapshot()
+            if sim.started:
+                report['pathCache'] = sim.model.pathfinder.cache_info()
+            await self.send(framed(json.dumps(report).encode('utf-8')))
+
+        elif command == cmds.METRICS.value and sim.started:
+            # metrics [N]: traffic totals plus the last N steps of every series
+            steps = int(args[0]) if args else 0
+            report = await self.betweenSteps(sim.model.metrics.report, steps)
+            await self.send(framed(json.dumps(report).encode('utf-8')))
@@ -0,0 +1,124 @@
+'''
+Headless parameter sweeps.
+
+Runs the model for every combination of the given parameter values on a
+process pool, without the socket server or any frame encoding, and writes one
+row of summary metrics per run to a columnar file (.npz or .csv).
+
+    python sweep.py --numCars 10 50 100 --numPedestrians 15 60 \\
+        --spawnEvery 5 10 --lightPeriod 4 8 --steps 200 --reps 3 --out sweep.npz
+'''
+import argparse
+import csv
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from constants import CAR, PEDESTRIAN
+from mapgen import loadMap
+from model import CityModel, params
+
+# Parameters that can be swept from the command line
+SWEEPABLE = ['numCars', 'numPedestrians', 'spawnEvery', 'lightPeriod']
+
+def runOne(config: dict) -> dict:
+    '''
+    Run one configuration and summarize it. `config` has the model
+    parameters to override, the number of steps, the seed and optionally the
+    directory of a saved map
+    '''
+    base = dict(params, **loadMap(config['map'])) if config.get('map') else params
+    model = CityModel(dict(base, **config['params']))
+    steps = config['steps']
+
+    start = time.perf_counter()
+    model.sim_setup(steps=steps, seed=config['seed'])
+    agents = 0
+    for _ in range(steps):
+        model.sim_step()
+        agents += len(model.agents)
+    wall = time.perf_counter() - start
+
+    cars = sum(1 for agent in model.agents if agent.typeCode == CAR)
+    traffic = model.metrics.report()
+    return {
+        **config['params'],
+        'seed': config['seed'],
+        'steps': steps,
+        'seconds': wall,
+        'stepsPerSec': steps / wall if wall else 0.0,
+        'meanAgents': agents / steps if steps else 0.0,
+        'finalCars': cars,
+        'finalPedestrians': len(model.agents) - cars,
+        'spawnedCars': int(model.spawned[CAR]),
+        'despawnedCars': int(model.despawned[CAR]),
+        'despawnedPedestrians': int(model.despawned[PEDESTRIAN]),
+        'pathCacheHitRate': model.pathfinder.cache_info()['hit_rate'],
+        'meanQueue': float(sum(traffic['meanQueue'])),
+        'carsThrough': int(sum(traffic['through'])),
+        'meanPedWait': traffic['pedWait'].get('mean', 0.0),
+    }
+
+def configs(grid: dict, steps: int, reps: int, seed: int, map=None) -> list:
+    '''
+    Every combination of the values in `grid`, `reps` times, each with its
+    own seed derived from `seed`
+    '''
+    names = list(grid)
+    combos = list(itertools.product(*(grid[name] for name in names)))
+    seeds = np.random.SeedSequence(seed).generate_state(len(combos) * reps)
+    return [
+        {
+            'params': dict(zip(names, combo)),
+            'steps': steps,
+            'seed': int(seeds[i * reps + rep]),
+            'map': map,
+        }
+        for i, combo in enumerate(combos)
+        for rep in range(reps)
+    ]
+
+def sweep(grid: dict, steps=100, reps=1, seed=0, workers=None, map=None) -> dict:
+    '''
+    Run a sweep and return its results as columns (name -> array)
+    '''
+    runs = configs(grid, steps, reps, seed, map)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        rows = list(pool.map(runOne, runs))
+    return { name: np.array([row[name] for row in rows]) for name in rows[0] } if rows else {}
+
+def save(columns: dict, path: str):
+    if path.endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(zip(*(col.tolist() for col in columns.values())))
+    else:
+        np.savez(path, **columns)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for name in SWEEPABLE:
+        parser.add_argument(f'--{name}', type=int, nargs='+', default=[params[name]])
+    parser.add_argument('--steps', type=int, default=100)
+    parser.add_argument('--reps', type=int, default=1, help='Runs per combination')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='sweep.npz', help='.npz or .csv file')
+    parser.add_argument('--map', help='Directory with a map saved by mapgen.py')
+    args = parser.parse_args()
+
+    grid = { name: getattr(args, name) for name in SWEEPABLE }
+    start = time.perf_counter()
+    columns = sweep(grid, args.steps, args.reps, args.seed, args.workers, args.map)
+    wall = time.perf_counter() - start
+
+    save(columns, args.out)
+    runs = len(columns['seed'])
+    print(f'{runs} runs in {wall:.1f}s ({runs / wall:.1f} runs/s) -> {args.out}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+import binframe
+from binframe import AGENT_DTYPE, FULL, KEY, DELTA, FLAG_GRID, FLAG_VIEW
+
+def records(rows):
+    return np.array(rows, dtype=AGENT_DTYPE)
+
+AGENTS = records([
+    (1, 0, 3, 4, -1, -1),
+    (2, 1, 5, 6, 7, 8),
+])
+GRID = np.arange(6 * 5, dtype=np.uint32).reshape(6, 5)
+
+def test_keyframe_round_trip():
+    lights = [{ 'id': 1 << 16, 'state': 'green' }, { 'id': 2 << 16, 'state': 'red' }]
+    frame = binframe.decode(binframe.pack(KEY, 7, GRID.shape, GRID, agents=AGENTS, lights=lights))
+
+    assert frame['kind'] == KEY
+    assert frame['seq'] == 7
+    assert frame['dims'] == (6, 5)
+    assert frame['view'] is None
+    np.testing.assert_array_equal(frame['grid'], GRID)
+    np.testing.assert_array_equal(frame['agents'], AGENTS)
+    assert binframe.agentDicts(frame['agents']) == [
+        { 'id': 1, 'pos': [3, 4], 'type': 'car', 'goal': None },
+        { 'id': 2, 'pos': [5, 6], 'type': 'pedestrian', 'goal': [7, 8] },
+    ]
+    assert frame['lights']['id'].tolist() == [1 << 16, 2 << 16]
+    assert [binframe.LIGHT_NAMES[s] for s in frame['lights']['state'].tolist()] == ['green', 'red']
+    assert len(frame['moved']) == len(frame['goals']) == len(frame['deleted']) == 0
+
+def test_delta_round_trip():
+    data = binframe.pack(
+        DELTA, 8, GRID.shape, agents=AGENTS[:1], moved=[[2, 5, 7]], goals=[[2, None], [1, 9, 1]],
+        deleted=[10, 11], lights=[{ 'id': 2 << 16, 'state': 'green' }],
+    )
+    header = binframe.HEADER.unpack_from(data, 0)
+    assert header[3] & (FLAG_GRID | FLAG_VIEW) == 0
+
+    frame = binframe.decode(data)
+    assert frame['kind'] == DELTA
+    assert frame['seq'] == 8
+    assert frame['grid'] is None
+    np.testing.assert_array_equal(frame['agents'], AGENTS[:1])
+    assert frame['moved'].tolist() == [(2, 5, 7)]
+    assert frame['goals'].tolist() == [(2, -1, -1), (1, 9, 1)]
+    assert frame['deleted'].tolist() == [10, 11]
+    assert frame['lights'].tolist() == [(2 << 16, binframe.GREEN)]
+
+def test_view_round_trip():
+    view = (1, 2, 4, 5)
+    tiles = GRID[1:4, 2:5]
+    frame = binframe.decode(binframe.pack(FULL, 0, GRID.shape, tiles, agents=AGENTS, deleted=[3], view=view))
+
+    assert frame['kind'] == FULL
+    assert frame['dims'] == (6, 5)
+    assert frame['view'] == view
+    np.testing.assert_array_equal(frame['grid'], tiles)
+    np.testing.assert_array_equal(frame['agents'], AGENTS)
+    assert frame['deleted'].tolist() == [3]
+
+def test_sections_stay_aligned():
+    data = binframe.pack(DELTA, 1, GRID.shape, moved=[[1, 2, 3]], deleted=[4], view=(0, 0, 2, 2))
+    assert len(data) % 4 == 0
+
+def test_bad_magic():
+    data = bytearray(binframe.pack(KEY, 1, GRID.shape, GRID))
+    data[:4] = b'XXXX'
+    with pytest.raises(ValueError):
+        binframe.decode(bytes(data))
@@ -0,0 +1,39 @@
+import numpy as np
+
+import mapgen
+from hierarchy import MOVES
+from mapindex import MapData
+from pathfinding import PathFinder
+
+def test_cluster_moves_match_the_move_graph():
+    road, dirs, _ = mapgen.tile(2)
+    data = MapData(road, dirs)
+    moves = data.moveGraphs()
+    for is_pedestrian, graph in data.clusterGraphs(8).items():
+        cols = graph.cols
+        for cell in range(road.size):
+            x, y = divmod(cell, cols)
+            bits = int(graph.intra_bits[x, y])
+            inside = {
+                (x + dx, y + dy) for i, (_, dx, dy) in enumerate(MOVES)
+                if bits >> i & 1
+            }
+            expected = {
+                n for n in moves[is_pedestrian].neighbors((x, y))
+                if graph.cluster[n] == graph.cluster[x, y]
+            }
+            assert inside == expected, (is_pedestrian, (x, y))
+
+def test_paths_take_the_moves_of_the_move_graph():
+    road, dirs, _ = mapgen.tile(2)
+    hpa = PathFinder(road, dirs, cluster=8)
+    flat = PathFinder(road, dirs, cache_bytes=0)
+    rng = np.random.default_rng(0)
+    for i in range(60):
+        is_pedestrian = i % 2 == 1
+        tiles = hpa.index.tiles(is_pedestrian)
+        start, goal = (tuple(tiles[rng.integers(len(tiles))].tolist()) for _ in range(2))
+        path = hpa.find_path(start, goal, is_pedestrian)
+        assert bool(path) == bool(flat.find_path_astar(start, goal, is_pedestrian))
+        for a, b in zip(path, path[1:]):
+            assert b in hpa.get_valid_neighbors(a, is_pedestrian)
@@ -0,0 +1,49 @@
+import numpy as np
+
+from constants import RO, RC, LIGHT_SHIFT, GREEN, RED
+from model import LightSystem
+
+def lightMap(groups):
+    '''
+    One tile per light, every intersection on a row of its own
+    '''
+    road = np.full((len(groups), max(len(g) for g in groups)), RO, dtype=np.uint32)
+    for i, group in enumerate(groups):
+        for j, ID in enumerate(group):
+            road[i, j] = RC | ID
+    return road
+
+def switches(lights, steps):
+    '''
+    Steps at which every intersection switched lights
+    '''
+    seen = [[] for _ in lights.groupSize]
+    for _ in range(steps):
+        before = lights.greenIdx.copy()
+        lights.step()
+        for g in np.flatnonzero(lights.greenIdx != before).tolist():
+            seen[g].append(lights.t)
+    return seen
+
+GROUPS = [[1 << LIGHT_SHIFT, 2 << LIGHT_SHIFT], [3 << LIGHT_SHIFT, 4 << LIGHT_SHIFT]]
+
+def test_period_and_offset():
+    lights = LightSystem(GROUPS, lightMap(GROUPS), periods=[8, 8], offsets=[0, 3])
+    assert switches(lights, 24) == [[8, 16, 24], [3, 11, 19]]
+
+def test_default_period():
+    lights = LightSystem(GROUPS, lightMap(GROUPS), period=5)
+    assert switches(lights, 12) == [[5, 10], [5, 10]]
+
+def test_one_green_per_intersection():
+    road = lightMap(GROUPS)
+    lights = LightSystem(GROUPS, road, periods=[2, 3])
+    for _ in range(12):
+        lights.step()
+        for g, group in enumerate(GROUPS):
+            states = [lights.state[ID >> LIGHT_SHIFT] for ID in group]
+            assert states.count(GREEN) == 1
+            # Cars drive into the green tile only, pedestrians cross the red one
+            green = states.index(GREEN)
+            assert lights.carPass[g].tolist() == [j == green for j in range(len(group))]
+            assert lights.pedPass[g].tolist() == [states[j] == RED for j in range(len(group))]
@@ -1,4 +1,5 @@
 import json
+import numpy as np
 
 class Encodable:
     def toJSON(self):
@@ -21,4 +22,7 @@ class Encodable:
         elif isinstance(obj, dict):
             return { key:Encodable.serialize(val) for key, val in obj.items() }
 
+        elif isinstance(obj, (np.ndarray, np.generic)):
+            return obj.tolist()
+
         return obj
\ No newline at end of file
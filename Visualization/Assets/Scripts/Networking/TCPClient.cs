@@ -46,7 +46,8 @@ public class TCPClient {
             return;
         }
 
-        socket.Send(Encoding.Default.GetBytes(msg));
+        // The server reads one command per line
+        socket.Send(Encoding.Default.GetBytes(msg + "\n"));
     }
 
     public event Action<string> OnRecv;